@@ -0,0 +1,139 @@
+"""
+Benchmark of the native NUTS sampler (`utils.training.NUTS`) against the pymc3 NUTS path
+(`utils.BNN_pymc3`), on the posterior of a BNN_LV fitted to the wet-chicken transitions.
+
+The metric is the effective sample size (ESS) per second of wall-clock time
+(minimum and median over the network weights), with the ESS of both samplers
+computed by the same estimator (`utils.training.effective_sample_size`).
+The pymc3 time includes the theano compilation, since that is paid on every session.
+(The output noise of the network is switched off in both models, so that the target is deterministic.)
+
+Usage (from the root of the repository):
+    python -m benchmarks.bench_nuts --episodes 100 --samples 500 --chains 2
+    python -m benchmarks.bench_nuts --skip-pymc3
+"""
+
+import argparse
+import time
+
+import numpy
+
+from utils.games import WetChicken2D
+from utils.models import BNN_LV, BayesianModel, SamplerModel
+from utils.training import NUTS, effective_sample_size
+
+
+# Settings of the wet-chicken notebooks:
+ARCHITECTURE = {
+    'input_n' : 4,
+    'output_n' : 2,
+    'hidden_layers' : [20,20],
+    'biases' : [1,1,1],
+    'activations' : ['relu', 'relu', 'linear'],
+    'gamma' : [2.0],
+    'sigma' : [0.0, 0.0],  # No output noise (deterministic target).
+}
+PRIOR_WEIGHTS_STDEV = 5.0
+PRIOR_LATENTS_STDEV = 2.0
+LIKELIHOOD_STDEV = 0.25
+
+
+def make_dataset(episodes, seed):
+    env = WetChicken2D(L=5, W=3, max_steps=20, seed=seed)
+    env.run(episodes=episodes, policy=lambda state: (0,0))  # The "do nothing" policy.
+    transitions = env.extract_transition_dataset()
+    X = transitions[['start_x','start_y','action_x','action_y']].to_numpy().astype(float)
+    Y = transitions[['result_x','result_y']].to_numpy().astype(float)
+    return X, Y
+
+
+def summarize(name, weight_samples, seconds):
+    """
+    weight_samples: S-by-C-by-D tensor of the weights drawn by each chain.
+    """
+    ess = effective_sample_size(weight_samples)
+    print(f"{name:>8} : {seconds:8.1f} sec | ESS min {numpy.min(ess):8.1f} median {numpy.median(ess):8.1f} "
+          f"| ESS/sec min {numpy.min(ess)/seconds:8.3f} median {numpy.median(ess)/seconds:8.3f}")
+    return ess
+
+
+def run_native(X, Y, args):
+    nn = BNN_LV(architecture=ARCHITECTURE, seed=args.seed)
+    nn.fit(X, Y, step_size=0.01, max_iteration=args.fit_iterations, check_point=args.fit_iterations)
+    model = BayesianModel(
+        X, Y, nn,
+        prior_weights_stdev = PRIOR_WEIGHTS_STDEV,
+        prior_latents_stdev = PRIOR_LATENTS_STDEV,
+        likelihood_stdev = LIKELIHOOD_STDEV,
+    )
+    sampler_model = SamplerModel(model)
+    position_init = sampler_model.stack(nn.weights.reshape(1,-1), numpy.zeros((model.N,model.L)))
+    time_start = time.time()
+    nuts = NUTS(
+        sampler_model.log_posterior, position_init,
+        total_samples=args.samples, burn_in=args.burn_in, step_size=1e-3,
+        random_seed=args.seed, n_chains=args.chains,
+        adapt_step_size=True, target_accept=args.target_accept, adapt_mass=True,
+        max_depth=args.max_depth,
+    )
+    nuts.sample()
+    seconds = time.time() - time_start
+    weight_samples = numpy.asarray(nuts.chain_samples)[:,:,:model.D]
+    ess = summarize('native', weight_samples, seconds)
+    print(f"{'':>8}   step size {nuts.step_size:.2e}, mean tree depth {numpy.mean(nuts.tree_depths.data[nuts.burn_num:]):.1f}, "
+          f"{nuts.n_divergent} divergences, {nuts.gradient_provider.n_evals:,} gradient evaluations")
+    return ess, seconds
+
+
+def run_pymc3(X, Y, args):
+    import pymc3 as pm
+    from utils.BNN_pymc3 import BNN_LV as BNN_LV_pymc3
+    nn = BNN_LV_pymc3(architecture=ARCHITECTURE, seed=args.seed)
+    nn.fit(X, Y, step_size=0.01, max_iteration=args.fit_iterations, check_point=args.fit_iterations)
+    time_start = time.time()
+    with pm.Model():
+        w = pm.Normal(name='w', mu=0, sigma=PRIOR_WEIGHTS_STDEV, shape=nn.weights.shape)
+        z = pm.Normal(name='z', mu=0, sigma=PRIOR_LATENTS_STDEV, shape=(X.shape[0],1))
+        pm.Normal(
+            name='y', mu=nn.forward(X=X, input_noise=z, weights=w, output_noise='zero'),
+            sigma=LIKELIHOOD_STDEV, observed=Y,
+        )
+        burn_num = int(args.samples/(1.0-args.burn_in)) - args.samples
+        trace = pm.sample(
+            draws=args.samples, tune=burn_num, chains=args.chains, cores=1,
+            target_accept=args.target_accept, max_treedepth=args.max_depth,
+            random_seed=args.seed, return_inferencedata=False, progressbar=False,
+        )
+    seconds = time.time() - time_start
+    weight_samples = numpy.stack(trace.get_values('w', combine=False), axis=1)  # S-by-C-by-(weight shape).
+    weight_samples = weight_samples.reshape(*weight_samples.shape[:2], -1)
+    ess = summarize('pymc3', weight_samples, seconds)
+    return ess, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--episodes', type=int, default=100)
+    parser.add_argument('--samples', type=int, default=500)
+    parser.add_argument('--burn-in', type=float, default=0.5)
+    parser.add_argument('--chains', type=int, default=2)
+    parser.add_argument('--target-accept', type=float, default=0.8)
+    parser.add_argument('--max-depth', type=int, default=10)
+    parser.add_argument('--fit-iterations', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=207)
+    parser.add_argument('--skip-pymc3', action='store_true')
+    args = parser.parse_args()
+
+    X, Y = make_dataset(args.episodes, args.seed)
+    print(f"Wet-chicken dataset: X {X.shape}, Y {Y.shape}")
+    run_native(X, Y, args)
+    if args.skip_pymc3:
+        return
+    try:
+        run_pymc3(X, Y, args)
+    except ImportError as e:
+        print(f"Skipped the pymc3 benchmark ({e}).")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,16 @@
 """Testing for `utils` package."""
+import os
+import tempfile
+
 import numpy as np
+from autograd import grad
 
 from unittest import TestCase, main
-from utils.models import BNN
+from utils.buffers import GrowableArray, ColumnBuffer
+from utils.decomposition import knn_entropy, knn_entropy_2D, knn_entropy_batched, aleatoric_entropy_streaming, decompose_grid
+from utils.games import WetChicken2D, LunarLander2D, generate_transitions, GreedyPolicy, EpsilonGreedyPolicy, UniformPolicy, BatchedPolicy
+from utils.models import BNN, BNN_LV, BayesianModel, SamplerModel
+from utils.training import HMC, NUTS, SGHMC, SGLD, BBVI, GradientProvider, WelfordVariance, effective_sample_size
 
 class exampleTests(TestCase):
     def test_basic(self):
@@ -91,5 +99,454 @@ class nnTests(TestCase):
         assert results.shape == (1,1,2)
 
 
+    def test_feedforward_broadcasts_weight_samples(self):
+        architecture = {'input_n':3, 'output_n':2, 'hidden_layers':[5,4], 'biases':[1,0,1],
+                        'activations':['relu','relu','linear']}
+        nn = BNN(architecture=architecture, seed=207)
+        W = nn.random_weights(S=6)
+        X = np.random.RandomState(0).randn(10,3)
+        results = nn.forward(X, weights=W)
+        assert results.shape == (6,10,2)
+        for s in range(6):
+            np.testing.assert_allclose(results[s], nn.forward(X, weights=W[s:s+1]))
+        # A stack of datasets is broadcast against a single set of weights:
+        np.testing.assert_allclose(nn.forward(np.stack([X,2*X]), weights=W[:1])[1], nn.forward(2*X, weights=W[:1]))
+
+    def test_unstack_weights_and_gradient(self):
+        architecture = {'input_n':2, 'output_n':1, 'hidden_layers':[3], 'biases':[1,1],
+                        'activations':['relu','linear']}
+        nn = BNN(architecture=architecture, seed=207)
+        W_0, W_1 = nn.unstack_weights(nn.weights)
+        assert (W_0.shape, W_1.shape) == ((1,3,3), (1,4,1))
+        assert np.shares_memory(W_0, nn.weights) and np.shares_memory(W_1, nn.weights)
+        # Gradients still flow through the fused bias and ReLU:
+        X = np.random.RandomState(0).randn(5,2)
+        objective = lambda W: np.sum(nn.forward(X, weights=W)**2)
+        gradient = grad(objective)(nn.weights)
+        eps = 1e-6
+        numerical = np.array([
+            (objective(nn.weights + eps*e) - objective(nn.weights - eps*e)) / (2*eps)
+            for e in np.eye(nn.D)
+        ]).reshape(1,-1)
+        np.testing.assert_allclose(gradient, numerical, rtol=1e-4, atol=1e-6)
+
+    def test_fit_history_and_best_weights(self):
+        architecture = {'input_n':1, 'output_n':1, 'hidden_layers':[5], 'biases':[1,1],
+                        'activations':['relu','linear']}
+        nn = BNN(architecture=architecture, seed=207)
+        X = np.linspace(-1,1,20).reshape(-1,1)
+        Y = np.sin(3*X)
+        nn.fit(X, Y, step_size=0.01, max_iteration=50, check_point=None, thinning=10)
+        assert nn.objective_trace.shape == (5,1) and nn.weight_trace.shape == (5,nn.D)
+        # The recorded objective matches the recorded weights (from the same evaluation as the gradient):
+        mse = np.mean(np.sum((Y - nn.forward(X, weights=nn.weight_trace[2:3]))**2, axis=-1))
+        np.testing.assert_allclose(nn.objective_trace[2,0], mse)
+        # The best weights over all iterations are kept (not only the recorded ones):
+        assert nn.best_objective <= np.min(nn.objective_trace)
+        np.testing.assert_allclose(np.mean(np.sum((Y - nn.forward(X))**2, axis=-1)), nn.best_objective)
+
+# Sampler Tests
+def log_standard_normal(q):
+    return -0.5*np.sum(q**2, axis=-1)
+
+class hmcTests(TestCase):
+    def test_multichain_standard_normal(self):
+        hmc = HMC(log_standard_normal, np.zeros(3), total_samples=400, leapfrog_steps=8, step_size=0.2,
+                  burn_in=0.1, random_seed=207, n_chains=4)
+        samples = hmc.sample()
+        assert samples.shape == (4*400,3)
+        assert hmc.chain_samples.shape == (400,4,3)
+        assert hmc.n_accepted + hmc.n_rejected == 4*hmc.iters
+        np.testing.assert_allclose(samples.mean(axis=0), 0.0, atol=0.15)
+        np.testing.assert_allclose(samples.std(axis=0), 1.0, atol=0.15)
+
+    def test_gradient_provider_value_and_grad(self):
+        provider = GradientProvider(log_standard_normal)
+        q = np.array([[1.0,2.0],[-3.0,0.5]])
+        value, gradient = provider.value_and_grad(q)
+        np.testing.assert_allclose(value, log_standard_normal(q))
+        np.testing.assert_allclose(gradient, -q)
+        # One fused evaluation per leapfrog step (plus one at the initial position):
+        hmc = HMC(log_standard_normal, np.zeros(2), total_samples=10, leapfrog_steps=5, burn_in=0.0, random_seed=207)
+        hmc.sample()
+        assert hmc.gradient_provider.n_evals == 1 + 5*hmc.iters
+
+    def test_sample_buffer_views_and_warm_start(self):
+        hmc = HMC(log_standard_normal, np.zeros(2), total_samples=20, leapfrog_steps=3, burn_in=0.5, thinning_factor=2, random_seed=207)
+        samples = hmc.sample()
+        assert samples.shape == (20,2)
+        assert np.shares_memory(samples, hmc.raw_samples.data)
+        assert not samples.flags.writeable
+        np.testing.assert_array_equal(samples, hmc.raw_samples.data[hmc.burn_num::2].reshape(-1,2))
+        samples = hmc.sample(new_samples=5)
+        assert samples.shape == (25,2)
+        assert len(hmc.raw_samples) == hmc.iters + 10
+
+    def test_checkpoint_appends_and_reloads(self):
+        hmc = HMC(log_standard_normal, np.zeros(2), total_samples=10, leapfrog_steps=3, random_seed=207, n_chains=2)
+        hmc.sample()
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'hmc_state.npz')
+            filepaths = hmc.save_state(filepath)
+            samples_path = filepaths[1]
+            hmc.sample(new_samples=5)
+            hmc.save_state(filepath, replace=True)
+            assert os.path.getsize(samples_path) == hmc.raw_samples.data.nbytes
+            loaded = HMC(log_standard_normal, np.zeros(2), total_samples=10, leapfrog_steps=3, random_seed=0, n_chains=2)
+            loaded.load_state(filepath)
+            assert isinstance(loaded.raw_samples.data, np.memmap)
+            np.testing.assert_array_equal(loaded.samples, hmc.samples)
+            assert loaded.np_random.rand() == hmc.np_random.rand()
+
+    def test_step_size_and_mass_adaptation(self):
+        stdev = np.array([0.1,1.0,5.0])
+        log_target = lambda q: log_standard_normal(q/stdev)
+        hmc = HMC(log_target, np.zeros(3), total_samples=500, leapfrog_steps=10, step_size=0.05, burn_in=0.5,
+                  random_seed=207, n_chains=4, adapt_step_size=True, target_accept=0.8, adapt_mass=True)
+        hmc.sample()
+        np.testing.assert_allclose(hmc.mass, 1/stdev**2, rtol=0.3)
+        assert hmc.step_size > 0.5
+        np.testing.assert_allclose(hmc.n_accepted/(hmc.n_accepted+hmc.n_rejected), 0.8, atol=0.1)
+        assert hmc.effective_samples_per_gradient().shape == (3,)
+
+    def test_welford_and_effective_sample_size(self):
+        rows = np.random.RandomState(207).randn(1000,4,2)
+        welford = WelfordVariance(2)
+        for row in rows:
+            welford.update(row)
+        np.testing.assert_allclose(welford.mean, rows.reshape(-1,2).mean(axis=0))
+        np.testing.assert_allclose(welford.variance, rows.reshape(-1,2).var(axis=0, ddof=1))
+        # Independent samples have an effective sample size close to the number of samples:
+        np.testing.assert_allclose(effective_sample_size(rows), 4000, rtol=0.1)
+        # A slowly mixing chain has far fewer:
+        assert np.all(effective_sample_size(np.cumsum(rows, axis=0)) < 100)
+
+    def test_nuts_standard_normal(self):
+        nuts = NUTS(log_standard_normal, np.zeros(3), total_samples=300, step_size=0.5, burn_in=0.25,
+                    random_seed=207, n_chains=2)
+        samples = nuts.sample()
+        assert samples.shape == (2*300,3)
+        np.testing.assert_allclose(samples.mean(axis=0), 0.0, atol=0.2)
+        np.testing.assert_allclose(samples.std(axis=0), 1.0, atol=0.15)
+        assert nuts.gradient_provider.n_evals == 1 + nuts.n_leapfrog
+        # The depth of the trees is capped:
+        capped = NUTS(log_standard_normal, np.zeros(3), total_samples=20, step_size=0.01, burn_in=0.0,
+                      adapt_step_size=False, max_depth=3, random_seed=207)
+        capped.sample()
+        assert np.all(capped.tree_depths.data == 3)
+        assert capped.n_leapfrog == capped.iters * (2**3-1)
+
+
+def make_sampler_model(N=8, seed=207):
+    architecture = {'input_n':1, 'output_n':1, 'hidden_layers':[3], 'biases':[1,1],
+                    'activations':['relu','linear'], 'gamma':[1.0], 'sigma':[0.0]}
+    nn = BNN_LV(architecture=architecture, seed=seed)
+    X = np.linspace(-1,1,N).reshape(-1,1)
+    return SamplerModel(BayesianModel(X, np.sin(3*X), nn))
+
+class samplerModelTests(TestCase):
+    def test_vectorize_batched_and_chunked(self):
+        sampler_model = make_sampler_model()
+        samples = np.random.RandomState(0).randn(5, sampler_model.D+sampler_model.N)
+        W, Z = sampler_model.unstack(samples)
+        looped = np.array([sampler_model.model.log_posterior(w.reshape(1,-1), z) for w, z in zip(W,Z)]).flatten()
+        np.testing.assert_allclose(sampler_model.log_posterior(samples), looped)
+        # A small memory budget evaluates the samples in chunks, with the same values and gradients:
+        chunked = make_sampler_model()
+        chunked.max_chunk_bytes = 1
+        assert chunked.chunk_size() == 1
+        np.testing.assert_allclose(chunked.vectorize(chunked.model.log_posterior, W, Z, chunk_size=2), looped)
+        objective = lambda model: (lambda q: np.sum(model.log_posterior(q)))
+        np.testing.assert_allclose(grad(objective(chunked))(samples), grad(objective(sampler_model))(samples))
+
+    def test_stack_and_unstack_views(self):
+        sampler_model = make_sampler_model()
+        samples = np.random.RandomState(0).randn(5, sampler_model.D+sampler_model.N)
+        W, Z = sampler_model.unstack(samples)
+        assert np.shares_memory(W, samples) and np.shares_memory(Z, samples)
+        # Halves of one packed buffer are not copied, other inputs are written into a new buffer:
+        assert sampler_model.stack(W, Z) is samples
+        np.testing.assert_array_equal(sampler_model.stack(W.copy(), Z), samples)
+        # A single sample is broadcast to the other's sample count:
+        np.testing.assert_array_equal(sampler_model.stack(W[:1], Z)[:,:sampler_model.D], np.tile(W[:1], (5,1)))
+        np.testing.assert_array_equal(sampler_model.stack(W, Z[0])[:,sampler_model.D:], np.tile(Z[0].reshape(1,-1), (5,1)))
+        with self.assertRaises(ValueError):
+            sampler_model.stack(W[:2], Z[:3])
+
+class sghmcTests(TestCase):
+    def test_standard_normal(self):
+        for sampler in [SGHMC, SGLD]:
+            hmc = sampler(log_standard_normal, np.zeros(3), total_samples=400, leapfrog_steps=5, step_size=0.1,
+                          burn_in=0.1, random_seed=207, n_chains=4)
+            samples = hmc.sample()
+            assert samples.shape == (4*400,3)
+            np.testing.assert_allclose(samples.mean(axis=0), 0.0, atol=0.15)
+            np.testing.assert_allclose(samples.std(axis=0), 1.0, atol=0.15)
+
+    def test_minibatch_gradient(self):
+        sampler_model = make_sampler_model()
+        dims = sampler_model.D + sampler_model.N
+        hmc = SGHMC(sampler_model.log_posterior, np.zeros(dims), total_samples=5, leapfrog_steps=2, step_size=1e-3,
+                    random_seed=207, n_chains=2, batch_size=3, sampler_model=sampler_model)
+        q = np.random.RandomState(0).randn(2, dims)
+        U, G = hmc.potential_value_and_grad(q)
+        batch = sampler_model.sample_batch(3, np.random.RandomState(207))
+        touched = np.zeros(sampler_model.N, dtype=bool)
+        touched[batch] = True
+        assert U.shape == (2,)
+        assert np.all(G[:,sampler_model.D:][:,~touched] == 0)
+        assert np.all(G[:,sampler_model.D:][:,touched] != 0)
+        samples = hmc.sample()
+        assert samples.shape == (2*5,dims)
+        assert hmc.gradient_provider.n_evals == 1 + 1 + 2*hmc.iters
+
+
+class bbviTests(TestCase):
+    def test_single_evaluation_per_step_and_diagnostics(self):
+        kwargs = dict(num_samples=50, step_size=0.1, num_iters=30, random_seed=207)
+        bbvi = BBVI(log_standard_normal, np.ones(2), np.ones(2), **kwargs)
+        bbvi.run()
+        # The callback reuses the value and gradient of the ADAM step:
+        assert bbvi.gradient_provider.n_evals == bbvi.num_iters
+        assert bbvi.elbo_hist.shape == (30,1)
+        np.testing.assert_allclose(bbvi.magnitude_hist[:,0], np.linalg.norm(bbvi.gradident_hist, axis=1))
+        # Diagnostics use their own random state and do not change the optimization:
+        diagnosed = BBVI(log_standard_normal, np.ones(2), np.ones(2), diagnostic_interval=10, **kwargs)
+        diagnosed.run()
+        assert diagnosed.diagnostic_hist.shape == (3,3)
+        np.testing.assert_array_equal(diagnosed.diagnostic_hist[:,0], [10,20,30])
+        np.testing.assert_array_equal(diagnosed.params_hist, bbvi.params_hist)
+
+    def test_minibatch_objective(self):
+        sampler_model = make_sampler_model()
+        samples = np.random.RandomState(0).randn(2, sampler_model.D+sampler_model.N)
+        # A batch of all rows (once or twice, scaled by N/B) matches the full log posterior:
+        for batch in [np.arange(8), np.tile(np.arange(8), 2)]:
+            np.testing.assert_allclose(
+                sampler_model.log_posterior(samples[:,sampler_model.batch_columns(batch)], batch=batch),
+                sampler_model.log_posterior(samples),
+            )
+        # Only the latent variables of the batch get a gradient:
+        bbvi = BBVI(sampler_model.log_posterior, np.zeros(samples.shape[1]), np.ones(samples.shape[1]),
+                    num_samples=5, num_iters=3, random_seed=207, batch_size=2, sampler_model=sampler_model)
+        gradient = bbvi.variational_gradient(bbvi.params_init)
+        batch = sampler_model.sample_batch(2, np.random.RandomState(207))
+        touched = np.zeros(sampler_model.N, dtype=bool)
+        touched[batch] = True
+        latent_gradient = gradient.reshape(2,-1)[:,sampler_model.D:]
+        assert np.all(latent_gradient[:,~touched] == 0)
+        assert np.all(latent_gradient[:,touched] != 0)
+        bbvi.run()
+        assert bbvi.params_hist.shape == (3, 2*samples.shape[1])
+
+
+class bufferTests(TestCase):
+    def test_growable_array(self):
+        buffer = GrowableArray(row_shape=(2,), capacity=1)
+        for i in range(10):
+            buffer.append([i,-i])
+        buffer.extend(np.ones((5,2)))
+        assert len(buffer) == 15
+        assert buffer.capacity >= 15
+        np.testing.assert_array_equal(buffer[:10,0], np.arange(10))
+        np.testing.assert_array_equal(np.array(buffer)[10:], 1)
+
+    def test_column_buffer(self):
+        buffer = ColumnBuffer(['x', 'y'], dtype=np.int8, capacity=1)
+        for i in range(10):
+            buffer.append((i, -i))
+        buffer.extend({'x' : np.ones(5), 'y' : np.zeros(5)})
+        assert len(buffer) == 15 and buffer.capacity >= 15
+        np.testing.assert_array_equal(buffer['y'][:10], -np.arange(10))
+        assert buffer['x'].dtype == np.int8 and buffer['x'].flags['C_CONTIGUOUS']
+        assert buffer.columns()['x'].base is not None  # Views of the buffer.
+
+
+class entropyTests(TestCase):
+    def test_knn_entropy(self):
+        from scipy.spatial.distance import pdist, squareform
+        from scipy.special import gamma
+        points = np.random.RandomState(0).randn(2, 4000, 2)
+        # k=1 matches the estimator based on the full distance matrix:
+        distances = squareform(pdist(points[0])) + np.diag(np.full(4000, np.inf))
+        expected = 2*np.mean(np.log(distances.min(axis=1))) + np.log(np.pi/gamma(2)) + (np.euler_gamma + np.log(4000-1))
+        H = knn_entropy(points)
+        assert H.shape == (2,)
+        np.testing.assert_array_equal(H[0], expected)
+        # Entropy of a standard bivariate normal (for any k):
+        for k in [1, 5]:
+            np.testing.assert_allclose(knn_entropy(points, k=k), np.log(2*np.pi*np.e), atol=0.1)
+
+    def test_knn_entropy_batched(self):
+        y_stack = np.random.RandomState(0).randn(4,3,50,2)  # S by N by L by D.
+        for k in [1, 3]:
+            expected = np.array([[knn_entropy_2D(matrix, k=k) for matrix in tensor] for tensor in y_stack])
+            # Blocks of stacks (by broadcasting) and single stacks (by k-d tree) give the same results:
+            np.testing.assert_array_equal(knn_entropy_batched(y_stack, k=k, max_block_bytes=1), expected)
+            np.testing.assert_array_equal(knn_entropy_batched(y_stack, k=k, max_broadcast_n=10), expected)
+        # Shards in worker processes (over shared memory) give the same results for any number of workers:
+        for n_jobs in [2, 3]:
+            np.testing.assert_array_equal(knn_entropy_batched(y_stack, n_jobs=n_jobs), knn_entropy_batched(y_stack))
+
+    def test_aleatoric_entropy_streaming(self):
+        architecture = {'input_n':2, 'output_n':2, 'hidden_layers':[5], 'biases':[1,1],
+                        'activations':['relu','linear'], 'gamma':[1.0], 'sigma':[0.1,0.2]}
+        S, N, L = 6, 4, 20
+        x_test_stack = np.tile(np.random.RandomState(0).randn(N,2), reps=(L,1))
+        W = BNN_LV(architecture=architecture, seed=0).random_weights(S=S)
+        # Single forward pass over all samples (as the decomposition functions did before):
+        y_stack = BNN_LV(architecture=architecture, seed=207).forward(x_test_stack, W).reshape(S,-1,L,2)
+        expected = knn_entropy_batched(y_stack)
+        # Chunks of samples give the same result, blocks of rows (of whole groups) the same up to rounding:
+        for max_block_bytes, assert_equal in [(2**28, np.testing.assert_array_equal), (15000, np.testing.assert_array_equal), (1, np.testing.assert_allclose)]:
+            nn = BNN_LV(architecture=architecture, seed=207)
+            assert_equal(aleatoric_entropy_streaming(nn, x_test_stack, W, L, max_block_bytes=max_block_bytes), expected)
+        # The same with the blocks in worker processes (one pool for the whole pass):
+        nn = BNN_LV(architecture=architecture, seed=207)
+        np.testing.assert_array_equal(aleatoric_entropy_streaming(nn, x_test_stack, W, L, max_block_bytes=15000, n_jobs=2), expected)
+
+    def test_decompose_grid(self):
+        architecture = {'input_n':4, 'output_n':2, 'hidden_layers':[5], 'biases':[1,1],
+                        'activations':['relu','linear'], 'gamma':[1.0], 'sigma':[0.1,0.1]}
+        nn = BNN_LV(architecture=architecture, seed=207)
+        env = WetChicken2D(L=5, W=3)
+        decomposition = decompose_grid(nn, env, nn.random_weights(S=20), N2=2, L=20)
+        np.testing.assert_array_equal(decomposition['x'], [1,2,3])
+        np.testing.assert_array_equal(decomposition['y'], [1,2,3,4,5])
+        for kind in ['total', 'aleatoric', 'epistemic']:
+            assert decomposition[kind].shape == (5,3)
+        np.testing.assert_allclose(decomposition['aleatoric'] + decomposition['epistemic'], decomposition['total'])
+        # The same with the entropies in worker processes (a pool started for both passes, or given by the caller):
+        from concurrent.futures import ProcessPoolExecutor
+        samples = BNN_LV(architecture=architecture, seed=207).random_weights(S=20)
+        expected = decompose_grid(BNN_LV(architecture=architecture, seed=207), env, samples, N2=2, L=20)
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            for kwargs in [dict(n_jobs=2), dict(executor=executor)]:
+                parallel = decompose_grid(BNN_LV(architecture=architecture, seed=207), env, samples, N2=2, L=20, **kwargs)
+                np.testing.assert_array_equal(parallel['total'], expected['total'])
+                np.testing.assert_array_equal(parallel['aleatoric'], expected['aleatoric'])
+
+
+class gamesTests(TestCase):
+    def test_batch_simulation_matches_per_step(self):
+        key = ['start_x','start_y','action_x','action_y','result_x','result_y']
+        # (The lunar lander episodes are shorter, so more of them are needed for the same number of transitions.)
+        for env_cls, episodes in [(WetChicken2D, 2000), (LunarLander2D, 8000)]:
+            env = env_cls(max_steps=20, seed=0)
+            env.run(episodes=episodes)
+            reference = env.extract_transition_dataset()
+            batched = env_cls(max_steps=20, seed=1)
+            batched.run_batch(episodes=episodes, batch_size=700)
+            transitions = batched.extract_transition_dataset()
+            assert batched.episode_count == env.episode_count
+            # Same transition frequencies (up to Monte Carlo error):
+            frequencies = lambda df: df.groupby(key).size() / len(df)
+            difference = frequencies(reference).subtract(frequencies(transitions), fill_value=0)
+            assert np.max(np.abs(difference)) < 0.01
+            # Episodes are stored in order, and each one ends when it is terminal or after max_steps:
+            columns = batched.simulate_batch(500)
+            assert np.all(np.diff(columns['episode']) >= 0)
+            last = np.r_[np.diff(columns['episode']) > 0, True]
+            ended = batched.is_terminal(columns['result_x'][last], columns['result_y'][last]) | (columns['step'][last] == 19)
+            assert np.all(ended)
+            assert not np.any(batched.is_terminal(columns['result_x'][~last], columns['result_y'][~last]))
+
+    def test_lunar_lander_termination(self):
+        # A crash (y == 0) or the column x == 2 ends the episode, in both simulations:
+        assert LunarLander2D.is_terminal(3, 0) and LunarLander2D.is_terminal(2, 4)
+        assert not LunarLander2D.is_terminal(3, 2)
+        env = LunarLander2D(max_steps=20, seed=0)
+        env.run(episodes=200)
+        ends = [states[-1] for states in env.state_history[:-1] if len(states) <= 20]
+        assert all((y == 0) or (x == 2) for x,y in ends)
+        columns = env.simulate_batch(2000)
+        assert not np.any((columns['start_y'] == 0) | (columns['start_x'] == 2) & (columns['step'] > 0))
+
+    def test_columnar_history(self):
+        env = WetChicken2D(max_steps=20, seed=0)
+        env.run(episodes=50)
+        env.run_batch(episodes=50)
+        assert env.transitions.dtype == np.int8
+        assert env.episode_count == 101 and env.step_count == 0
+        transitions = env.extract_transition_dataset()
+        assert env.total_step_count == len(transitions)
+        # The dataset is a copy (with the integer type of the previous implementation):
+        assert all(transitions.dtypes == np.int64)
+        transitions.iloc[0,0] = 99
+        assert env.transitions['start_x'][0] != 99
+        # The lists of the history are built from the buffer (the first position and the result of each step):
+        states, actions = env.state_history, env.action_history
+        assert len(states) == env.episode_count
+        assert sum(len(episode) for episode in actions) == env.total_step_count
+        for ep in [0, 49, 50, 99]:
+            assert len(states[ep]) == len(actions[ep]) + 1
+            assert env.is_terminal(*states[ep][-1]) or len(actions[ep]) == 20
+        assert states[-1] == [env.state]
+        # Empty episodes keep their first position, and the lists hold Python integers:
+        env.new_episode()
+        empty = env.state_history[-2]
+        assert len(empty) == 1 and empty[0] == tuple(env.episode_starts[-2])
+        env.noise = env.simulate_noise()
+        history = env.state_history + env.noise_history + env.action_history
+        assert {type(value) for episode in history for step in episode for value in step} == {int}
+
+    def test_transition_probabilities(self):
+        env = WetChicken2D(L=5, W=3, seed=0)
+        P = env.transition_probabilities
+        assert P.shape == (3, 6, 4, 3, 6)
+        assert env.transition_probabilities is WetChicken2D(L=5, W=3).transition_probabilities  # Cached.
+        np.testing.assert_allclose(P.sum(axis=(-2,-1)), 1)
+        # Turbulence in [-1,+1] and current -1 in the middle of the river, [-2,+2] and -2 on the right bank:
+        np.testing.assert_allclose(P[1,3,0,1,[1,2,3]], 1/3)
+        np.testing.assert_allclose(P[2,1,0,2,[0,1]], [4/5,1/5])
+        # The sampler draws from the table, and simulated episodes follow it:
+        n = 200_000
+        x, y, action = np.full(n, 2), np.full(n, 3), np.full(n, 3)
+        result_x, result_y = env.sample_transitions(x, y, action)
+        np.testing.assert_allclose(np.bincount(result_y[result_x==2], minlength=6)/n, P[1,3,3,1], atol=0.01)
+        columns = env.simulate_batch(20_000)
+        start = (columns['start_x']==2) & (columns['start_y']==5) & (columns['action']==0)
+        np.testing.assert_allclose(np.bincount(columns['result_y'][start], minlength=6)/np.sum(start), P[1,5,0,1], atol=0.02)
+
+    def test_generate_transitions_reproducible(self):
+        columns = generate_transitions(LunarLander2D, 250, seed=3, shard_episodes=100, max_steps=15)
+        # Episodes are numbered across the shards (in order):
+        np.testing.assert_array_equal(np.unique(columns['episode']), np.arange(250))
+        assert np.all(np.diff(columns['episode']) >= 0)
+        # The same for any number of workers:
+        for n_workers in [2, 3]:
+            parallel = generate_transitions(LunarLander2D, 250, n_workers=n_workers, seed=3, shard_episodes=100, max_steps=15)
+            for name in columns:
+                np.testing.assert_array_equal(parallel[name], columns[name])
+        assert len(generate_transitions(LunarLander2D, 0, seed=3)['episode']) == 0
+
+    def test_tabular_policies(self):
+        Q = np.random.RandomState(0).randn(3, 6, 4)  # W by (L+1) by A.
+        best = np.argmax(Q, axis=-1)
+        env = WetChicken2D(max_steps=20, seed=0)
+        # Greedy actions are lookups in the table of the best action in each state:
+        columns = env.simulate_batch(2000, policy=GreedyPolicy(Q))
+        np.testing.assert_array_equal(columns['action'], best[columns['start_x']-1, columns['start_y']])
+        # Epsilon-greedy actions are greedy, except for a fraction epsilon of uniformly random ones:
+        columns = env.simulate_batch(20_000, policy=EpsilonGreedyPolicy(Q, epsilon=0.2))
+        greedy = columns['action'] == best[columns['start_x']-1, columns['start_y']]
+        np.testing.assert_allclose(np.mean(greedy), 0.8 + 0.2/4, atol=0.01)
+        counts = np.bincount(env.simulate_batch(5000, policy=UniformPolicy())['action'], minlength=4)
+        np.testing.assert_allclose(counts/np.sum(counts), 0.25, atol=0.02)
+        # The same policies drive the per-step simulation, and the batched one is reproducible from the seed:
+        env.run(episodes=20, policy=GreedyPolicy(Q))
+        for states, actions in zip(env.state_history, env.action_history):
+            assert actions == [env.valid_actions[best[x-1,y]] for x,y in states[:len(actions)]]
+        policy = EpsilonGreedyPolicy(Q, epsilon=0.5)
+        first, second = [WetChicken2D(seed=1).simulate_batch(100, policy=policy) for _ in range(2)]
+        np.testing.assert_array_equal(first['action'], second['action'])
+        # Functions of the states are wrapped in a BatchedPolicy, and functions of the environment are only for the per-step simulation:
+        columns = env.simulate_batch(100, policy=BatchedPolicy(lambda states: np.full(len(states), 3)))
+        assert np.all(columns['action'] == 3)
+        with self.assertRaises(TypeError):
+            env.run_batch(episodes=10, policy=lambda env: (0,0))
+        assert env.episode_count == 21 and env.step_count == 0  # (The history is unchanged.)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,202 @@
+"""
+Growable array buffers.
+
+A buffer stores a sequence of rows (each with the same fixed shape)
+in a preallocated numpy array, so that appending a row does not copy
+the rows that were already stored. When the buffer is full, its capacity
+is grown geometrically, which makes appends O(1) (amortized).
+The stored rows are exposed as views of the underlying array.
+`ColumnBuffer` does the same for a table of named columns (stored column by column).
+"""
+
+import numpy as np
+
+
+class GrowableArray:
+    """
+    A preallocated array of rows that can be appended to.
+    The rows are stored along the first dimension of an
+    (capacity)-by-(row_shape) array, and `data` is a view
+    of the rows that have been filled so far.
+    """
+
+    def __init__(self, row_shape=(), dtype=float, capacity=0):
+        """
+        row_shape:
+            Shape of each row (e.g. `(D,)` for a sequence of length-D vectors).
+
+        dtype:
+            Numpy data type of the stored values.
+
+        capacity:
+            Number of rows to preallocate.
+        """
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self._array = np.empty((int(capacity), *self.row_shape), dtype=self.dtype)
+        self._size = 0
+
+    @classmethod
+    def from_array(cls, array):
+        """
+        Wrap an existing array (without copying it) as a full buffer.
+        The array is only copied if rows are appended later.
+        """
+        buffer = cls(row_shape=array.shape[1:], dtype=array.dtype, capacity=0)
+        buffer._array = array
+        buffer._size = array.shape[0]
+        return buffer
+
+    @property
+    def capacity(self):
+        return self._array.shape[0]
+
+    @property
+    def data(self):
+        """ View of the filled rows. """
+        return self._array[:self._size]
+
+    @property
+    def shape(self):
+        return (self._size, *self.row_shape)
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.data
+        return self.data.astype(dtype)
+
+    def __repr__(self):
+        return f"GrowableArray(shape={self.shape}, dtype={self.dtype}, capacity={self.capacity})"
+
+    def reserve(self, n):
+        """
+        Make sure there is room for `n` more rows
+        (grows the capacity by at least a factor of 2 if a reallocation is needed).
+        """
+        required = self._size + int(n)
+        if required <= self.capacity:
+            return
+        capacity = max(required, 2*self.capacity)
+        array = np.empty((capacity, *self.row_shape), dtype=self.dtype)
+        array[:self._size] = self._array[:self._size]
+        self._array = array
+
+    def append(self, row):
+        """
+        Copy a single row into the buffer.
+        """
+        if self._size == self.capacity:
+            self.reserve(1)
+        self._array[self._size] = row
+        self._size += 1
+
+    def extend(self, rows):
+        """
+        Copy a stack of rows (with the rows along the first dimension) into the buffer.
+        """
+        rows = np.asarray(rows)
+        n = rows.shape[0]
+        self.reserve(n)
+        self._array[self._size:self._size+n] = rows
+        self._size += n
+
+    def pop(self):
+        """
+        Remove the last row and return (a copy of) it.
+        """
+        assert self._size > 0, "Cannot pop from an empty buffer."
+        self._size -= 1
+        return self._array[self._size].copy()
+
+    def clear(self):
+        """
+        Remove all rows (the allocated memory is kept for reuse).
+        """
+        self._size = 0
+
+
+class ColumnBuffer:
+    """
+    A preallocated table of named columns (all with the same data type) that rows can be appended to.
+    The values are stored column by column in an (columns)-by-(capacity) array,
+    so each column of the filled rows is a contiguous view (e.g. to build a dataframe without copying).
+    """
+
+    def __init__(self, names, dtype=float, capacity=0):
+        """
+        names:
+            Names of the columns (in order).
+
+        dtype:
+            Numpy data type of the stored values (e.g. a small integer type for compact tables).
+
+        capacity:
+            Number of rows to preallocate.
+        """
+        self.names = list(names)
+        self.index = {name : i for i, name in enumerate(self.names)}
+        self.dtype = np.dtype(dtype)
+        self._array = np.empty((len(self.names), int(capacity)), dtype=self.dtype)
+        self._size = 0
+
+    @property
+    def capacity(self):
+        return self._array.shape[1]
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, name):
+        """ View of the filled rows of a column. """
+        return self._array[self.index[name], :self._size]
+
+    def __repr__(self):
+        return f"ColumnBuffer(names={self.names}, rows={self._size}, dtype={self.dtype}, capacity={self.capacity})"
+
+    def columns(self):
+        """ Dictionary of views of the filled rows of each column. """
+        return {name : self[name] for name in self.names}
+
+    def reserve(self, n):
+        """
+        Make sure there is room for `n` more rows
+        (grows the capacity by at least a factor of 2 if a reallocation is needed).
+        """
+        required = self._size + int(n)
+        if required <= self.capacity:
+            return
+        capacity = max(required, 2*self.capacity)
+        array = np.empty((len(self.names), capacity), dtype=self.dtype)
+        array[:, :self._size] = self._array[:, :self._size]
+        self._array = array
+
+    def append(self, row):
+        """
+        Copy a single row (a value for each column, in order) into the buffer.
+        """
+        if self._size == self.capacity:
+            self.reserve(1)
+        self._array[:, self._size] = row
+        self._size += 1
+
+    def extend(self, columns):
+        """
+        Copy a block of rows, given as a dictionary of equally long arrays (one for each column), into the buffer.
+        """
+        n = len(columns[self.names[0]])
+        self.reserve(n)
+        for name in self.names:
+            self._array[self.index[name], self._size:self._size+n] = columns[name]
+        self._size += n
+
+    def clear(self):
+        """
+        Remove all rows (the allocated memory is kept for reuse).
+        """
+        self._size = 0
@@ -4,19 +4,47 @@ import tensorflow
 tensorflow.random.set_seed(1)
 
 import scipy as sp
+import numpy
 import autograd.numpy as np
 import pandas as pd
 
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import pdist, squareform
 # from tensorflow imort set_random_seed
-import matplotlib.pyplot as plt
-import matplotlib as mpl
+# Note: matplotlib is only imported by the plotting functions (so that decompositions can run headless).
 
 
 
 
 ## Entropy calculation
-def knn_entropy_2D(data_points, metric="euclidean"):
+
+# Metrics supported by the k-d tree (as the order of the Minkowski p-norm):
+KDTREE_METRICS = {'euclidean': 2, 'minkowski': 2, 'cityblock': 1, 'manhattan': 1, 'chebyshev': np.inf}
+
+def knn_distances(data_points, k=1, metric="euclidean"):
+    """
+    Distance from each of the n points (rows of an n by p matrix) to its k-th nearest neighbor
+    (not counting the point itself). Uses a k-d tree, i.e. O(n log n) time and O(n) memory,
+    unless the metric is not a Minkowski norm (see KDTREE_METRICS), in which case
+    the full n by n distance matrix is computed.
+    """
+    n = data_points.shape[0]
+    assert n > k, f"Need more than k={k} points to find the k-th nearest neighbor, not {n}."
+    if metric in KDTREE_METRICS:
+        # Query k+1 neighbors because the closest one is the point itself (at distance 0):
+        tree = cKDTree(data_points)
+        distances, _ = tree.query(data_points, k=[k+1], p=KDTREE_METRICS[metric])
+        return distances[:,0]
+    # Set the distance to self to infinity, then find the k-th smallest distance in each row:
+    distances = squareform(pdist(data_points, metric))
+    np.fill_diagonal(distances, np.inf)
+    return np.partition(distances, k-1, axis=1)[:,k-1]
+
+def knn_entropy_2D(data_points, metric="euclidean", k=1):
 
 
     """
@@ -30,34 +58,179 @@ def knn_entropy_2D(data_points, metric="euclidean"):
     n = data_points.shape[0]
 
     hypersphere_k = np.log( (np.pi ** (p/2)) / sp.special.gamma((p/2) + 1) )
-    euler_k = np.euler_gamma + np.log(n-1)
+    # Note: -digamma(1) is the Euler-Mascheroni constant, so k=1 gives `euler_gamma + log(n-1)`:
+    euler_k = -sp.special.digamma(k) + np.log(n-1)
 
-    # Set the distance to self to infinity
-    inf_diag = np.diag(np.ones(data_points.shape[0]) * np.inf)
+    # Distance to the k-th closest neighbor
+    p_i = knn_distances(data_points, k=k, metric=metric)
 
-    # Loop over each stack and calculate the entropy
-    #for stack in data_points.shape[-1]
+    # Calculate Entropy
+    H = p * np.mean(np.log(p_i)) + hypersphere_k + euler_k
+
+    return H
 
-    # Create the distance matrix from point to all other points
-    distances = squareform(pdist(data_points, metric)) + inf_diag
 
-    # Closest neighbor distance
-    p_i = np.min(distances, axis=1)
+# Metrics for which the distances of a block of stacks are computed by broadcasting:
+BROADCAST_METRICS = {'euclidean', 'minkowski', 'cityblock', 'manhattan', 'chebyshev'}
+
+def knn_distances_batched(data_points, k=1, metric="euclidean"):
+    """
+    Batched version of `knn_distances` for a B by n by p tensor of B stacks (for small n):
+    the B by n by n distances of the whole block are computed at once by broadcasting,
+    which gives the same distances as `pdist` (and as the k-d tree).
+    """
+    n, p = data_points.shape[-2:]
+    assert n > k, f"Need more than k={k} points to find the k-th nearest neighbor, not {n}."
+    # Accumulate the B by n by n distances one dimension at a time (in place):
+    distances = None
+    for j in range(p):
+        difference = data_points[:,:,None,j] - data_points[:,None,:,j]  # B by n by n.
+        if metric in {'cityblock', 'manhattan'}:
+            np.abs(difference, out=difference)
+        elif metric=='chebyshev':
+            np.abs(difference, out=difference)
+            if distances is not None:
+                np.maximum(distances, difference, out=distances)
+                continue
+        else:
+            difference *= difference
+        if distances is None:
+            distances = difference
+        else:
+            distances += difference
+    if metric not in {'cityblock', 'manhattan', 'chebyshev'}:
+        np.sqrt(distances, out=distances)
+    # Set the distance to self to infinity, then find the k-th smallest distance in each row:
+    diagonal = np.arange(n)
+    distances[:,diagonal,diagonal] = np.inf
+    if k==1:
+        return np.min(distances, axis=-1)
+    return np.partition(distances, k-1, axis=-1)[...,k-1]
+
+def _knn_entropy_stacks(data_points, metric="euclidean", k=1, max_block_bytes=2**20, max_broadcast_n=512):
+    """
+    Entropy of each stack of a B by n by p tensor (see `knn_entropy_batched`).
+    """
+    B, n, p = data_points.shape
+
+    # Set up constants
+    hypersphere_k = np.log( (np.pi ** (p/2)) / sp.special.gamma((p/2) + 1) )
+    euler_k = -sp.special.digamma(k) + np.log(n-1)
+
+    # Distance to the k-th closest neighbor (B by n):
+    p_i = np.empty((B, n))
+    if (metric in BROADCAST_METRICS) and (n <= max_broadcast_n):
+        block_size = max(1, int(max_block_bytes // (8*n*n)))
+        for start in range(0, B, block_size):
+            p_i[start:start+block_size] = knn_distances_batched(data_points[start:start+block_size], k=k, metric=metric)
+    else:
+        for b in range(B):
+            p_i[b] = knn_distances(data_points[b], k=k, metric=metric)
 
     # Calculate Entropy
-    H = p * np.mean(np.log(p_i)) + hypersphere_k + euler_k
+    H = p * np.mean(np.log(p_i), axis=-1) + hypersphere_k + euler_k
+
+    return H
 
+def _knn_entropy_shard(shared_name, shape, start, stop, **kwargs):
+    """
+    Worker task for `knn_entropy_batched`: attach to the shared B by n by p tensor (by name)
+    and calculate the entropy of the stacks `start:stop` (only the indices are sent to the worker).
+    """
+    shared = shared_memory.SharedMemory(name=shared_name)
+    data_points = numpy.ndarray(shape, dtype=float, buffer=shared.buf)
+    H = _knn_entropy_stacks(data_points[start:stop], **kwargs)
+    del data_points  # Release the view before closing the shared memory.
+    shared.close()
     return H
 
+def knn_entropy_batched(data_points, metric="euclidean", k=1, max_block_bytes=2**20, max_broadcast_n=512, n_jobs=1, executor=None):
+    """
+    Batched engine for `knn_entropy`: calculate the entropy of each stack of n points
+    in a (...) by n by p tensor (e.g. S by N by L by D) and return a (...) tensor.
+
+    The stacks are processed in blocks, with one vectorised nearest-neighbor computation per block
+    (`knn_distances_batched`), where the size of each block is chosen so that its pairwise distances
+    (block by n by n values) fit in `max_block_bytes` (small blocks stay in the cache). Stacks with more than `max_broadcast_n` points
+    (or metrics that cannot be broadcast) use the k-d tree of `knn_distances` one stack at a time.
+    The results are the same as `knn_entropy_2D` on each stack.
+
+    n_jobs:
+        Number of worker processes. If more than 1, the tensor is copied once into shared memory
+        and the stacks are split into contiguous shards, so only the shard indices are sent to the workers.
+        Each stack is computed independently, so the results do not depend on the number of workers.
+    executor:
+        An existing process pool (e.g. `concurrent.futures.ProcessPoolExecutor`) to run the shards on,
+        instead of creating one with `n_jobs` workers (`n_jobs` still sets the number of shards, 4 per job).
+    """
+    seed(1)
+    tensorflow.random.set_seed(1)
 
-def knn_entropy(data_points, metric="euclidean"):
+    assert len(data_points.shape) >= 2, "Error: Data must have (at least) 2 dimensions (rows = data, columns = dimensions)"
+    stack_shape = data_points.shape[:-2]
+    n, p = data_points.shape[-2:]
+    data_points = data_points.reshape(-1, n, p)
+    B = data_points.shape[0]
+    kwargs = dict(metric=metric, k=k, max_block_bytes=max_block_bytes, max_broadcast_n=max_broadcast_n)
+
+    if (executor is None and n_jobs==1) or B<=1:
+        # Sequential:
+        H = _knn_entropy_stacks(data_points, **kwargs)
+        return H.reshape(stack_shape)
+
+    # Copy the stacks into shared memory (once) and split them into shards:
+    n_shards = min(B, 4*n_jobs)
+    bounds = numpy.linspace(0, B, n_shards+1).astype(int)
+    shared = shared_memory.SharedMemory(create=True, size=max(1, data_points.size*8))
+    try:
+        shared_points = numpy.ndarray(data_points.shape, dtype=float, buffer=shared.buf)
+        shared_points[:] = data_points
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers=n_jobs)
+        try:
+            futures = [
+                executor.submit(_knn_entropy_shard, shared.name, data_points.shape, start, stop, **kwargs)
+                for start, stop in zip(bounds[:-1], bounds[1:])
+            ]
+            H = numpy.concatenate([future.result() for future in futures])
+        finally:
+            if own_executor:
+                executor.shutdown()
+        del shared_points
+    finally:
+        shared.close()
+        shared.unlink()
+
+    return H.reshape(stack_shape)
+
+@contextmanager
+def process_pool(n_jobs=1, executor=None):
     """
-    Utilize KNN approximation to calculate the entropy of a set of points.
+    Context for the passes that use `knn_entropy_batched` several times: yields `executor` if given,
+    or else a process pool with `n_jobs` workers (shut down on exit) if `n_jobs` is more than 1, or else None
+    (so that the pool is started once, instead of once per call).
+    """
+    if executor is not None or n_jobs==1:
+        yield executor
+        return
+    executor = ProcessPoolExecutor(max_workers=n_jobs)
+    try:
+        yield executor
+    finally:
+        executor.shutdown()
+
+def knn_entropy(data_points, metric="euclidean", k=1, n_jobs=1, executor=None):
+    """
+    Utilize KNN approximation to calculate the entropy of a set of points
+    (the Kozachenko-Leonenko estimator, based on the distance to the k-th nearest neighbor).
 
     Data must be SxNxM where N = data points, M = dimensionality, S = stack 
     (as we are calculating entropy per datapoint S is usually going to be X)
 
     If distance are all zero (say a vector of ones) then returns -inf
+
+    n_jobs and executor: worker processes or existing process pool (see knn_entropy_batched)
     """
     seed(1)
     tensorflow.random.set_seed(1)
@@ -65,10 +238,58 @@ def knn_entropy(data_points, metric="euclidean"):
     assert(isinstance(data_points, np.ndarray)), "Error: Data must be a numpy 3D array (rows = data, columns = dimensions, depth=stacks)"
     assert(len(data_points.shape) == 3), "Error: Data must be a numpy 3D array (rows = data, columns = dimensions, depth=stacks)"
 
-    H = np.stack([knn_entropy_2D(matrix) for matrix in data_points],axis=-1)
+    H = knn_entropy_batched(data_points, metric=metric, k=k, n_jobs=n_jobs, executor=executor)
 
     return H
 
+def aleatoric_entropy_streaming(bnn_lv, x_test_stack, w_samples, L, max_block_bytes=2**28, metric="euclidean", k=1, n_jobs=1, executor=None):
+    """
+    Entropy of each group of L consecutive rows of `x_test_stack` (i.e. the L replicates of a test point)
+    under the predictions of each of the S sets of weights in `w_samples` (S by D),
+    returned as an S by (number of rows / L) matrix.
+
+    This is the same as a single forward pass of `bnn_lv` over all samples followed by `knn_entropy_batched`
+    (reshaped to S by N by L by K), but it never materialises the S by (N*L) by K output:
+    the samples are processed in chunks and the rows in blocks (of whole groups), so that the activations
+    of each block (and its output noise) fit in `max_block_bytes`, and each block is reduced to its entropies
+    before moving on. The noise is drawn in the same order as in the single forward pass,
+    so the results do not depend on the memory budget (up to rounding in the matrix products
+    when a single sample has to be split into blocks of rows).
+
+    n_jobs and executor: worker processes or existing process pool for the entropies (see knn_entropy_batched);
+    a pool started for `n_jobs` is shared by all the blocks.
+    """
+    S = w_samples.shape[0]
+    R = x_test_stack.shape[0]
+    assert R % L == 0, f"Expects the rows of x_test_stack ({R}) to be groups of L={L} replicates."
+    G = R // L
+    K = bnn_lv.layers['output_n']
+
+    # Bytes per sample per row (inputs, latent inputs, activations of each layer and output noise):
+    row_bytes = 8 * (bnn_lv.M + bnn_lv.L + sum(bnn_lv.layers['all_layers_shape']) + K)
+    sample_chunk = max(1, min(S, int(max_block_bytes // (row_bytes*R))))
+    row_block = R if sample_chunk>1 else max(L, L*int(max_block_bytes // (row_bytes*L)))
+
+    # Draw the input noise for all rows (shared by all samples), as `BNN_LV.add_input_noise` does:
+    Z = bnn_lv.random.normal(loc=0, scale=bnn_lv.gamma, size=(R, bnn_lv.L))
+
+    epi_H_W = numpy.empty((S, G))
+    # (one process pool for all the blocks, if any)
+    with process_pool(n_jobs, executor) as executor:
+        for s_start in range(0, S, sample_chunk):
+            W = w_samples[s_start:s_start+sample_chunk]
+            # Draw the output noise of this chunk of samples, as `BNN_LV.add_output_noise` does:
+            Eps_shape = (R, K) if S==1 else (W.shape[0], R, K)
+            Eps = bnn_lv.random.normal(loc=0, scale=bnn_lv.sigma, size=Eps_shape).reshape(W.shape[0], R, K)
+            for r_start in range(0, R, row_block):
+                rows = slice(r_start, r_start+row_block)
+                y_block = bnn_lv.forward(x_test_stack[rows], W, input_noise=Z[rows], output_noise='zero') + Eps[:,rows]
+                y_block = y_block.reshape(W.shape[0], -1, L, K)  # samples x groups x L x dim
+                groups = slice(r_start//L, r_start//L + y_block.shape[1])
+                epi_H_W[s_start:s_start+sample_chunk, groups] = knn_entropy_batched(y_block, metric=metric, k=k, n_jobs=n_jobs, executor=executor)
+                del y_block
+    return epi_H_W
+
 def moving_average(x, w):
     # moving average for simplified uncertainty plotting
     # https://stackoverflow.com/questions/14313510/how-to-calculate-rolling-moving-average-using-numpy-scipy
@@ -77,12 +298,15 @@ def moving_average(x, w):
 
     return np.convolve(x, np.ones(w), 'valid') / w
 
-def uncertainty_decompose_entropy(bnn_lv, X_train, w_samples, S, N, N2, D, avg_window=10):
+def uncertainty_decompose_entropy(bnn_lv, X_train, w_samples, S, N, N2, D, avg_window=10, n_jobs=1, max_block_bytes=2**28, executor=None):
     """
     S = number of samples
     N  = number of x datapoints
     N2 = number of x datapoints for calculating entropy
     D = Dimensions of y
+    n_jobs = number of worker processes for the entropy calculations (see knn_entropy_batched)
+    executor = existing process pool for the entropy calculations (instead of starting one with n_jobs workers)
+    max_block_bytes = memory budget of the aleatoric pass (see aleatoric_entropy_streaming)
     """
 
     seed(1)
@@ -98,19 +322,22 @@ def uncertainty_decompose_entropy(bnn_lv, X_train, w_samples, S, N, N2, D, avg_w
     # Get the stack of predictions from the 2000 samples of weights (over 1000 x data points)
     y_star = bnn_lv.forward(x_test_space_small.reshape(-1,1), w_random_samples)
 
-    # Reshape it to be (1000 x 2000 x 1 - NxSxM - stacks(x) by samples by dimensions) - calculate entropies
-    overall_entropy = knn_entropy(y_star.swapaxes(0,1))
-
     # Create a duplicated set of data to predict L times per set of samples
     x_test_stack = np.tile(x_test_space_small.reshape(-1,1), reps=(1,L)).reshape(-1,1)
-    y_stack = bnn_lv.forward(x_test_stack, w_random_samples)
-    y_stack = y_stack.reshape(S,-1,L,D)
 
-    epi_H_W = np.stack([knn_entropy(tensor) for tensor in y_stack],axis=-1)
+    # (one process pool for both passes, if any)
+    with process_pool(n_jobs, executor) as executor:
+        # Reshape it to be (1000 x 2000 x 1 - NxSxM - stacks(x) by samples by dimensions) - calculate entropies
+        overall_entropy = knn_entropy(y_star.swapaxes(0,1), n_jobs=n_jobs, executor=executor)
+
+        # (streamed over chunks of samples and blocks of rows, see aleatoric_entropy_streaming)
+        epi_H_W = aleatoric_entropy_streaming(bnn_lv, x_test_stack, w_random_samples, L, max_block_bytes=max_block_bytes, n_jobs=n_jobs, executor=executor)
+    epi_H_W = np.ascontiguousarray(epi_H_W.T)  # N by S.
     aleatoric_entropy = np.mean(epi_H_W, axis=-1)
 
     epistemic_entropy = overall_entropy - aleatoric_entropy
 
+    import matplotlib.pyplot as plt
 
     fig, ax = plt.subplots(1,3,figsize=(21,6))
     ax[0].plot(moving_average(x_test_space_small.flatten(),avg_window),
@@ -129,198 +356,142 @@ def uncertainty_decompose_entropy(bnn_lv, X_train, w_samples, S, N, N2, D, avg_w
     return epistemic_entropy, aleatoric_entropy
 
 
-def chicken_entropy_decompose(bnn_lv_in, transitions_in, w_samples_in, N, N2, L, name):
+## Grid environments
+
+def grid_decomposition(model, x_values, y_values, samples, N2=40, L=40, action=(0,0), n_jobs=1, max_block_bytes=2**28, executor=None):
     """
-    2D decomposition for 3x5 wet chicken grid
+    Entropy decomposition of the predicted next state of `model` (a BNN_LV with inputs [x, y, action_x, action_y])
+    at each cell of the grid spanned by `x_values` and `y_values`, when playing `action`.
+    samples:
+        S by D (or S by 1 by D) matrix of posterior samples of the weights.
+    N2:
+        Number of times each cell is repeated (the entropies of the repeats are averaged).
+    L:
+        Number of predictions per cell and per set of weights for the aleatoric entropy.
+    n_jobs, executor:
+        Worker processes, or an existing process pool, for the entropies (see `knn_entropy_batched`);
+        a pool started for `n_jobs` is shared by the total and aleatoric passes.
+
+    Returns a dictionary of arrays (without plotting, see `plot_grid_decomposition`):
+    'x' and 'y' (the grid values), and 'total', 'aleatoric' and 'epistemic' entropies
+    as images with one row per y value and one column per x value.
     """
-    # mpl.rcParams['svg.hashsalt'] = str(seed)
     seed(1)
     tensorflow.random.set_seed(1)
     np.random.seed(1)
 
-    np.random.RandomState(1)
+    x_values = numpy.asarray(x_values)
+    y_values = numpy.asarray(y_values)
+    w_samples = samples.reshape(samples.shape[0], -1)  # S by D.
+    image_shape = (len(y_values), len(x_values))
 
-    S = w_samples_in.shape[0] # number of samples
-    D = 2 # Dimensions of y
-      
-    x1_test_space_lst = np.arange(min(transitions_in['start_x']), 1+max(transitions_in['start_x']))
-    x2_test_space_lst = np.arange(min(transitions_in['start_y']), 1+max(transitions_in['start_y']))
+    # Cells of the grid (row-major in y, i.e. each row of the image is a y value), repeated N2 times:
+    x_grid, y_grid = numpy.meshgrid(x_values, y_values)
+    cells = numpy.stack([x_grid.ravel(), y_grid.ravel(), *[numpy.full(x_grid.size, a) for a in action]], axis=-1).astype(float)
+    x_test_space_small = numpy.tile(cells, reps=(N2,1))
 
-    x1_test_space_grid, x2_test_space_grid = np.meshgrid(x1_test_space_lst,x2_test_space_lst)
+    with process_pool(n_jobs, executor) as executor:
+        # Total entropy of the predictions of the S samples of weights at each test point:
+        y_star = model.forward(x_test_space_small, w_samples)
+        overall_entropy = knn_entropy(y_star.swapaxes(0,1), n_jobs=n_jobs, executor=executor)
+        del y_star
 
-    x1_test_space = list(x1_test_space_grid.ravel())*N
-    x2_test_space = list(x2_test_space_grid.ravel())*N
-    x_test_space = np.vstack([x1_test_space,x2_test_space,
-                          [0]*len(x2_test_space), [0]*len(x2_test_space)]).T
-
-
-    x1_test_space_small = list(x1_test_space_grid.ravel())*N2
-    x2_test_space_small = list(x2_test_space_grid.ravel())*N2
-    x_test_space_small = np.vstack([x1_test_space_small,x2_test_space_small,
-                          [0]*len(x2_test_space_small), [0]*len(x2_test_space_small)]).T
-
-    
-    
-    # Get the stack of predictions from the S samples of weights
-    y_star = bnn_lv_in.forward(x_test_space_small, w_samples_in.squeeze(1))
-
-    # Reshape it to be (NxSx2- stacks(x) by samples by dimensions) - calculate entropies
-    overall_entropy = knn_entropy(y_star.swapaxes(0,1))
-
-    # Create a duplicated set of data to predict L times per set of samples
-    x_test_stack = np.tile(x_test_space_small, reps=(L,1))
-    y_stack = bnn_lv_in.forward(x_test_stack, w_samples_in.squeeze(1))
-    y_stack = y_stack.reshape(S,-1,L,D) #samples x N x L x dim
-
-    epi_H_W = np.stack([knn_entropy(tensor) for tensor in y_stack],axis=-1)
-    aleatoric_entropy = np.mean(epi_H_W, axis=-1)
+        # Aleatoric entropy of L predictions (for each set of weights) at each test point,
+        # with the L replicates of each test point in consecutive rows:
+        x_test_stack = numpy.repeat(x_test_space_small, L, axis=0)
+        epi_H_W = aleatoric_entropy_streaming(model, x_test_stack, w_samples, L, max_block_bytes=max_block_bytes, n_jobs=n_jobs, executor=executor)
+    aleatoric_entropy = numpy.mean(epi_H_W, axis=0)
 
     epistemic_entropy = overall_entropy - aleatoric_entropy
-    
-    ### Saving out dataframe
-    decomposition_df = pd.DataFrame({'x':x_test_space_small[:,0], 'y':x_test_space_small[:,1],
-                                     'epistemic':epistemic_entropy, 'aleatoric':aleatoric_entropy})
-    decomposition_df.sort_values(['x','y'],inplace=True)
-    decomposition_df_avg = decomposition_df.groupby(['x','y']).mean().reset_index()
-    
-    ### Plotting
-
-    epistemic_im = np.zeros((5,3))
-    aleatoric_im = np.zeros((5,3))
-    for i, row in decomposition_df_avg.iterrows():
-        x = int(row['x'])-1
-        y = int(row['y'])-1
-        epistemic_im[y,x] = row['epistemic']
-        aleatoric_im[y,x] = row['aleatoric']
-    
-    fig, ax = plt.subplots(1,2,figsize=(20,10))
-    plot1 = ax[0].imshow(epistemic_im,origin='lower')
-    ax[0].set_title('Epistemic')
-    ax[0].set_xticks([0,1,2])
-    ax[0].set_xticklabels([1, 2, 3])
-    ax[0].set_xlabel('x')
-    ax[0].set_yticks(np.arange(5))
-    ax[0].set_yticklabels(np.arange(1,6))
-    ax[0].set_ylabel('y')
-    for (j,i),label in np.ndenumerate(np.round(epistemic_im,3)):
-        ax[0].text(i,j,label,ha='center',va='center')
-    fig.colorbar(plot1,ax=ax[0])
-
-    plot2 = ax[1].imshow(aleatoric_im,origin='lower')
-    ax[1].set_title('Aleatoric')
-    ax[1].set_xticks([0,1,2])
-    ax[1].set_xticklabels([1, 2, 3])
-    ax[1].set_xlabel('x')
-    ax[1].set_yticks(np.arange(5))
-    ax[1].set_yticklabels(np.arange(1,6))
-    ax[1].set_ylabel('y')
-    for (j,i),label in np.ndenumerate(np.round(aleatoric_im,3)):
-        ax[1].text(i,j,label,ha='center',va='center')
-    fig.colorbar(plot2,ax=ax[1])
-
-    # plt.gcf().set_dpi(300)
-    plt.savefig(name, dpi=300)
-    plt.show()
 
+    # Average the N2 repeats of each cell:
+    average = lambda entropy: numpy.mean(entropy.reshape(N2, -1), axis=0).reshape(image_shape)
+    decomposition = {
+        'x' : x_values,
+        'y' : y_values,
+        'total' : average(overall_entropy),
+        'aleatoric' : average(aleatoric_entropy),
+        'epistemic' : average(epistemic_entropy),
+    }
+    return decomposition
 
-    return decomposition_df_avg
 
-
-def lunar_entropy_decompose(bnn_lv_in, transitions_in, w_samples_in, N, N2, L, name): #in progress
+def decompose_grid(model, env, samples, N2=40, L=40, action=(0,0), n_jobs=1, max_block_bytes=2**28, executor=None):
     """
-    2D decomposition for 5x4 wet chicken grid
+    Entropy decomposition over all the (non-terminal) states of a grid environment
+    (e.g. `WetChicken2D` or `LunarLander2D`: x in 1..env.W and y in 1..env.L).
+    See `grid_decomposition` for the parameters and the returned arrays.
     """
-
-    seed(1)
-    tensorflow.random.set_seed(1)
-    np.random.seed(1)
-
-    np.random.RandomState(1)
-
-    S = w_samples_in.shape[0]  # number of samples
-    D = 2  # Dimensions of y
-
-    x1_test_space_lst = np.arange(min(transitions_in['start_x']), 1 + max(transitions_in['start_x']))
-    x2_test_space_lst = np.arange(min(transitions_in['start_y']), 1 + max(transitions_in['start_y']))
-
-    x1_test_space_grid, x2_test_space_grid = np.meshgrid(x1_test_space_lst, x2_test_space_lst)
-
-
-
-    x1_test_space = list(x1_test_space_grid.ravel()) * N
-    x2_test_space = list(x2_test_space_grid.ravel()) * N
-    x_test_space = np.vstack([x1_test_space, x2_test_space,
-                              [0] * len(x2_test_space), [0] * len(x2_test_space)]).T
+    x_values = numpy.arange(1, env.W+1)
+    y_values = numpy.arange(1, env.L+1)
+    return grid_decomposition(model, x_values, y_values, samples, N2=N2, L=L, action=action, n_jobs=n_jobs, max_block_bytes=max_block_bytes, executor=executor)
 
 
+def decomposition_dataframe(decomposition):
+    """
+    Convert the arrays of `grid_decomposition` to a dataframe with one row per cell (sorted by x and y).
+    """
+    x_grid, y_grid = numpy.meshgrid(decomposition['x'], decomposition['y'])
+    decomposition_df = pd.DataFrame({'x':x_grid.ravel(), 'y':y_grid.ravel(),
+                                     'epistemic':decomposition['epistemic'].ravel(), 'aleatoric':decomposition['aleatoric'].ravel()})
+    return decomposition_df.sort_values(['x','y']).reset_index(drop=True)
 
-    x1_test_space_small = list(x1_test_space_grid.ravel()) * N2
-    x2_test_space_small = list(x2_test_space_grid.ravel()) * N2
-    x_test_space_small = np.vstack([x1_test_space_small, x2_test_space_small,
-                                    [0] * len(x2_test_space_small), [0] * len(x2_test_space_small)]).T
-
-
-    # Get the stack of predictions from the S samples of weights
-    y_star = bnn_lv_in.forward(x_test_space_small, w_samples_in.squeeze(1))
-
-    #print(y_star) --> this changes
-
-
-    # Reshape it to be (NxSx2- stacks(x) by samples by dimensions) - calculate entropies
-    overall_entropy = knn_entropy(y_star.swapaxes(0, 1))
 
-    # Create a duplicated set of data to predict L times per set of samples
-    x_test_stack = np.tile(x_test_space_small, reps=(L, 1))
-    y_stack = bnn_lv_in.forward(x_test_stack, w_samples_in.squeeze(1))
-    y_stack = y_stack.reshape(S, -1, L, D)  # samples x N x L x dim
+def plot_grid_decomposition(decomposition, name=None, show=True, figsize=(20,10)):
+    """
+    Plot the epistemic and aleatoric entropy images of `grid_decomposition` side by side
+    (and save the figure to `name`, if provided).
+    """
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(1,2,figsize=figsize)
+    for i, kind in enumerate(['epistemic', 'aleatoric']):
+        image = decomposition[kind]
+        plot = ax[i].imshow(image,origin='lower')
+        ax[i].set_title(kind.capitalize())
+        ax[i].set_xticks(np.arange(len(decomposition['x'])))
+        ax[i].set_xticklabels(decomposition['x'])
+        ax[i].set_xlabel('x')
+        ax[i].set_yticks(np.arange(len(decomposition['y'])))
+        ax[i].set_yticklabels(decomposition['y'])
+        ax[i].set_ylabel('y')
+        for (j,k),label in np.ndenumerate(np.round(image,3)):
+            ax[i].text(k,j,label,ha='center',va='center')
+        fig.colorbar(plot,ax=ax[i])
+
+    if name is not None:
+        plt.savefig(name, dpi=300)
+    if show:
+        plt.show()
+    return fig, ax
+
+
+def transitions_grid(transitions):
+    """
+    Grid values (x and y) spanned by the start states of a transition dataset.
+    """
+    x_values = np.arange(min(transitions['start_x']), 1+max(transitions['start_x']))
+    y_values = np.arange(min(transitions['start_y']), 1+max(transitions['start_y']))
+    return x_values, y_values
 
-    epi_H_W = np.stack([knn_entropy(tensor) for tensor in y_stack], axis=-1)
-    aleatoric_entropy = np.mean(epi_H_W, axis=-1)
 
-    epistemic_entropy = overall_entropy - aleatoric_entropy
+def chicken_entropy_decompose(bnn_lv_in, transitions_in, w_samples_in, N, N2, L, name, n_jobs=1, max_block_bytes=2**28, executor=None):
+    """
+    2D decomposition for 3x5 wet chicken grid
+    (see grid_decomposition; the grid is spanned by the start states of the transitions, and N is not used)
+    """
+    x_values, y_values = transitions_grid(transitions_in)
+    decomposition = grid_decomposition(bnn_lv_in, x_values, y_values, w_samples_in, N2=N2, L=L, n_jobs=n_jobs, max_block_bytes=max_block_bytes, executor=executor)
+    plot_grid_decomposition(decomposition, name=name, figsize=(20,10))
+    return decomposition_dataframe(decomposition)
 
-    ### Saving out dataframe
-    decomposition_df = pd.DataFrame({'x': x_test_space_small[:, 0], 'y': x_test_space_small[:, 1],
-                                     'epistemic': epistemic_entropy, 'aleatoric': aleatoric_entropy})
-    decomposition_df.sort_values(['x', 'y'], inplace=True)
-    decomposition_df_avg = decomposition_df.groupby(['x', 'y']).mean().reset_index()
-
-    ### Plotting
-
-    epistemic_im = np.zeros((4, 5))
-    aleatoric_im = np.zeros((4, 5))
-    for i, row in decomposition_df_avg.iterrows():
-        x = int(row['x']) - 1
-        y = int(row['y']) - 1
-        epistemic_im[y, x] = row['epistemic']
-        aleatoric_im[y, x] = row['aleatoric']
-
-    fig, ax = plt.subplots(1, 2, figsize=(20, 5))
-    plot1 = ax[0].imshow(epistemic_im, origin='lower')
-    ax[0].set_title('Epistemic')
-    ax[0].set_xticks([0, 1, 2, 3, 4])
-    ax[0].set_xticklabels([1, 2, 3, 4, 5])
-    ax[0].set_xlabel('x')
-    ax[0].set_yticks(np.arange(4))
-    ax[0].set_yticklabels(np.arange(1, 5))
-    ax[0].set_ylabel('y')
-    for (j, i), label in np.ndenumerate(np.round(epistemic_im, 3)):
-        ax[0].text(i, j, label, ha='center', va='center')
-    fig.colorbar(plot1, ax=ax[0])
-
-    plot2 = ax[1].imshow(aleatoric_im, origin='lower')
-    ax[1].set_title('Aleatoric')
-    ax[1].set_xticks([0, 1, 2, 3, 4])
-    ax[1].set_xticklabels([1, 2, 3, 4, 5])
-    ax[1].set_xlabel('x')
-    ax[1].set_yticks(np.arange(4))
-    ax[1].set_yticklabels(np.arange(1, 5))
-    ax[1].set_ylabel('y')
-    for (j, i), label in np.ndenumerate(np.round(aleatoric_im, 3)):
-        ax[1].text(i, j, label, ha='center', va='center')
-    fig.colorbar(plot2, ax=ax[1])
-
-    plt.savefig(name, dpi=300)
-    plt.show()
 
-    return decomposition_df_avg
\ No newline at end of file
+def lunar_entropy_decompose(bnn_lv_in, transitions_in, w_samples_in, N, N2, L, name, n_jobs=1, max_block_bytes=2**28, executor=None):
+    """
+    2D decomposition for 5x4 lunar lander grid
+    (see grid_decomposition; the grid is spanned by the start states of the transitions, and N is not used)
+    """
+    x_values, y_values = transitions_grid(transitions_in)
+    decomposition = grid_decomposition(bnn_lv_in, x_values, y_values, w_samples_in, N2=N2, L=L, n_jobs=n_jobs, max_block_bytes=max_block_bytes, executor=executor)
+    plot_grid_decomposition(decomposition, name=name, figsize=(20,5))
+    return decomposition_dataframe(decomposition)
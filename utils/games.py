@@ -8,9 +8,438 @@ import autograd.scipy as sp
 from scipy import stats
 import pandas as pd
 
+import numpy
 import matplotlib.pyplot as plt
 
-class WetChicken2D:
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.buffers import ColumnBuffer, GrowableArray
+
+class GridPolicy:
+    """
+    Batched policy for the grid environments: `actions` takes an E by 2 array of (x,y) states
+    and returns an array of E action indices (into `valid_actions` of the environment).
+    Stochastic policies draw from the random state they are given (the environment's own, when
+    called by `GridEnvironment.simulate_batch` or `GridEnvironment.select_action`), so that
+    simulations remain reproducible from the seed of the environment.
+
+    Calling a policy, `policy(states)`, uses its own random state instead (see `seed`).
+    Subclasses implement `actions` (see `BatchedPolicy` to wrap a function of the states).
+
+    This is the policy protocol of both simulations: the batched one (`simulate_batch`, `run_batch`
+    and `generate_transitions`) only accepts a `GridPolicy`, while the per-step one (`select_action`,
+    `update` and `run`) also accepts the functions of the previous implementation,
+    which take the environment and return an (x,y) action.
+    """
+
+    def __init__(self, seed=None):
+        self.random = numpy.random.RandomState(seed)
+
+    def actions(self, states, random):
+        raise NotImplementedError
+
+    def __call__(self, states):
+        return self.actions(states, self.random)
+
+
+class BatchedPolicy(GridPolicy):
+    """
+    Deterministic policy given by a function that takes an E by 2 array of (x,y) states
+    and returns an array of E action indices.
+    """
+
+    def __init__(self, function):
+        super().__init__()
+        self.function = function
+
+    def actions(self, states, random):
+        return numpy.asarray(self.function(states))
+
+
+class UniformPolicy(GridPolicy):
+    """
+    Uniformly random actions.
+    """
+
+    def __init__(self, n_actions=4, seed=None):
+        super().__init__(seed=seed)
+        self.n_actions = n_actions
+
+    def actions(self, states, random):
+        return random.randint(0, self.n_actions, size=len(states))
+
+
+class GreedyPolicy(GridPolicy):
+    """
+    Greedy actions for a table of action values (e.g. the posterior mean of a Q-function),
+    looked up from the table of the best action in each state (computed once).
+    """
+
+    def __init__(self, Q, seed=None):
+        """
+        Q:
+            W by (L+1) by A array of the values of each action in each state, indexed by [x-1, y, action index]
+            (as `GridEnvironment.transition_probabilities`).
+        """
+        super().__init__(seed=seed)
+        Q = numpy.asarray(Q)
+        assert Q.ndim==3, f"Q should be a W by (L+1) by A array (got shape {Q.shape})."
+        self.Q = Q
+        self.n_actions = Q.shape[-1]
+        self.table = numpy.argmax(Q, axis=-1)  # Best action in each state.
+
+    def actions(self, states, random):
+        states = numpy.asarray(states)
+        return self.table[states[:,0]-1, states[:,1]]
+
+
+class EpsilonGreedyPolicy(GreedyPolicy):
+    """
+    Greedy actions for a table of action values (see `GreedyPolicy`),
+    except for a fraction `epsilon` of uniformly random actions.
+    """
+
+    def __init__(self, Q, epsilon=0.1, seed=None):
+        super().__init__(Q, seed=seed)
+        assert (epsilon>=0) and (epsilon<=1), f"Invalid epsilon: {epsilon}"
+        self.epsilon = epsilon
+
+    def actions(self, states, random):
+        action = super().actions(states, random)
+        explore = random.random_sample(len(action)) < self.epsilon
+        return numpy.where(explore, random.randint(0, self.n_actions, size=len(action)), action)
+
+
+class GridEnvironment:
+
+    """
+    Batched simulation for the discrete grid environments below (`WetChicken2D` and `LunarLander2D`),
+    which share the same dynamics: the state is an (x,y) cell with x in 1..W and y in 0..L,
+    the turbulence moves y by an amount drawn uniformly from [-(x-1),+(x-1)],
+    the current (or gravity) moves y by -(x-1), and the action moves x or y by one cell.
+    Subclasses define `valid_actions`, `max_steps`, `random` and `is_terminal`.
+
+    Instead of simulating one step of one episode at a time (see `update` and `run`, which remain
+    the reference implementation), `simulate_batch` advances a batch of episodes at once
+    as arrays of states, with the episodes that have ended masked out.
+
+    The history is stored in a columnar buffer (`transitions`, one small integer per value
+    and one row per step), with the index of the first row (`episode_offsets`) and the first position
+    (`episode_starts`) of each episode.
+    The nested lists of the previous implementation are still available (see `state_history`),
+    but they are built on demand.
+
+    Since the dynamics are known, `transition_probabilities` gives the exact P(s'|s,a) as a (cached) table,
+    and `sample_transitions` draws next states with these probabilities for arrays of states and actions
+    (with a lookup of the next state of each turbulence value, which is uniform).
+    """
+
+    # Columns of the transition buffer:
+    TRANSITION_COLUMNS = ['start_x', 'start_y', 'noise_x', 'noise_y', 'action_x', 'action_y', 'result_x', 'result_y']
+
+    @property
+    def history_dtype(self):
+        """ Smallest integer type for the values of the history (positions, noise and actions). """
+        return numpy.int8 if max(self.W, self.L) < 127 else numpy.int16
+
+    def new_game(self):
+        """
+        Clears the game history.
+        """
+
+        # Transitions are stored in a buffer of columns, with the index of the first row and the first position of each episode:
+        self.transitions = ColumnBuffer(self.TRANSITION_COLUMNS, dtype=self.history_dtype, capacity=1024)
+        self.episode_offsets = GrowableArray(dtype=numpy.int64, capacity=128)
+        self.episode_starts = GrowableArray(row_shape=(2,), dtype=numpy.int64, capacity=128)
+        self._state = None  # Latest position.
+        self._noise = None  # Noise of the current step (if set).
+        self._action = None  # Action of the current step (if set).
+
+        # Begin new episode:
+        self.new_episode()
+
+    def _begin_episode(self):
+        """
+        Add a new (empty) episode to the history.
+        """
+        self.episode_offsets.append(len(self.transitions))
+        self._state = None
+        self._noise = None
+        self._action = None
+
+    @property
+    def episode_count(self):
+        return len(self.episode_offsets)
+
+    @property
+    def step_count(self):
+        return len(self.transitions) - self.episode_offsets[-1]
+
+    @property
+    def total_step_count(self):
+        return len(self.transitions)
+
+    @property
+    def state(self):
+        """
+        Get latest (x,y) position (i.e. latest position in latest episode).
+        """
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        """
+        Set the first position of an episode, or the result of the current step
+        (once its noise and action are set), which adds a transition to the history.
+        """
+        x,y = state
+        assert (x>0) and (x<=self.W), f"Invalid x: {x}"
+        assert (y>=0) and (y<=self.L), f"Invalid y: {y}"
+        if self._state is not None:
+            assert (self._noise is not None) and (self._action is not None), "The noise and action of the step must be set before its result."
+            self.transitions.append((*self._state, *self._noise, *self._action, x, y))
+            self._noise = None
+            self._action = None
+        else:
+            self.episode_starts.append(state)
+        self._state = state
+
+    @property
+    def noise(self):
+        """
+        Get noise associated with latest position (None if it is not set yet).
+        """
+        return self._noise
+
+    @noise.setter
+    def noise(self, noise):
+        assert self._noise is None, "Noise of the current step is already set."
+        self._noise = noise
+
+    @property
+    def action(self):
+        """
+        Get action associated with latest position (None if it is not set yet).
+        """
+        return self._action
+
+    @action.setter
+    def action(self, action):
+        assert action in self.valid_actions
+        assert self._action is None, "Action of the current step is already set."
+        self._action = action
+
+    def _episode_rows(self, ep):
+        """ Rows (start, stop) of the transition buffer of an episode (negative indices count from the end). """
+        ep = range(self.episode_count)[ep]
+        offsets = self.episode_offsets.data
+        stop = offsets[ep+1] if ep+1 < len(offsets) else len(self.transitions)
+        return offsets[ep], stop
+
+    def episode_states(self, ep):
+        """
+        List of the (x,y) positions of an episode (the first position and the result of each step), as Python integers.
+        """
+        start, stop = self._episode_rows(ep)
+        first = [tuple(self.episode_starts[ep].tolist())] if range(self.episode_count)[ep] < len(self.episode_starts) else []
+        return first + list(zip(self.transitions['result_x'][start:stop].tolist(), self.transitions['result_y'][start:stop].tolist()))
+
+    def _history(self, x_name, y_name, pending):
+        episodes = []
+        for ep in range(self.episode_count):
+            start, stop = self._episode_rows(ep)
+            episode = list(zip(self.transitions[x_name][start:stop].tolist(), self.transitions[y_name][start:stop].tolist()))
+            episodes.append(episode)
+        if pending is not None:
+            episodes[-1].append(tuple(int(value) for value in pending))
+        return episodes
+
+    @property
+    def state_history(self):
+        """ Positions of each episode, as a list of lists of (x,y) tuples (built from the buffer). """
+        return [self.episode_states(ep) for ep in range(self.episode_count)]
+
+    @property
+    def noise_history(self):
+        """ Noise of each step of each episode, as a list of lists of tuples (built from the buffer). """
+        return self._history('noise_x', 'noise_y', self._noise)
+
+    @property
+    def action_history(self):
+        """ Action of each step of each episode, as a list of lists of tuples (built from the buffer). """
+        return self._history('action_x', 'action_y', self._action)
+
+    def extract_transition_dataset(self):
+        """
+        Dataframe of all transitions (one row per step), with integer columns copied from the buffer
+        (so the dataframe is independent of the history of the environment).
+        """
+        columns = ['start_x', 'start_y', 'action_x', 'action_y', 'result_x', 'result_y']
+        transitions = pd.DataFrame({name : self.transitions[name].astype(numpy.int64) for name in columns})
+        return transitions
+
+    @property
+    def action_array(self):
+        """ Valid actions as an A by 2 integer array (the action index is the row). """
+        return numpy.array(self.valid_actions, dtype=numpy.int64)
+
+    # Transition tables shared by all instances with the same grid and actions (see `transition_probabilities`):
+    _transition_tables = {}
+
+    @property
+    def transition_probabilities(self):
+        """
+        Exact transition probabilities P(s'|s,a) of the grid, as a W by (L+1) by A by W by (L+1) array
+        indexed by [x-1, y, action index, x'-1, y'] (read-only).
+        The table is computed once for each environment class, grid size and set of actions, and then cached.
+        It covers every cell, including the terminal ones (episodes do not continue from them).
+        """
+        return self._transition_table()[0]
+
+    def _transition_table(self):
+        """
+        The table of `transition_probabilities` and the table of the next state (flattened index in the W by (L+1) grid)
+        of each state, action and turbulence (indexed by [x-1, y, action index, noise index], where the noise index
+        0..2(x-1) stands for the turbulence -(x-1)..+(x-1), and the unused indices are -1), used by `sample_transitions`.
+        Since the turbulence is uniform, P(s'|s,a) is the fraction of the turbulence values that lead to s'.
+        """
+        key = (type(self).__name__, self.W, self.L, tuple(self.valid_actions))
+        if key in self._transition_tables:
+            return self._transition_tables[key]
+        W, L = self.W, self.L
+        actions = self.action_array
+        next_state = numpy.full((W, L+1, len(actions), 2*W-1), -1, dtype=numpy.int64)
+        P = numpy.zeros((W, L+1, len(actions), W*(L+1)))
+        y = numpy.arange(L+1)[:,None]  # Start y by action.
+        for x in range(1, W+1):
+            result_x = numpy.clip(x + actions[None,:,0], 1, W)
+            # Turbulence (uniform in [-(x-1),+(x-1)]) and current (or gravity) of -(x-1):
+            for noise_index, noise_y in enumerate(range(-(x-1), x)):
+                result_y = numpy.clip(y + noise_y + actions[None,:,1] - (x-1), 0, L)
+                next_state[x-1, :, :, noise_index] = (result_x-1)*(L+1) + result_y
+            for a in range(len(actions)):
+                for y_start in range(L+1):
+                    P[x-1, y_start, a] = numpy.bincount(next_state[x-1, y_start, a, :2*x-1], minlength=W*(L+1)) / (2*x-1)
+        P = P.reshape(W, L+1, len(actions), W, L+1)
+        P.setflags(write=False)
+        next_state.setflags(write=False)
+        self._transition_tables[key] = (P, next_state)
+        return P, next_state
+
+    def sample_transitions(self, x, y, action, random=None):
+        """
+        Draw the next states of an array of transitions (with the probabilities of `transition_probabilities`),
+        with one integer draw (the turbulence) and one table lookup for each transition.
+        x, y:
+            Arrays of the (x,y) states.
+        action:
+            Array of action indices (into `valid_actions`).
+        random:
+            Random state (the environment's own by default).
+        Returns the arrays (result_x, result_y).
+        """
+        _, next_state = self._transition_table()
+        random = self.random if random is None else random
+        x, y, action = numpy.broadcast_arrays(numpy.asarray(x), numpy.asarray(y), numpy.asarray(action))
+        # Index of the turbulence (uniform in 0..2(x-1)) and of the next state in the flattened W by (L+1) grid:
+        noise_index = random.randint(0, 2*x-1)
+        index = next_state[x-1, y, action, noise_index]
+        return index//(self.L+1) + 1, index%(self.L+1)
+
+    @staticmethod
+    def _check_batch_policy(policy):
+        if not (policy is None or isinstance(policy, GridPolicy)):
+            raise TypeError(f"Batched simulations need a GridPolicy (e.g. BatchedPolicy(function) for a function of the states), got {policy!r}.")
+
+    def simulate_batch(self, episodes, policy=None):
+        """
+        Simulate `episodes` episodes at once and return their transitions as a dictionary of columns
+        (ordered by episode and then by step): 'episode', 'step', 'start_x', 'start_y', 'noise_x', 'noise_y',
+        'action_x', 'action_y', 'result_x', 'result_y' (and 'action', the index of the action).
+        policy:
+            None for uniformly random actions, or a `GridPolicy` (which draws from the random state of the environment).
+            Functions of the environment (see `select_action`) cannot be evaluated on a batch of states,
+            and a function of the states has to be wrapped in a `BatchedPolicy`.
+        """
+        self._check_batch_policy(policy)
+        E = int(episodes)
+        actions = self.action_array
+        # Start far from the end, at a random lateral position:
+        x = self.random.randint(1, self.W+1, size=E)
+        y = numpy.full(E, self.L, dtype=numpy.int64)
+        active = numpy.arange(E)  # Episodes that have not ended.
+        steps = []
+        for t in range(self.max_steps):
+            if len(active)==0:
+                break
+            x_t, y_t = x[active], y[active]
+            # Turbulence (uniform in [-(x-1),+(x-1)]):
+            noise_y = self.random.randint(-(x_t-1), x_t)
+            # Action:
+            if policy is None:
+                action = self.random.randint(0, len(actions), size=len(active))
+            else:
+                action = policy.actions(numpy.stack([x_t, y_t], axis=-1), self.random)
+            action_x, action_y = actions[action,0], actions[action,1]
+            # Transition (with the current or gravity of -(x-1)):
+            result_x = numpy.clip(x_t + action_x, 1, self.W)
+            result_y = numpy.clip(y_t + noise_y + action_y - (x_t-1), 0, self.L)
+            steps.append((active, numpy.full(len(active), t), x_t, y_t, noise_y, action, action_x, action_y, result_x, result_y))
+            x[active], y[active] = result_x, result_y
+            active = active[~self.is_terminal(result_x, result_y)]
+        names = ['episode', 'step', 'start_x', 'start_y', 'noise_y', 'action', 'action_x', 'action_y', 'result_x', 'result_y']
+        if len(steps)==0:
+            columns = {name : numpy.zeros(0, dtype=numpy.int64) for name in names}
+        else:
+            columns = {name : numpy.concatenate(values) for name, values in zip(names, zip(*steps))}
+        # Order by episode (the steps of each episode are already in order):
+        order = numpy.argsort(columns['episode'], kind='stable')
+        columns = {name : values[order] for name, values in columns.items()}
+        columns['noise_x'] = numpy.zeros_like(columns['noise_y'])
+        return columns
+
+    def select_action(self, policy=None):
+        """
+        Get action according to random or custom policy.
+        If `policy` is specified, it should be a `GridPolicy` (evaluated on the latest position),
+        or a function that takes this environment as a parameter and returns a valid action
+        (only in the per-step simulation, see `GridPolicy`).
+        """
+
+        if policy is None:
+            i = self.random.choice(range(len(self.valid_actions)))
+            action = self.valid_actions[i]
+            return action
+        elif isinstance(policy, GridPolicy):
+            i = policy.actions(numpy.array([self.state]), self.random)[0]
+            return self.valid_actions[i]
+        else:
+            action = policy(self)
+            assert action in self.valid_actions, f"Action {action} is not a valid action: {self.valid_actions}"
+            return action
+
+    def run_batch(self, episodes=1_000, policy=None, batch_size=100_000):
+        """
+        Batched version of `run`: simulate `episodes` episodes (in batches of `batch_size` episodes,
+        see `simulate_batch`) and add them to the history. `policy` is None or a `GridPolicy`.
+        """
+        self._check_batch_policy(policy)
+        # Drop the current episode if it has not started (it is replaced by a new one at the end, as in `run`):
+        if self.step_count==0 and self._noise is None and self._action is None:
+            self.episode_offsets.pop()
+            self.episode_starts.pop()
+        for start in range(0, episodes, batch_size):
+            columns = self.simulate_batch(min(batch_size, episodes-start), policy=policy)
+            # Index of the first row of each episode (the rows are ordered by episode):
+            episode = columns['episode']
+            first = numpy.flatnonzero(numpy.r_[True, episode[1:]!=episode[:-1]]) if len(episode) else numpy.zeros(0, dtype=numpy.int64)
+            self.episode_offsets.extend(len(self.transitions) + first)
+            self.episode_starts.extend(numpy.stack([columns['start_x'][first], columns['start_y'][first]], axis=-1))
+            self.transitions.extend(columns)
+        self.new_episode()
+
+
+class WetChicken2D(GridEnvironment):
 
     """
     Benchmark reinforcement learning problem where 
@@ -49,10 +478,10 @@ class WetChicken2D:
         #   Canoeist can drift, or move side to side, or paddle against current.
         self.valid_actions = [(0,0),(-1,0),(+1,0),(0,+1)]
 
-        # Create placeholders for state values:
-        self.state_history = None
-        self.noise_history = None
-        self.action_history = None
+        # Create placeholders for the history (see `new_game`):
+        self.transitions = None
+        self.episode_offsets = None
+        self.episode_starts = None
 
         # Initialize game history:
         self.new_game()
@@ -69,96 +498,18 @@ class WetChicken2D:
         )
         return s
 
-    def new_game(self):
-        """
-        Clears the game history.
-        """
-
-        # States are stored in a list of episodes; each episode is a list of steps.
-        self.state_history = []  # List of lists.
-        self.noise_history = []  # List of lists.
-        self.action_history = []  # List of lists.
-
-        # Begin new episode:
-        self.new_episode()
-
     def new_episode(self):
         """
         Starts a new episode with a new initial state.
         """
 
         # Add new episode to history:
-        self.state_history.append([])
-        self.noise_history.append([])
-        self.action_history.append([])
-        
+        self._begin_episode()
+
         # Start far upstream of the waterfall, at a random lateral position:
         x = self.random.choice(range(1,1+self.W))
         self.state = (x,self.L)
 
-    @property
-    def episode_count(self):
-        return len(self.action_history)
-
-    @property
-    def step_count(self):
-        return len(self.action_history[-1])
-
-    @property
-    def total_step_count(self):
-        return sum([len(episode) for episode in self.action_history])
-
-    @property
-    def state(self):
-        """
-        Get latest (x,y) position (i.e. latest position in latest episode).
-        """
-        return self.state_history[-1][-1]
-    
-    @state.setter
-    def state(self, state):
-        x,y = state
-        assert (x>0) and (x<=self.W), f"Invalid x: {x}"
-        assert (y>=0) and (y<=self.L), f"Invalid y: {y}"
-        self.state_history[-1].append(state)
-
-    @property
-    def noise(self):
-        """
-        Get noise associated with latest position.
-        """
-        len_noise = len(self.noise_history[-1])
-        len_state = len(self.state_history[-1])
-        if len_noise == len_state:
-            return self.noise_history[-1][-1]
-        elif len_noise == len_state-1:
-            return None  # Latest noise not set yet.
-        else:
-            raise RuntimeError(f"Noise history ({len_noise}) should only be 0 or 1 entry shorter than position history ({len_state}).")
-    
-    @noise.setter
-    def noise(self, noise):
-        self.noise_history[-1].append(noise)
-
-    @property
-    def action(self):
-        """
-        Get noise associated with latest position.
-        """
-        len_action = len(self.action_history[-1])
-        len_state = len(self.state_history[-1])
-        if len_action == len_state:
-            return self.action_history[-1][-1]
-        elif len_action == len_state-1:
-            return None  # Latest action not set yet.
-        else:
-            raise RuntimeError(f"Action history ({len_action}) should only be 0 or 1 entry shorter than position history ({len_state}).")
-    
-    @action.setter
-    def action(self, action):
-        assert action in self.valid_actions
-        self.action_history[-1].append(action)        
-
     def simulate_noise(self):
         """
         Simulates turbulence (which depends on x position).
@@ -195,22 +546,13 @@ class WetChicken2D:
         new_y = max(0,min(new_y,self.L))  # Episode ends if y==0.
         return (new_x, new_y)
 
-    def select_action(self, policy=None):
+    @staticmethod
+    def is_terminal(x, y):
         """
-        Get action according to random or custom policy.
-        If `policy` is specified, it should be a function
-        that takes this environment as a parameter
-        and returns a valid action.
+        Whether the episode ends in state (x,y) (for scalars or arrays):
+        the canoeist has gone over the waterfall.
         """
-
-        if policy is None:
-            i = self.random.choice(range(len(self.valid_actions)))
-            action = self.valid_actions[i]
-            return action
-        else:
-            action = policy(self)
-            assert action in self.valid_actions, f"Action {action} is not a valid action: {self.valid_actions}"
-            return action
+        return y == 0
 
     def update(self, policy=None):
         """
@@ -223,7 +565,7 @@ class WetChicken2D:
         self.action = self.select_action(policy=policy)
         self.state = self.simulate_transition()
 
-        if ( self.state[1] == 0 ) or ( self.step_count >= self.max_steps ):
+        if self.is_terminal(*self.state) or ( self.step_count >= self.max_steps ):
             return False
         else:
             return True
@@ -237,36 +579,6 @@ class WetChicken2D:
                 print(f"Episode {ep+1}/{episodes} took {self.step_count} steps.")
             self.new_episode()
 
-    def extract_transition_dataset(self):
-
-        transitions = []
-
-        for ep in range(self.episode_count):
-
-            ep_state_history = self.state_history[ep]
-            ep_noise_history = self.noise_history[ep]
-            ep_action_history = self.action_history[ep]
-
-            for t in range(len(ep_action_history)):
-
-                s = ep_state_history[t]
-                a = ep_action_history[t]
-                s_ = ep_state_history[t+1]
-
-                observation = {
-                    'start_x' : s[0],
-                    'start_y' : s[1],
-                    'action_x' : a[0],
-                    'action_y' : a[1],
-                    'result_x' : s_[0],
-                    'result_y' : s_[1],
-                }
-                transitions.append(observation)
-
-        transitions = pd.DataFrame(transitions)
-
-        return transitions
-    
     def plot_environment(self, ax=None):
         
         if ax:
@@ -291,7 +603,7 @@ class WetChicken2D:
         
         fig, ax = self.plot_environment(ax=ax)
         
-        states = self.state_history[ep]
+        states = self.episode_states(ep)
         
         if fade:
             n_steps = len(states)
@@ -307,7 +619,7 @@ class WetChicken2D:
         return fig,ax
 
 
-class LunarLander2D:
+class LunarLander2D(GridEnvironment):
     """
     Benchmark reinforcement learning problem where
     a spacecraft is landing on the moon
@@ -347,10 +659,10 @@ class LunarLander2D:
         #   Spacecraft can drift, or move side to side, or go up against the gravity.
         self.valid_actions = [(0, 0), (-1, 0), (+1, 0), (0, +1)]
 
-        # Create placeholders for state values:
-        self.state_history = None
-        self.noise_history = None
-        self.action_history = None
+        # Create placeholders for the history (see `new_game`):
+        self.transitions = None
+        self.episode_offsets = None
+        self.episode_starts = None
 
         # Initialize game history:
         self.new_game()
@@ -367,98 +679,18 @@ class LunarLander2D:
         )
         return s
 
-    def new_game(self):
-        """
-        Clears the game history.
-        """
-
-        # States are stored in a list of episodes; each episode is a list of steps.
-        self.state_history = []  # List of lists.
-        self.noise_history = []  # List of lists.
-        self.action_history = []  # List of lists.
-
-        # Begin new episode:
-        self.new_episode()
-
     def new_episode(self):
         """
         Starts a new episode with a new initial state.
         """
 
         # Add new episode to history:
-        self.state_history.append([])
-        self.noise_history.append([])
-        self.action_history.append([])
+        self._begin_episode()
 
         # Start far at the top of the environment, at a random lateral position:
         x = self.random.choice(range(1, 1 + self.W))
         self.state = (x, self.L)
 
-    @property
-    def episode_count(self):
-        return len(self.action_history)
-
-    @property
-    def step_count(self):
-        return len(self.action_history[-1])
-
-    @property
-    def total_step_count(self):
-        return sum([len(episode) for episode in self.action_history])
-
-    @property
-    def state(self):
-        """
-        Get latest (x,y) position (i.e. latest position in latest episode).
-        """
-        return self.state_history[-1][-1]
-
-    @state.setter
-    def state(self, state):
-        x, y = state
-        assert (x > 0) and (x <= self.W), f"Invalid x: {x}"
-        assert (y >= 0) and (y <= self.L), f"Invalid y: {y}"
-        self.state_history[-1].append(state)
-
-    @property
-    def noise(self):
-        """
-        Get noise associated with latest position.
-        """
-        len_noise = len(self.noise_history[-1])
-        len_state = len(self.state_history[-1])
-        if len_noise == len_state:
-            return self.noise_history[-1][-1]
-        elif len_noise == len_state - 1:
-            return None  # Latest noise not set yet.
-        else:
-            raise RuntimeError(
-                f"Noise history ({len_noise}) should only be 0 or 1 entry shorter than position history ({len_state}).")
-
-    @noise.setter
-    def noise(self, noise):
-        self.noise_history[-1].append(noise)
-
-    @property
-    def action(self):
-        """
-        Get noise associated with latest position.
-        """
-        len_action = len(self.action_history[-1])
-        len_state = len(self.state_history[-1])
-        if len_action == len_state:
-            return self.action_history[-1][-1]
-        elif len_action == len_state - 1:
-            return None  # Latest action not set yet.
-        else:
-            raise RuntimeError(
-                f"Action history ({len_action}) should only be 0 or 1 entry shorter than position history ({len_state}).")
-
-    @action.setter
-    def action(self, action):
-        assert action in self.valid_actions
-        self.action_history[-1].append(action)
-
     def simulate_noise(self):
         """
         Simulates turbulence (which depends on x position).
@@ -495,22 +727,16 @@ class LunarLander2D:
         new_y = max(0, min(new_y, self.L))  # Episode ends if y==0.
         return (new_x, new_y)
 
-    def select_action(self, policy=None):
+    @staticmethod
+    def is_terminal(x, y):
         """
-        Get action according to random or custom policy.
-        If `policy` is specified, it should be a function
-        that takes this environment as a parameter
-        and returns a valid action.
+        Whether the episode ends in state (x,y) (for scalars or arrays):
+        the spacecraft has crashed (y == 0) or reached the column x == 2.
+        Note: Earlier versions of `update` wrote this condition as `(y == 0 | x == 2)`,
+              which Python evaluates as the chained comparison `y == (0|x) == 2` (i.e. y == x == 2),
+              so datasets generated with them continue after a crash.
         """
-
-        if policy is None:
-            i = self.random.choice(range(len(self.valid_actions)))
-            action = self.valid_actions[i]
-            return action
-        else:
-            action = policy(self)
-            assert action in self.valid_actions, f"Action {action} is not a valid action: {self.valid_actions}"
-            return action
+        return (y == 0) | (x == 2)
 
     def update(self, policy=None):
         """
@@ -523,7 +749,7 @@ class LunarLander2D:
         self.action = self.select_action(policy=policy)
         self.state = self.simulate_transition()
 
-        if (self.state[1] == 0 | self.state[0] == 2) or (self.step_count >= self.max_steps):
+        if self.is_terminal(*self.state) or (self.step_count >= self.max_steps):
             return False
         else:
             return True
@@ -537,35 +763,6 @@ class LunarLander2D:
                 print(f"Episode {ep + 1}/{episodes} took {self.step_count} steps.")
             self.new_episode()
 
-    def extract_transition_dataset(self):
-
-        transitions = []
-
-        for ep in range(self.episode_count):
-
-            ep_state_history = self.state_history[ep]
-            ep_noise_history = self.noise_history[ep]
-            ep_action_history = self.action_history[ep]
-
-            for t in range(len(ep_action_history)):
-                s = ep_state_history[t]
-                a = ep_action_history[t]
-                s_ = ep_state_history[t + 1]
-
-                observation = {
-                    'start_x': s[0],
-                    'start_y': s[1],
-                    'action_x': a[0],
-                    'action_y': a[1],
-                    'result_x': s_[0],
-                    'result_y': s_[1],
-                }
-                transitions.append(observation)
-
-        transitions = pd.DataFrame(transitions)
-
-        return transitions
-
     def plot_environment(self, ax=None):
 
         if ax:
@@ -590,7 +787,7 @@ class LunarLander2D:
 
         fig, ax = self.plot_environment(ax=ax)
 
-        states = self.state_history[ep]
+        states = self.episode_states(ep)
 
         if fade:
             n_steps = len(states)
@@ -603,4 +800,63 @@ class LunarLander2D:
             xs, ys = [x for x, y in states], [y for x, y in states]
             ax.plot(ys, xs, color='red', alpha=0.8, lw=3, marker='o')
 
-        return fig, ax
\ No newline at end of file
+        return fig, ax
+
+
+def _simulate_shard(env_cls, env_kwargs, seed_sequence, episodes, policy):
+    """
+    Worker task for `generate_transitions`: simulate a shard of episodes
+    with an environment seeded from the shard's own seed sequence.
+    """
+    env = env_cls(seed=seed_sequence.generate_state(4), **env_kwargs)
+    return env.simulate_batch(episodes, policy=policy)
+
+def generate_transitions(env_cls, episodes, n_workers=1, seed=None, shard_episodes=10_000, policy=None, executor=None, **env_kwargs):
+    """
+    Simulate `episodes` episodes of an environment class (e.g. `WetChicken2D`) in shards, possibly in parallel,
+    and return their transitions as a dictionary of columns (as `GridEnvironment.simulate_batch`,
+    with the episodes numbered from 0 to `episodes`-1 across the shards).
+
+    The episodes are split into shards of `shard_episodes` episodes, and each shard is simulated
+    by its own environment, seeded with an independent child of `numpy.random.SeedSequence(seed)`.
+    The shards do not depend on the number of workers, so the result is the same for a given seed
+    whether it is generated sequentially or in parallel.
+
+    n_workers:
+        Number of worker processes (1 to simulate the shards in this process).
+    policy:
+        None for uniformly random actions, or a `GridPolicy` (see `simulate_batch`), which draws from
+        the random state of each shard's environment. It must be picklable to be sent to the workers
+        (e.g. a `BatchedPolicy` of a module-level function).
+    executor:
+        An existing process pool (e.g. `concurrent.futures.ProcessPoolExecutor`) to run the shards on,
+        instead of creating one with `n_workers` workers.
+    env_kwargs:
+        Arguments of the environment (e.g. `L`, `W`, `max_steps`).
+    """
+    bounds = list(range(0, max(episodes, 1), shard_episodes)) + [episodes]  # (At least one shard.)
+    seed_sequences = numpy.random.SeedSequence(seed).spawn(len(bounds)-1)
+    tasks = [
+        (env_cls, env_kwargs, seed_sequence, stop-start, policy)
+        for seed_sequence, start, stop in zip(seed_sequences, bounds[:-1], bounds[1:])
+    ]
+
+    if executor is None and n_workers==1:
+        # Sequential:
+        shards = [_simulate_shard(*task) for task in tasks]
+    else:
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers=n_workers)
+        try:
+            futures = [executor.submit(_simulate_shard, *task) for task in tasks]
+            shards = [future.result() for future in futures]
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+    # Merge the shards (in order), with the episodes numbered across the shards:
+    for shard, start in zip(shards, bounds[:-1]):
+        shard['episode'] += start
+    columns = {name : numpy.concatenate([shard[name] for shard in shards]) for name in shards[0]}
+    return columns
@@ -44,10 +44,12 @@ In summary:
 import inspect
 import re
 
+import numpy
 from autograd import numpy as np
-from autograd import grad
+from autograd import grad, value_and_grad
 from autograd.misc.optimizers import adam
 
+from utils.buffers import GrowableArray
 from utils.functions import log_gaussian, gaussian
 
 
@@ -109,25 +111,46 @@ class BayesianModel:
             return self.sum_over_samples( log_gaussian(x=W, mu=mu, sigma=sigma) )
         raise NotImplementedError(f"Expects W to have 2 dimensions, not {W.shape}.")
     
-    def log_prior_latents(self, Z):
+    def batch_scale(self, batch=None):
+        """
+        Factor N/B that scales a sum over a minibatch of B rows (indexed by `batch`)
+        to an unbiased estimate of the sum over all N rows (1 if `batch` is None).
+        """
+        if batch is None:
+            return 1.0
+        return self.N / len(batch)
+
+    def log_prior_latents(self, Z, batch=None):
+        """
+        If `batch` is provided, Z only contains the latent variables for those rows
+        (B by L or S by B by L) and the result is scaled by N/B.
+        """
         mu = self.prior_latents_mean
         sigma = self.prior_latents_stdev
+        scale = self.batch_scale(batch)
         if len(Z.shape)==2:
-            return np.sum( log_gaussian(x=Z, mu=mu, sigma=sigma) ).reshape(1,-1)
+            return scale * np.sum( log_gaussian(x=Z, mu=mu, sigma=sigma) ).reshape(1,-1)
         elif len(Z.shape)==3:
-            return self.sum_over_samples( log_gaussian(x=Z, mu=mu, sigma=sigma) )
+            return scale * self.sum_over_samples( log_gaussian(x=Z, mu=mu, sigma=sigma) )
         raise NotImplementedError(f"Expects Z to have 2 or 3 dimensions, not {Z.shape}.")
         
-    def log_prior(self, W, Z):
-        return self.log_prior_weights(W) + self.log_prior_latents(Z)
+    def log_prior(self, W, Z, batch=None):
+        return self.log_prior_weights(W) + self.log_prior_latents(Z, batch=batch)
     
-    def log_likelihood(self, W, Z):
-        mu = self.nn.forward(X=self.X, weights=W, input_noise=Z)
+    def log_likelihood(self, W, Z, batch=None):
+        """
+        If `batch` is provided, only the rows of X and Y in the batch are evaluated
+        (Z only contains the latent variables for those rows) and the result is scaled by N/B.
+        """
+        X = self.X if batch is None else self.X[batch]
+        Y = self.Y if batch is None else self.Y[batch]
+        scale = self.batch_scale(batch)
+        mu = self.nn.forward(X=X, weights=W, input_noise=Z)
         sigma = self.likelihood_stdev
         if len(Z.shape)==2:
-            return np.sum( log_gaussian(x=self.Y, mu=mu, sigma=sigma) )
+            return scale * np.sum( log_gaussian(x=Y, mu=mu, sigma=sigma) )
         elif len(Z.shape)==3:
-            return self.sum_over_samples(log_gaussian(x=self.Y, mu=mu, sigma=sigma) )
+            return scale * self.sum_over_samples(log_gaussian(x=Y, mu=mu, sigma=sigma) )
         raise NotImplementedError(f"Expects Z to have 2 or 3 dimensions, not {Z.shape}.")
 
     def likelihood(self, W, Z): #might be incorrect
@@ -144,8 +167,8 @@ class BayesianModel:
         sigma = self.likelihood_stdev
         return mu #, sigma
 
-    def log_posterior(self, W, Z):
-        return self.log_prior_weights(W) + self.log_prior_latents(Z) + self.log_likelihood(W, Z)
+    def log_posterior(self, W, Z, batch=None):
+        return self.log_prior_weights(W) + self.log_prior_latents(Z, batch=batch) + self.log_likelihood(W, Z, batch=batch)
 
     def info(self):
         info = {
@@ -224,39 +247,87 @@ class BayesianModel:
     def _repr_html_(self):
         self.display()
         
-
-    def predict(self, X, W):
-        return self.nn.forward(X=X, weights=W, input_noise='auto', output_noise='auto')
-        
-    def log_prior_weights(self, W):
-        mu = self.prior_weights_mean
-        sigma = self.prior_weights_stdev
-        if len(W.shape)==2:
-            return self.sum_over_samples( log_gaussian(x=W, mu=mu, sigma=sigma) )
-        raise NotImplementedError(f"Expects W to have 2 dimensions, not {W.shape}.")
     
-    def log_prior_latents(self, Z):
-        mu = self.prior_latents_mean
-        sigma = self.prior_latents_stdev
-        if len(Z.shape)==2:
-            return np.sum( log_gaussian(x=Z, mu=mu, sigma=sigma) ).reshape(1,-1)
-        elif len(Z.shape)==3:
-            return self.sum_over_samples( log_gaussian(x=Z, mu=mu, sigma=sigma) )
-        raise NotImplementedError(f"Expects Z to have 2 or 3 dimensions, not {Z.shape}.")
-        
-    def log_prior(self, W, Z):
-        return self.log_prior_weights(W) + self.log_prior_latents(Z)
-    
-    def log_likelihood(self, W, Z):
-        mu = self.nn.forward(X=self.X, weights=W, input_noise=Z)
-        sigma = self.likelihood_stdev
+class ParameterLayout:
+
+    """
+    Layout of the packed parameter vectors of a SamplerModel:
+    each row of an S by (1*D+N*L) `samples` matrix holds the D weights
+    followed by the N*L latent variables (row-major, i.e. the L latent features of each data point are adjacent).
+    The shapes are checked once, when the layout is created, and the weights and latent variables
+    are read as views of the packed buffer (and written in place when packing).
+    """
+
+    def __init__(self, D, N, L):
+        self.D = D
+        self.N = N
+        self.L = L
+        self.columns = (1*D)+(N*L)  # Length of a packed parameter vector.
+
+    def empty(self, S):
+        """ Allocate an uninitialized S by (1*D+N*L) buffer of packed samples. """
+        return numpy.empty((S, self.columns))
+
+    def pack(self, W, Z, out=None):
+        """
+        Pack S by D weights and S by N by L latent variables into one S by (1*D+N*L) buffer.
+        Either input can have a single sample (W is 1 by D or Z is N by L or 1 by N by L),
+        which is broadcast into the buffer (it is not tiled first).
+        If both inputs are already the two halves of one packed buffer (e.g. returned by `unpack`),
+        that buffer is returned without copying. Otherwise, the values are written
+        into `out` (if provided) or into a new buffer, without intermediate copies.
+        """
         if len(Z.shape)==2:
-            return np.sum( log_gaussian(x=self.Y, mu=mu, sigma=sigma) )
-        elif len(Z.shape)==3:
-            return self.sum_over_samples( log_gaussian(x=self.Y, mu=mu, sigma=sigma) )
-        raise NotImplementedError(f"Expects Z to have 2 or 3 dimensions, not {Z.shape}.")
-        
-    
+            Z = Z.reshape(1,*Z.shape)  # Add S=1 as first dimension.
+        S = max(W.shape[0],Z.shape[0])
+        if (W.shape[0] not in {1,S}) or (Z.shape[0] not in {1,S}):
+            raise ValueError(f"If either input has more than one sample, they must both has the same number; received {W.shape[0]} and {Z.shape[0]}.")
+        # Inside an autograd trace, the buffer cannot be written in place:
+        if not (type(W) is numpy.ndarray and type(Z) is numpy.ndarray):
+            W_flat = np.broadcast_to(W.reshape(-1,self.D), (S,self.D))
+            Z_flat = np.broadcast_to(Z.reshape(Z.shape[0],self.N*self.L), (S,self.N*self.L))
+            return np.concatenate([W_flat,Z_flat],axis=-1)
+        # Return the buffer that both inputs are views of (if any):
+        if out is None and W.shape[0]==Z.shape[0] and self.is_packed(W, Z):
+            return W.base
+        samples = self.empty(S) if out is None else out
+        assert samples.shape==(S,self.columns), f"Expects a buffer of shape {(S,self.columns)}, not {samples.shape}."
+        samples[:,:self.D] = W.reshape(-1,self.D)
+        samples[:,self.D:] = Z.reshape(Z.shape[0],self.N*self.L)
+        return samples
+
+    def is_packed(self, W, Z):
+        """
+        Check whether W and Z are the weight and latent halves of one packed buffer (as returned by `unpack`).
+        """
+        base = W.base
+        if base is None or Z.base is not base or base.shape!=(W.shape[0],self.columns) or not base.flags['C_CONTIGUOUS']:
+            return False
+        address = lambda array: array.__array_interface__['data'][0]
+        same_rows = (W.shape[0]==1) or (W.strides[0]==base.strides[0] and Z.strides[0]==base.strides[0])
+        return (
+            same_rows and W.strides[-1]==base.itemsize and Z.strides[-1]==base.itemsize
+            and address(W)==address(base) and address(Z)==address(base)+base.itemsize*self.D
+        )
+
+    def unpack(self, samples):
+        """
+        Split an S by (1*D+N*L) buffer of packed samples into the weights (S by D)
+        and the latent variables (N by L if S=1, otherwise S by N by L).
+        Both are views of the buffer (for numpy arrays); inside an autograd trace,
+        the split is a single operation whose gradient is assembled in one buffer.
+        """
+        assert len(samples.shape)==2, f"Expects samples to be 2 dimenional."
+        assert samples.shape[1]==self.columns, f"Expects samples to have a value for each weight and a value for each data point for each latent feature."
+        S = samples.shape[0]
+        W, Z = np.split(samples, [self.D], axis=1)
+        if S==1:
+            Z = Z.reshape(self.N,self.L)  # 2 dimensions.
+        else:
+            Z = Z.reshape(S,self.N,self.L)  # 3 dimensions.
+        return W, Z
+
+
 class SamplerModel:
 
     """
@@ -268,10 +339,12 @@ class SamplerModel:
     def __init__(
         self,
         model,  # BayesianModel object.
+        max_chunk_bytes = 2**28,  # Memory budget for the activations of a batched evaluation (see `vectorize`).
     ):
         
         # Store wrapped model:
         self.model = model
+        self.max_chunk_bytes = max_chunk_bytes
 
         # Get properties of wrapped model:
         self.label = model.label
@@ -285,6 +358,8 @@ class SamplerModel:
         self.M = model.M
         self.K = model.K
         self.D = model.D
+        self.layout = ParameterLayout(D=self.D, N=self.N, L=self.L)  # Packing of the weights and latent variables.
+        self._batch_layouts = {}  # Layouts of minibatches (by batch size).
         
         # Store functions of wrapped model:
         self._log_prior = model.log_prior
@@ -293,54 +368,96 @@ class SamplerModel:
         self._parameters = model.parameters #remove if not working
         self._likelihood = model.likelihood #remove if not working
     
-    def stack(self, W, Z):
+    def stack(self, W, Z, out=None):
+        """
+        Pack weights (S by D) and latent variables (N by L or S by N by L) into an S by (1*D+N*L) matrix
+        (see `ParameterLayout.pack`; an input with a single sample is broadcast to the other's sample count).
+        """
+        assert (len(W.shape)==2), f"Expects an S by D matrix, not {W.shape}"
+        assert W.shape[-1]==self.D, f"Expects an S by D ({self.D}) matrix, not {W.shape}"
         if len(Z.shape)==2:
-            assert (len(W.shape)==2), f"Expects an S by D matrix, not {W.shape}"
             assert Z.shape[0]==self.N, f"In 2D case, expects N ({self.N}) by L ({self.L}) matrix, not {Z.shape}"
             assert Z.shape[1]==self.L, f"In 2D case, expects N ({self.N}) by L ({self.L}) matrix, not {Z.shape}"
-            Z = Z.reshape(1,*Z.shape)  # Add S=1 as first dimension.
         elif len(Z.shape)==3:
-            assert (len(W.shape)==2), f"Expects an S by D matrix, not {W.shape}"
             assert Z.shape[-2]==self.N, f"In 3D case, expects S by N ({self.N}) by L ({self.L}) tensor, not {Z.shape}"
             assert Z.shape[-1]==self.L, f"In 3D case, expects S by N ({self.N}) by L ({self.L}) tensor, not {Z.shape}"
         else:
             raise NotImplementedError(f"Z should be two (N by L) or three (S by N by L) dimensions, not {Z.shape}")
-        # Make sure both inputs have the same number of samples (or 1):
-        S = max(W.shape[0],Z.shape[0])
-        if (W.shape[0] not in {1,S}) or (Z.shape[0] not in {1,S}):
-            ValueError(f"If either input has more than one sample, they must both has the same number; received {W.shape[0]} and {Z.shape[0]}.")
-        # Broadcast both inputs to have size S:
-        if W.shape[0]<S:
-            assert W.shape[0]==1, f"W and Z must have same number of samples or 1 sample, but cannot broadcast two different size: {W.shape[0]} and {Z.shape[0]}"
-            W = np.tile(W, reps=(S,1))  # Repeat S times along first axis and preserve other axis (D).
-        if Z.shape[0]<S:
-            assert Z.shape[0]==1, f"W and Z must have same number of samples or 1 sample, but cannot broadcast two different size: {W.shape[0]} and {Z.shape[0]}"
-            Z = np.tile(Z, reps=(S,1,1))  # Repeat S times along first axis and preserve other axes (N and L).
-        # Reshape and concatenate:
-        W_flat = W.reshape(S,self.D)
-        Z_flat = Z.reshape(S,self.N*self.L)
-        samples = np.concatenate([W_flat,Z_flat],axis=-1)  # Create 1 by (1*D+N*L) matrix.
-        return samples
+        return self.layout.pack(W, Z, out=out)
     
-    def unstack(self, samples):
-        assert len(samples.shape)==2, f"Expects samples to be 2 dimenional."
-        assert samples.shape[1]==(1*self.D)+(self.N*self.L), f"Expects samples to have a value for each weight and a value for each data point for each latent feature."
-        S = samples.shape[0]
-        if S==1:
-            W = samples[:,:self.D].reshape(1,self.D)
-            Z = samples[:,self.D:].reshape(self.N,self.L)  # 2 dimensions.
-        else:
-            W = samples[:,:self.D].reshape(S,self.D)
-            Z = samples[:,self.D:].reshape(S,self.N,self.L)  # 3 dimensions.
-        return W, Z
+    def batch_layout(self, batch=None):
+        """
+        Layout of the samples of a minibatch (1*D+B*L columns; see `batch_columns`),
+        created once per batch size.
+        """
+        if batch is None:
+            return self.layout
+        B = len(batch)
+        if B not in self._batch_layouts:
+            self._batch_layouts[B] = ParameterLayout(D=self.D, N=B, L=self.L)
+        return self._batch_layouts[B]
+
+    def unstack(self, samples, batch=None):
+        """
+        Split samples into weights and latent variables (as views; see `ParameterLayout.unpack`).
+        If `batch` is provided, expects samples with a value for each weight
+        and a value for each latent feature of the rows in the batch only (1*D+B*L columns; see `batch_columns`).
+        """
+        return self.batch_layout(batch).unpack(samples)
+
+    def sample_batch(self, batch_size, np_random=None):
+        """
+        Draw the indices of a minibatch of `batch_size` rows (uniformly, with replacement).
+        """
+        np_random = np.random if np_random is None else np_random
+        return np_random.randint(0, self.N, size=batch_size)
+
+    def batch_columns(self, batch):
+        """
+        Column indices (in the stacked 1*D+N*L samples) of the weights
+        and of the latent variables for the rows in `batch`.
+        """
+        batch = np.asarray(batch)
+        latent_columns = self.D + (batch.reshape(-1,1)*self.L + np.arange(self.L)).reshape(-1)
+        return np.concatenate([np.arange(self.D), latent_columns])
+
+    def chunk_size(self, N=None):
+        """
+        Number of samples that can be evaluated in a single batched call
+        without the activations of the network (S by N by (M+L+hidden+K) values,
+        which are all kept when autograd is tracing the evaluation) exceeding `max_chunk_bytes`.
+        """
+        N = self.N if N is None else N
+        widths = self.M + self.L + sum(self.nn.layers['all_layers_shape'])
+        sample_bytes = 8 * N * widths
+        return max(1, int(self.max_chunk_bytes // sample_bytes))
 
-    def vectorize(self, func, W, Z):
+    def vectorize(self, func, W, Z, chunk_size=None, **kwargs):
+        """
+        Evaluate `func(W, Z, **kwargs)` (e.g. `BayesianModel.log_posterior`) on a stack of S samples
+        (W is S by D and Z is S by N by L) and return a length-S vector.
+        The whole stack is passed to `func` in a single call (the model broadcasts over the samples),
+        unless it does not fit in the memory budget, in which case the samples are evaluated
+        in consecutive chunks of `chunk_size` samples (by default, see `chunk_size`).
+        """
         assert len(Z.shape)==3, "Vectorization is only defined for 3 dimension case."
-        results = np.array([
-            func(w.reshape(1,-1), z)
-            for w, z in zip(W,Z)
-        ]).flatten()
-        assert len(results)==Z.shape[0], f"Vectorization over S samples had unexpected results: {results} ."
+        S = Z.shape[0]
+        assert W.shape[0]==S, f"Expects W {W.shape} and Z {Z.shape} to have the same number of samples."
+        chunk_size = self.chunk_size(N=Z.shape[1]) if chunk_size is None else chunk_size
+        def evaluate(W_chunk, Z_chunk):
+            # Note: A single sample is passed in the 2 dimensional (N by L) form,
+            #       because the forward pass drops the stack dimension when S=1.
+            if Z_chunk.shape[0]==1:
+                Z_chunk = Z_chunk[0]
+            return func(W_chunk, Z_chunk, **kwargs).reshape(-1)
+        if S <= chunk_size:
+            results = evaluate(W, Z)
+        else:
+            results = np.concatenate([
+                evaluate(W[start:start+chunk_size], Z[start:start+chunk_size])
+                for start in range(0, S, chunk_size)
+            ])
+        assert results.shape[0]==S, f"Vectorization over S samples had unexpected results: {results} ."
         return results
 
     def predict(self, X, samples):
@@ -349,17 +466,17 @@ class SamplerModel:
         #     return self.vectorize(self.model.predict, W=W, Z=Z)
         return self.model.predict(X=X, W=W)
         
-    def log_prior(self, samples):
-        W, Z = self.unstack(samples)
-        # if len(Z.shape)==3:
-        #     return self.vectorize(self.model.log_prior, W=W, Z=Z)
-        return self.model.log_prior(W=W, Z=Z)
+    def log_prior(self, samples, batch=None):
+        W, Z = self.unstack(samples, batch=batch)
+        if len(Z.shape)==3:
+            return self.vectorize(self.model.log_prior, W=W, Z=Z, batch=batch)
+        return self.model.log_prior(W=W, Z=Z, batch=batch)
     
-    def log_likelihood(self, samples):
-        W, Z = self.unstack(samples)
-        # if len(Z.shape)==3:
-        #     return self.vectorize(self.model.log_likelihood, W=W, Z=Z)
-        return self.model.log_likelihood(W=W, Z=Z)
+    def log_likelihood(self, samples, batch=None):
+        W, Z = self.unstack(samples, batch=batch)
+        if len(Z.shape)==3:
+            return self.vectorize(self.model.log_likelihood, W=W, Z=Z, batch=batch)
+        return self.model.log_likelihood(W=W, Z=Z, batch=batch)
 
     def likelihood(self, samples):
         W, Z = self.unstack(samples)
@@ -369,11 +486,11 @@ class SamplerModel:
         W, Z = self.unstack(samples)
         return self.model.parameters(W=W, Z=Z)
 
-    def log_posterior(self, samples):
-        W, Z = self.unstack(samples)
-        # if len(Z.shape)==3:
-        #     return self.vectorize(self.model.log_posterior, W=W, Z=Z)
-        return self.model.log_posterior(W=W, Z=Z)
+    def log_posterior(self, samples, batch=None):
+        W, Z = self.unstack(samples, batch=batch)
+        if len(Z.shape)==3:
+            return self.vectorize(self.model.log_posterior, W=W, Z=Z, batch=batch)
+        return self.model.log_posterior(W=W, Z=Z, batch=batch)
 
     def ppo(self, samples):
         for sample in samples:
@@ -445,8 +562,11 @@ class BNN:
                        'biases' : architecture['biases'],
                        'activations' : architecture['activations']}   
         self._D, self._layers_D = self._calculate_network_size()
-        self.objective_trace = np.empty((1, 1))
-        self.weight_trace = np.empty((1, self.D))
+        self._layer_offsets = self._calculate_layer_offsets()
+        self.objective_history = GrowableArray(row_shape=(1,))  # Objective at each (recorded) iteration of `fit`.
+        self.weight_history = GrowableArray(row_shape=(self.D,))  # Weights at each (recorded) iteration of `fit`.
+        self.best_objective = np.inf  # Lowest objective seen by `fit` (over all iterations).
+        self.best_weights = None  # Weights with the lowest objective.
         
         self.seed = seed
         self.random = np.random.RandomState(seed)
@@ -484,6 +604,16 @@ class BNN:
         """ Number of hidden layers (not counting input or output). """
         return len(self.layers['hidden_layers_shape'])
 
+    @property
+    def objective_trace(self):
+        """ History of the objective during `fit` (a view of the recorded rows). """
+        return self.objective_history.data
+
+    @property
+    def weight_trace(self):
+        """ History of the weights during `fit` (a view of the recorded rows). """
+        return self.weight_history.data
+
     def _calculate_network_size(self):
         '''
         Calculate the number of weights required to represent the specific architecture
@@ -510,6 +640,28 @@ class BNN:
 
         return D, layers_D
 
+    def _calculate_layer_offsets(self):
+        '''
+        Calculate (once) where the weights of each layer are stored in a row of the S-by-D weights:
+        returns a list with a tuple (start, bias_start, stop, IN, IN_weights, OUT) for each layer,
+        where IN is the number of inputs including the bias row (if any) and IN_weights excludes it,
+        W[:,start:stop] holds the layer's IN-by-OUT matrix (in row-major order),
+        W[:,start:bias_start] holds its IN_weights-by-OUT weights
+        and W[:,bias_start:stop] holds its bias (the last row of the matrix; empty if there is no bias).
+        '''
+        source_sizes = [self.layers['input_n']] + self.layers['all_layers_shape'][:-1]
+        target_sizes = self.layers['all_layers_shape']
+        offsets = []
+        cursor = 0
+        for i, (source_size, target_size) in enumerate(zip(source_sizes, target_sizes)):
+            source_size += self.layers['biases'][i]  # 0 or 1
+            stop = cursor + source_size*target_size
+            bias_start = stop - target_size if self.layers['biases'][i] else stop
+            offsets.append( (cursor, bias_start, stop, source_size, source_size-self.layers['biases'][i], target_size) )
+            cursor = stop
+        assert cursor == self.D, f"Layer offsets cover {cursor} weights but expected {self.D}."
+        return offsets
+
     def random_weights(self, S=1):
         return self.random.normal(0, 1, size=(S, self.D))
 
@@ -584,28 +736,36 @@ class BNN:
         # Determine how many sets of weights we have:
         S = W.shape[0]
             
-        # Get sizes of layers:
-        source_sizes = [self.layers['input_n']] + self.layers['all_layers_shape'][:-1]
-        target_sizes = self.layers['all_layers_shape']
-        for i,bias in enumerate(self.layers['biases']):
-            source_sizes[i] += bias  # 0 or 1
-            
-        # Loop through layers:
-        W_layers = []
-        cursor = 0  # Keep track row of W.
-        for source_size, target_size in zip(source_sizes,target_sizes):
-            # Get the chunk of weights corresponding to this layer:
-            W_layer = W[ :, cursor:(cursor+source_size*target_size) ]
-            # Reshape the chunk to stack of matrices (i.e. a 3d tensor)
-            # Where each matrix has rows corresponding to source nodes
-            # and columns corresponding to target nodes:
-            W_layer = W_layer.reshape(S, source_size, target_size)
-            # Add tensor to list:
-            W_layers.append(W_layer)
-            # Update cursor:
-            cursor += source_size*target_size
-            
-        return W_layers
+        # Slice the chunk of weights of each layer (using the offsets computed at initialization)
+        # and reshape it to a stack of matrices (a view of W), where each matrix has
+        # rows corresponding to source nodes and columns corresponding to target nodes:
+        return [
+            W[:, start:stop].reshape(S, source_size, target_size)
+            for start, _, stop, source_size, _, target_size in self._layer_offsets
+        ]
+
+    def _unstack_layers(self, W):
+        """
+        Creates a list of (weights, bias) pairs for each layer (used by `forward`).
+        The weights of a layer are an S-by-IN-by-OUT tensor and the bias is
+        an S-by-1-by-OUT tensor (or None for a layer without bias), so that
+        the pre-activation values are computed as `values @ weights + bias`
+        (without appending a column of ones to the values).
+        In the flat S-by-D representation, the bias of a layer is stored after its weights
+        (i.e. it is the last row of the layer's (IN+1)-by-OUT matrix from `unstack_weights`),
+        so both tensors are views of W.
+        """
+        if len(W.shape)==1:
+            W = W.reshape(1,-1)
+        assert len(W.shape)==2 and W.shape[1]==self.D, f"W should be S-by-D with D={self.D}, not {W.shape}."
+        S = W.shape[0]
+        return [
+            (
+                W[:, start:bias_start].reshape(S, weights_size, target_size),
+                W[:, None, bias_start:stop] if bias_start<stop else None,
+            )
+            for start, bias_start, stop, _, weights_size, target_size in self._layer_offsets
+        ]
 
     def set_weights(self, weights):
         '''
@@ -627,16 +787,33 @@ class BNN:
 
     @staticmethod
     def relu(x):
-        return np.maximum(np.zeros(shape=x.shape), x)
+        return np.maximum(0.0, x)
+
+    @staticmethod
+    def _relu_inplace(x):
+        """
+        ReLU that overwrites `x` when it is a plain numpy array
+        (only used on temporary pre-activation values);
+        autograd's boxes cannot be modified, so they are handled by `relu`.
+        """
+        if type(x) is numpy.ndarray:
+            return numpy.maximum(x, 0.0, out=x)
+        return BNN.relu(x)
 
     @staticmethod
     def identity(x):
         return x
 
-    def fit(self, X, Y, step_size=0.01, max_iteration=5000, check_point=100, regularization_coef=None):
+    def fit(self, X, Y, step_size=0.01, max_iteration=5000, check_point=100, regularization_coef=None, thinning=1):
         '''
-
+        Fit the weights by minimizing the mean squared error with ADAM.
+        The objective and its gradient are evaluated once per iteration (together),
+        and every `thinning`-th iteration is appended to the preallocated
+        `objective_history` and `weight_history` buffers.
+        The best weights are tracked on every iteration (including those that are not recorded,
+        and over previous calls to `fit`) and are kept at the end.
         '''
+        assert thinning==int(thinning) and thinning>0, "thinning must be a positive integer."
         # Check X dimensions:
         if len(X.shape) < 2:
             raise ValueError(f"X should be (at least) 2 dimensional; X.shape={X.shape}.")
@@ -654,7 +831,7 @@ class BNN:
             raise NotImplementedError(f"Current implementation does not support datasets of aritrary dimension, must be N-by-M; X.shape={X.shape}.")
         
         def objective(W, t):
-            ''' Callbacks for each optimization step '''
+            ''' Mean squared error (optionally regularized) '''
             squared_error = np.linalg.norm(Y - self.forward(X, weights=W), axis=-1)**2
             if regularization_coef is None:
                 mse = np.mean(squared_error, axis=-1)
@@ -663,21 +840,35 @@ class BNN:
                 mse = np.mean(squared_error, axis=-1) + regularization_coef * np.linalg.norm(W, axis=-1)
                 return mse
 
-        obj_gradient = grad(objective)
+        obj_value_and_grad = value_and_grad(objective)
+        last_objective = [None]  # Objective at the weights of the latest gradient (read by the callback).
+
+        def obj_gradient(W, t):
+            ''' Gradient for ADAM (keeps the objective from the same evaluation) '''
+            objective_val, gradient = obj_value_and_grad(W, t)
+            last_objective[0] = float(np.squeeze(objective_val))
+            return gradient
 
         def _call_back(weights, iteration, g):
             ''' Callbacks for each optimization step '''
-            objective_val = objective(weights, iteration)
-            self.objective_trace = np.vstack((self.objective_trace, objective_val))
-            self.weight_trace = np.vstack((self.weight_trace, weights))
+            objective_val = last_objective[0]
+            if objective_val < self.best_objective:
+                self.best_objective = objective_val
+                self.best_weights = np.array(weights).reshape(1,-1)  # Copy.
+            if iteration % thinning == 0:
+                self.objective_history.append(objective_val)
+                self.weight_history.append(weights.reshape(-1))
             if (check_point is not None) and (iteration % check_point == 0):
-                print("Iteration {} lower bound {}; gradient mag: {}".format(iteration, objective_val, np.linalg.norm(obj_gradient(weights, iteration))))
+                print("Iteration {} lower bound {}; gradient mag: {}".format(iteration, objective_val, np.linalg.norm(g)))
+
+        # Preallocate the history:
+        self.objective_history.reserve(int(np.ceil(max_iteration/thinning)))
+        self.weight_history.reserve(int(np.ceil(max_iteration/thinning)))
 
-    
         # Run the training method
         adam(obj_gradient, self.weights, step_size=step_size, num_iters=max_iteration, callback=_call_back)
-        optimum_index = np.argmin(self.objective_trace[1:])
-        self.weights = self.weight_trace[1:][optimum_index].reshape(1,-1)
+        if self.best_weights is not None:
+            self.weights = self.best_weights.copy()
         return
 
     def forward(self, X, weights=None):
@@ -692,6 +883,9 @@ class BNN:
         The current implementation requires either R=1 or R=S
         (i.e. if multiple datasets are provided, there must be a corresponding number of weights).
         This allows vectorization over S models.
+        A single dataset (or a single set of weights) is broadcast against the stack
+        by the matrix products, so it is never copied S times:
+        only the activations of each layer (S-by-N-by-OUT) are materialised.
         '''
         # Get weights:
         W = self.weights if weights is None else weights
@@ -719,43 +913,38 @@ class BNN:
         # Use S to refer to larger stack size and ignore R:
         S = max(S,R)
         del R
-        # Broadcast both inputs to have size S:
-        if W.shape[0]<S:
-            W = np.tile(W, reps=(S,1))  # Repeat S times along first axis and preserve other axis (D).
-        if X.shape[0]<S:
-            X = np.tile(X, reps=(S,1,1))  # Repeat S times along first axis and preserve other axes (N and M).
+        # Note: Inputs with a stack size of 1 are not tiled to size S;
+        #       `matmul` broadcasts them over the stack of the other input.
         
-        # Get weights for each layer (as tensors):
-        W_layers = self.unstack_weights(W=W)
+        # Get weights and biases for each layer (as 1-by-IN-by-OUT or S-by-IN-by-OUT tensors
+        # and 1-by-1-by-OUT or S-by-1-by-OUT tensors, respectively):
+        W_layers = self._unstack_layers(W=W)
 
         # Determine shape of output:
         Y_shape = tuple([S,*X.shape[1:-1], self.layers['output_n'] ])  # Determine shape of output.
 
-        # Copy data to values to iterate through the network
-        try:
-            # Fails if `X` is a numpy autograd ArrayBox instead of a numpy ndarray:
-            values_in = X.copy()
-        except:
-            # Skip copy if it fails:
-            values_in = X
+        # The input is not modified, so it does not need to be copied:
+        values_in = X
 
         # Loop through layers:
-        #   Reminder: W_layer is an S-by-IN-by-OUT tensor of the weights for S models,
+        #   Reminder: weights is an S-by-IN-by-OUT tensor of the weights for S models,
         #   with layer inputs on the rows and layer outputs on the columns.
-        for i, weights in enumerate(W_layers):
-            
-            # If there is a bias, postpend a column of ones to each matrix:
-            bias = self.layers['biases'][i]
-            if bias==1:
-                bias_features = np.ones((*values_in.shape[:-1],1))
-                values_in = np.append(values_in,bias_features, axis=-1)
+        for i, (weights, bias) in enumerate(W_layers):
 
-            # Calculate pre-activation values:
+            # Calculate pre-activation values
+            # (broadcasting a single input or a single set of weights over the stack):
             values_pre = np.matmul( values_in, weights )
 
-            # Apply activation fucntion:
+            # Add the bias (in place, unless autograd is tracing the values):
+            if bias is not None:
+                if type(values_pre) is numpy.ndarray and type(bias) is numpy.ndarray:
+                    values_pre += bias
+                else:
+                    values_pre = values_pre + bias
+
+            # Apply activation fucntion (the pre-activation values are a temporary, so ReLU may overwrite them):
             if self.layers['activations'][i] == 'relu':
-                values_out = self.relu(values_pre)
+                values_out = self._relu_inplace(values_pre)
             elif self.layers['activations'][i] == 'linear':
                 values_out = self.identity(values_pre)
             else:
@@ -862,11 +1051,12 @@ class BNN_LV(BNN):
             S = max(X.shape[0],Z.shape[0])
             assert X.shape[0] in {1,S}, f"If either X or Z is stacked, they must have the same stack size; cannot broadcast {X.shape} and {Z.shape}"
             assert Z.shape[0] in {1,S}, f"If either X or Z is stacked, they must have the same stack size; cannot broadcast {X.shape} and {Z.shape}"
-            # Repeat one input if needed to get equal stacks:
+            # Broadcast one input if needed to get equal stacks
+            # (read-only views, the values are only copied once by the concatenation below):
             if X.shape[0]<S:
-                X = np.tile(X, reps=(S,1,1))
+                X = np.broadcast_to(X, (S,*X.shape[1:]))
             if Z.shape[0]<S:
-                Z = np.tile(X, reps=(S,1,1))
+                Z = np.broadcast_to(Z, (S,*Z.shape[1:]))
         # Augment X with Z:
         X_ = np.concatenate([X,Z], axis=-1)
         return X_
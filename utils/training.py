@@ -4,19 +4,311 @@ import time
 
 from PIL import Image
 import matplotlib.pyplot as plt
+import numpy
 
 from autograd import numpy as np
 from autograd import scipy as sp
-from autograd import grad
+from autograd import grad, make_vjp
+from autograd.extend import vspace
 from autograd.misc.optimizers import adam
 
 import wandb
 
+from utils.buffers import GrowableArray
+
+
+class GradientProvider:
+    """
+    Builds the gradient of a function once (per sampler) and reuses it for every evaluation.
+    The function may return a scalar or a vector (e.g. one value per row of an S-by-D matrix);
+    in the latter case the gradient is taken of the sum of the outputs, which gives the gradient
+    of each row when the rows are independent.
+    """
+
+    def __init__(self, func, argnum=0):
+        """
+        func:
+            The function to differentiate (e.g. a log target density).
+
+        argnum:
+            Index of the positional argument to differentiate with respect to.
+        """
+        self.func = func
+        self.argnum = argnum
+        self.n_evals = 0  # Number of (fused) function and gradient evaluations.
+        # Build the vector-Jacobian product once:
+        self._make_vjp = make_vjp(func, argnum=argnum)
+
+    def value_and_grad(self, *args):
+        """
+        Evaluate the function and its gradient with a single forward pass.
+        Returns the (unreduced) function value and the gradient.
+        """
+        vjp, value = self._make_vjp(*args)
+        self.n_evals += 1
+        return value, vjp(vspace(value).ones())
+
+    def grad(self, *args):
+        """
+        Evaluate the gradient only (the function value is discarded).
+        """
+        _, gradient = self.value_and_grad(*args)
+        return gradient
+
+    def __call__(self, *args):
+        return self.grad(*args)
+
+
+class Checkpoint:
+    """
+    Append-only binary checkpoint for the state of a sampler.
+
+    Each growing history (e.g. the samples of HMC) is written as raw binary rows
+    to its own file (`<root>.<name>.bin`), and only the rows that were added since
+    the previous save are appended to it. The small part of the state (random state,
+    counters, and the shape and data type of each history) is rewritten on every save
+    to an index file (`<root>.npz`, i.e. the given `filepath`).
+    Histories are loaded back as memory-mapped arrays.
+    """
+
+    def __init__(self, filepath):
+        """
+        filepath:
+            Path of the index file (e.g. "hmc_state.npz");
+            the history files are stored next to it.
+        """
+        self.filepath = filepath
+        self.root = os.path.splitext(filepath)[0]
+        self._persisted = dict()  # For each history: (number of rows, row shape, dtype) already on disk.
+
+    def history_path(self, name):
+        return f"{self.root}.{name}.bin"
+
+    def _write_history(self, name, history):
+        """
+        Write the new rows of a history (or the whole history, if the file on disk does not match).
+        """
+        history = np.asarray(history)
+        path = self.history_path(name)
+        n_rows, row_shape, dtype = history.shape[0], history.shape[1:], history.dtype
+        row_nbytes = int(np.prod(row_shape, dtype=int)) * dtype.itemsize
+        persisted = self._persisted.get(name)
+        can_append = (
+            (persisted is not None)
+            and (persisted[1:] == (row_shape, dtype))
+            and (persisted[0] <= n_rows)
+            and os.path.isfile(path)
+            and (os.path.getsize(path) == persisted[0]*row_nbytes)
+        )
+        start = persisted[0] if can_append else 0
+        with open(path, 'ab' if can_append else 'wb') as f:
+            f.write(np.ascontiguousarray(history[start:]).tobytes())
+        self._persisted[name] = (n_rows, row_shape, dtype)
+        return path
+
+    def save(self, histories, state, replace=False):
+        """
+        histories:
+            Dictionary of arrays (or buffers) that only grow along their first dimension.
+        state:
+            Dictionary of (small) arrays or scalars that are rewritten on every save.
+        Returns the list of files that were written.
+        """
+        directory = os.path.dirname(self.filepath)
+        if directory and not os.path.isdir(directory):
+            raise FileNotFoundError(f"Make sure directory exists: {directory}")
+        if not replace and os.path.isfile(self.filepath) and (len(self._persisted)==0):
+            raise FileExistsError(f"Operation would overwrite file: {self.filepath}")
+        paths = []
+        index = dict(state)
+        for name, history in histories.items():
+            paths.append(self._write_history(name, history))
+            n_rows, row_shape, dtype = self._persisted[name]
+            index[f"{name}__shape"] = np.array((n_rows, *row_shape), dtype=int)
+            index[f"{name}__dtype"] = np.array(dtype.str)
+        # Write the index last, so that it never refers to rows that are not on disk:
+        with open(self.filepath, 'wb') as f:
+            np.savez(f, **index)
+        return [self.filepath] + paths
+
+    def load(self, mmap=True):
+        """
+        Returns a dictionary of histories (memory-mapped if `mmap` is True)
+        and a dictionary with the rest of the state.
+        """
+        with np.load(self.filepath, allow_pickle=False) as index:
+            index = {key : index[key] for key in index.files}
+        histories, state = dict(), dict()
+        names = [key[:-len('__shape')] for key in index if key.endswith('__shape')]
+        for name in names:
+            shape = tuple(int(n) for n in index.pop(f"{name}__shape"))
+            dtype = np.dtype(str(index.pop(f"{name}__dtype")))
+            path = self.history_path(name)
+            if shape[0]==0:
+                history = np.zeros(shape, dtype=dtype)
+            elif mmap:
+                history = np.memmap(path, dtype=dtype, mode='r', shape=shape)
+            else:
+                history = np.fromfile(path, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+            histories[name] = history
+            self._persisted[name] = (shape[0], shape[1:], dtype)
+        state.update(index)
+        return histories, state
+
+    @staticmethod
+    def pack_random_state(np_random):
+        """
+        Represent the state of a numpy RandomState as a dictionary of arrays.
+        """
+        name, key, pos, has_gauss, cached_gaussian = np_random.get_state()
+        return {
+            'random_state_key' : np.asarray(key, dtype=np.uint32),
+            'random_state_pos' : np.array(pos),
+            'random_state_has_gauss' : np.array(has_gauss),
+            'random_state_cached_gaussian' : np.array(cached_gaussian),
+        }
+
+    @staticmethod
+    def unpack_random_state(state):
+        """
+        Build the tuple expected by `RandomState.set_state` from `pack_random_state`'s output.
+        """
+        return (
+            'MT19937',
+            np.asarray(state['random_state_key'], dtype=np.uint32),
+            int(state['random_state_pos']),
+            int(state['random_state_has_gauss']),
+            float(state['random_state_cached_gaussian']),
+        )
+
+
+def effective_sample_size(chain_samples):
+    """
+    Estimate the effective sample size of each dimension of an S-by-C-by-D tensor
+    of samples (S samples from each of C chains) from the autocorrelation of the chains,
+    using the multi-chain estimator and Geyer's initial monotone sequence (as in Stan).
+    Returns a length-D vector.
+    """
+    chain_samples = numpy.asarray(chain_samples, dtype=float)
+    if len(chain_samples.shape)==2:
+        chain_samples = chain_samples.reshape(chain_samples.shape[0],1,-1)  # Single chain.
+    S, C, D = chain_samples.shape
+    assert S>3, "Expects at least 4 samples per chain."
+    # Autocovariance of each chain (via FFT, padded to avoid circular correlation):
+    centered = chain_samples - chain_samples.mean(axis=0)
+    n_fft = 2**int(numpy.ceil(numpy.log2(2*S)))
+    spectrum = numpy.fft.rfft(centered, n=n_fft, axis=0)
+    acov = numpy.fft.irfft(spectrum*numpy.conjugate(spectrum), n=n_fft, axis=0)[:S] / S
+    # Combine within-chain and between-chain variance:
+    chain_var = acov[0] * S/(S-1.0)
+    within_var = chain_var.mean(axis=0)
+    var_plus = within_var*(S-1.0)/S
+    if C>1:
+        var_plus = var_plus + chain_samples.mean(axis=0).var(axis=0, ddof=1)
+    var_plus = numpy.where(var_plus>0, var_plus, numpy.inf)
+    rho = 1.0 - (within_var - acov.mean(axis=1)) / var_plus  # Autocorrelation at each lag (S-by-D).
+    rho[0] = 1.0
+    # Sum pairs of autocorrelations while they are positive (and keep them monotone):
+    n_pairs = S//2
+    pairs = rho[:2*n_pairs:2] + rho[1:2*n_pairs:2]
+    positive = numpy.cumprod(pairs>0, axis=0).astype(bool)
+    pairs = numpy.minimum.accumulate(numpy.where(positive, pairs, 0.0), axis=0)
+    tau = -1.0 + 2.0*numpy.sum(pairs, axis=0)
+    tau = numpy.maximum(tau, 1.0/numpy.log10(S*C))
+    return S*C/tau
+
+
+class DualAveraging:
+    """
+    Dual-averaging adaptation of the step size towards a target acceptance probability,
+    as described in Hoffman and Gelman (2014): https://arxiv.org/abs/1111.4246 (Algorithm 5).
+    """
+
+    def __init__(self, step_size, target_accept=0.8, gamma=0.05, t0=10, kappa=0.75):
+        self.target_accept = target_accept
+        self.gamma = gamma
+        self.t0 = t0
+        self.kappa = kappa
+        self.restart(step_size)
+
+    def restart(self, step_size):
+        """
+        Restart the adaptation from a new initial step size (e.g. after the mass matrix changes).
+        """
+        self.mu = np.log(10*step_size)  # Bias the iterates towards larger steps.
+        self.m = 0
+        self.H_bar = 0.0
+        self.log_step_size = np.log(step_size)
+        self.log_step_size_bar = 0.0
+
+    def update(self, accept_prob):
+        """
+        Update the statistics with the acceptance probability of the latest iteration
+        and return the step size for the next iteration.
+        """
+        accept_prob = 0.0 if not np.isfinite(accept_prob) else accept_prob
+        self.m += 1
+        m, t0 = self.m, self.t0
+        self.H_bar = (1.0-1.0/(m+t0))*self.H_bar + 1.0/(m+t0)*(self.target_accept-accept_prob)
+        self.log_step_size = self.mu - np.sqrt(m)/self.gamma*self.H_bar
+        weight = m**(-self.kappa)
+        self.log_step_size_bar = weight*self.log_step_size + (1.0-weight)*self.log_step_size_bar
+        return np.exp(self.log_step_size)
+
+    @property
+    def final_step_size(self):
+        """ Averaged step size (used after the adaptation ends). """
+        return np.exp(self.log_step_size_bar)
+
+
+class WelfordVariance:
+    """
+    Running (per-dimension) mean and variance of a stream of samples,
+    using Welford's algorithm (updated with a batch of rows at a time, e.g. one row per chain).
+    """
+
+    def __init__(self, dims):
+        self.dims = dims
+        self.clear()
+
+    def clear(self):
+        self.n = 0
+        self.mean = numpy.zeros(self.dims)
+        self.m2 = numpy.zeros(self.dims)
+
+    def update(self, rows):
+        """
+        Add the rows of an R-by-D matrix (combined with the previous statistics as in Chan et al.).
+        """
+        rows = numpy.asarray(rows, dtype=float).reshape(-1,self.dims)
+        n_rows = rows.shape[0]
+        rows_mean = rows.mean(axis=0)
+        rows_m2 = numpy.sum((rows-rows_mean)**2, axis=0)
+        n = self.n + n_rows
+        delta = rows_mean - self.mean
+        self.mean = self.mean + delta*n_rows/n
+        self.m2 = self.m2 + rows_m2 + delta**2*self.n*n_rows/n
+        self.n = n
+
+    @property
+    def variance(self):
+        return self.m2/(self.n-1)
+
+    def regularized_variance(self, shrinkage=5, jitter=1e-3):
+        """
+        Variance shrunk towards a small constant (as in Stan), to stabilize short windows.
+        """
+        n = self.n
+        return (n/(n+shrinkage))*self.variance + jitter*(shrinkage/(n+shrinkage))
+
 
 class HMC:
     """
     Implementation of Hamiltonian-Montecarlo (HMC) sampling
     using Euclidean-Gaussian kinetic energy.
+    Multiple independent chains can be advanced together,
+    in which case the positions of the C chains are stored
+    as the rows of a C-by-D matrix.
     """
 
     def __init__(self,
@@ -24,14 +316,22 @@ class HMC:
         total_samples=1000, leapfrog_steps=20, step_size=1e-1,
         burn_in=0.1, thinning_factor=1,
         mass=1.0, random_seed=None, progress=False,
+        n_chains=1,
+        adapt_step_size=False, target_accept=0.8, adapt_mass=False,
         wb_settings=False,
     ):
         """
         Perform HMC using a Euclidean-Gaussian kinetic energy.
         
         log_target_func:
+            Log of the (unnormalized) target density.
+            Expects an S-by-D matrix of positions and returns one value per row
+            (e.g. `SamplerModel.log_posterior`), so that all chains
+            can be evaluated with a single call.
 
         position_init:
+            Initial position, as a length-D vector, a 1-by-D matrix
+            (shared by all chains), or a C-by-D matrix (one row per chain).
 
         total_samples, burn_in, thinning_factor:
             Number of desired samples (after burn-in and thinning).
@@ -40,6 +340,7 @@ class HMC:
         
         leapfrog_steps, step_size, mass:
             Hyperparameters for the Euclidian-Gaussian HMC.
+            The mass is either a scalar or a length-D vector (the diagonal of the mass matrix).
 
         random_seed:
             (int or None) Random seed for the sampler.
@@ -47,6 +348,22 @@ class HMC:
         progress:
             (False or int) How often to print progress.
 
+        n_chains:
+            (int) Number of chains C that are advanced together.
+            Every leapfrog step evaluates all chains in one batched call to `log_target_func`
+            and the accept/reject step is performed separately for each chain.
+
+        adapt_step_size, target_accept:
+            (bool, float) Whether to tune the step size during burn-in with dual averaging
+            (Hoffman and Gelman, 2014), so that the average acceptance probability approaches `target_accept`.
+            The averaged step size is used after burn-in.
+
+        adapt_mass:
+            (bool) Whether to estimate a diagonal mass matrix during burn-in.
+            The variance of each dimension is estimated (with Welford's algorithm) over the middle of the burn-in
+            (after the first 15% and before the last 10% of the burn-in iterations)
+            and the mass is set to its inverse; the step size adaptation is restarted from there.
+
         wb_settings:
             (False or dict) Settings for logging to Weights & Biases (optional).
             entity: Username of the project host (by default, uses gpestre/am207 shared project).
@@ -63,7 +380,8 @@ class HMC:
             base_path: Local directory where samples will be saved before W&B upload.
                 (If blank, uses the folder wandb creates for this run;
                 the default is a good choice, but does not seem to work on DeepNote.)
-            filename: Name of the file the HMC samples/state are dumped to (default: "hmc_state.json").
+            filename: Name of the file the HMC samples/state are dumped to (default: "hmc_state.npz").
+                (The samples are appended to a binary file next to it; see `Checkpoint`.)
             archive: A static dictionary of params/values to archive (e.g. info about the priors).
                 (These are logged as hyperparameters addition to the HMC intialization parameters).
             callback: A callback function that is run at every wandb checkpoint (e.g. for drawing plots).
@@ -85,6 +403,10 @@ class HMC:
                 'thinning_factor' : thinning_factor,
                 'mass' : mass,
                 'random_seed' : random_seed,
+                'n_chains' : n_chains,
+                'adapt_step_size' : adapt_step_size,
+                'target_accept' : target_accept,
+                'adapt_mass' : adapt_mass,
             })
             # Define helper function:
             def get_wb_setting(key, default):
@@ -107,7 +429,7 @@ class HMC:
             #       so the use can also specify some other local folder in wb_settings.
             self.wb_base_path = wandb.run.dir if 'base_path' not in self.wb_settings else self.wb_settings['base_path']
             # Save HMC samples/state:
-            self.wb_filename = "hmc_state.json" if 'filename' not in self.wb_settings else self.wb_settings['filename']
+            self.wb_filename = "hmc_state.npz" if 'filename' not in self.wb_settings else self.wb_settings['filename']
             self.wb_filepath = os.path.join(self.wb_base_path, self.wb_filename)
             # Bind the W&B module to the instance, for use in callback (e.g. for plotting progress):
             self.wandb = wandb
@@ -115,10 +437,13 @@ class HMC:
         # Check parameters:
         assert thinning_factor==int(thinning_factor), "thinning_factor must be integer."
         assert (burn_in>=0) and (burn_in<1), "Burn in must be between 0 and 1."
-        assert len(position_init.shape)==1 or position_init.shape[0]==1
+        assert n_chains==int(n_chains) and n_chains>0, "n_chains must be a positive integer."
+        assert (target_accept>0) and (target_accept<1), "target_accept must be between 0 and 1."
+        assert len(position_init.shape)==1 or position_init.shape[0] in {1,n_chains}, f"Expects position_init to have 1 or {n_chains} rows, not {position_init.shape}."
         
-        # Represent position as a 1-by-D matrix:
-        position_init = position_init.reshape(1,-1)
+        # Represent position as a C-by-D matrix (one row per chain):
+        if len(position_init.shape)==1 or position_init.shape[0]==1:
+            position_init = np.tile(position_init.reshape(1,-1), reps=(n_chains,1))
         dims = position_init.shape[1]
         
         # Calculate number of samples for given burn-in and thinning:
@@ -127,24 +452,34 @@ class HMC:
         
         # Store parameters:
         self.log_target_func = log_target_func
+        self.gradient_provider = GradientProvider(log_target_func)  # Gradient is built once and reused.
         self.position_init = position_init
         self.total_samples = total_samples
         self.leapfrog_steps = leapfrog_steps
+        self.step_size_init = step_size
         self.step_size = step_size
         self.burn_in = burn_in
         self.thinning_factor = thinning_factor
+        self.mass_init = mass
         self.mass = mass
         self.random_seed = random_seed
         self.progress = progress
+        self.n_chains = n_chains
+        self.adapt_step_size = adapt_step_size
+        self.target_accept = target_accept
+        self.adapt_mass = adapt_mass
         self.dims = dims
         self.iters = iters
 
         # Build placeholder for state variables:
-        self.raw_samples = None  # History of samples after burn-in and thinning (built as list of arrays and converted to numpy 2D array).
+        self.raw_samples = None  # History of positions (preallocated buffer of C-by-D rows, one per iteration).
         self.n_accepted = None  # Number of accepted samples.
         self.n_rejected = None  # Number of rejected samples.
         self.seconds = None  # Runtime in seconds.
         self.np_random = None  # Numpy random state.
+        self._dual_averaging = None  # Step size adaptation (during burn-in).
+        self._welford = None  # Variance estimate for the mass adaptation (during burn-in).
+        self._checkpoint = None  # Checkpoint file that samples are appended to (see `save_state`).
 
         # Initalize:
         self._reset(warm_start=False)
@@ -158,10 +493,17 @@ class HMC:
         else:
 
             # Reset state history:
-            self.raw_samples = list()
+            self.raw_samples = GrowableArray(row_shape=(self.n_chains,self.dims), capacity=self.iters)
             self.n_accepted = 0
             self.n_rejected = 0
             self.seconds = float("-Inf")
+            self._checkpoint = None
+
+            # Reset tuning parameters (and their adaptation):
+            self.step_size = self.step_size_init
+            self.mass = self.mass_init
+            self._dual_averaging = DualAveraging(self.step_size, target_accept=self.target_accept)
+            self._welford = WelfordVariance(self.dims)
 
             # Reset random state:
             self.np_random = np.random.RandomState(self.random_seed)
@@ -181,18 +523,20 @@ class HMC:
         """
         Calculate the Euclidean-Guassian kinetic energy of
         a particle of mass `m` with momentum `p`
-        (given as a D-dimensional numpy.array).
+        (given as a C-by-D numpy.array, with one row per chain).
+        The mass is a scalar or a length-D vector (the diagonal of the mass matrix).
+        Returns a vector with the energy of each of the C chains.
         """
         #####
         ## Using the fact that M is diagonal by construction:
-        ##   M_determinant := (1/m)**D
-        ##   M_inverse := 1/m * Identity
-        ##   p_transpose @ M_inverse @ p := 1/m * p_transpose @ p
+        ##   M_determinant := prod(1/m)
+        ##   M_inverse := diag(1/m)
+        ##   p_transpose @ M_inverse @ p := sum(p**2/m)
         #####
         m = self.mass
         D = p.shape[1]
-        term_inv = 0.5*( np.sum(p**2)*1/m )
-        term_det = 0.5*np.log( (1/m)**D )
+        term_inv = 0.5*np.sum(p**2/m, axis=-1)
+        term_det = 0.5*np.sum( np.log(1/m) * np.ones(D) )
         term_scalar = 0.5*D*np.log(2*np.pi)
         K = term_inv + term_det + term_scalar
         return K
@@ -200,31 +544,114 @@ class HMC:
     def kinetic_grad(self, p):
         """
         Calculate the gradient of the Euclidean-Guassian kinetic energy
-        with respect to momentum, for a particle with a given mass.
+        with respect to momentum, for a particle with a given (scalar or diagonal) mass.
         """
         m = self.mass
-        return 1.0/m * p
+        return p / m
     
     def potential_func(self, q):
         """
         Calculate the potential energy function
         as the Gibbs distriubtion of the target PDF.
+        Returns a vector with the energy of each of the C chains (rows of `q`).
         """
         # return -np.log(target_func(q))
         result = -self.log_target_func(q)
-        return result
+        return result.reshape(q.shape[0])
     
     # Define the gradient of the potential energy with respect to position:
     def potential_grad(self, q):
         # target_grad = grad(target_func,argnum=0)
         # return - target_grad(q) / target_func(q)
         # Get the logarithmic gradient:  d/dx ln(f(x)) = 1/f(x) * d/dx f(x)  (by chain rule)
-        log_target_grad = grad(self.log_target_func,argnum=0)
-        return - log_target_grad(q)
+        # Note: The chains are independent, so the gradient of the sum over chains
+        #       gives the gradient of each chain in the corresponding row.
+        return - self.gradient_provider.grad(q)
+
+    def potential_value_and_grad(self, q):
+        """
+        Calculate the potential energy (one value per chain) and its gradient
+        with a single evaluation of the target.
+        """
+        log_target, log_target_grad = self.gradient_provider.value_and_grad(q)
+        return -log_target.reshape(q.shape[0]), -log_target_grad
     
-    # Define sampling distriubution for momentum:
+    # Define sampling distriubution for momentum (with covariance M):
     def momentum_sample(self):
-        return self.np_random.normal(loc=0, scale=self.mass, size=(1, self.dims))
+        return self.np_random.normal(loc=0, scale=np.sqrt(self.mass), size=(self.n_chains, self.dims))
+
+    def _transition(self, q_curr, U_curr, G_curr):
+        """
+        Perform one HMC iteration (leapfrog trajectory and accept/reject step) for all chains.
+        Expects the current positions with their potential energy and its gradient
+        and returns the new positions, potential and gradient,
+        along with a dictionary of intermediate values (for logging and debugging).
+        """
+
+        # Sample a random momentum:
+        p_curr = self.momentum_sample()
+        
+        # Take specified number of steps:
+        q_prop = q_curr
+        p_prop = p_curr
+        U_prop = U_curr
+        G_prop = G_curr
+        for j in range(1,1+self.leapfrog_steps):
+            # Leapfrog intergrator
+            # (the gradient at the end of each step is reused at the start of the next one,
+            # and the potential at the final position comes from the same evaluation):
+            p_prop = p_prop - self.step_size/2 * G_prop
+            q_prop = q_prop + self.step_size * self.kinetic_grad(p_prop)
+            U_prop, G_prop = self.potential_value_and_grad(q_prop)
+            p_prop = p_prop - self.step_size/2 * G_prop
+        
+        # Reverse momentum:
+        p_prop = - p_prop
+        
+        # Calculate total energy (current):
+        K_curr = self.kinetic_func(p_curr)
+        H_curr = U_curr + K_curr
+        
+        # Calculate total energy (proposed):
+        K_prop = self.kinetic_func(p_prop)
+        H_prop = U_prop + K_prop
+
+        # Calculate acceptance threshold (for each chain):
+        alpha = np.minimum(1, np.exp( H_curr - H_prop ))
+        
+        # Accept or reject (for each chain):
+        u = self.np_random.uniform(0,1,size=self.n_chains)
+        accepted = (u <= alpha)
+        q_next = np.where(accepted.reshape(-1,1), q_prop, q_curr)
+        U_next = np.where(accepted, U_prop, U_curr)  # Reuse potential of accepted proposals.
+        G_next = np.where(accepted.reshape(-1,1), G_prop, G_curr)  # Reuse gradient of accepted proposals.
+        self.n_accepted += int(np.sum(accepted))
+        self.n_rejected += int(np.sum(~accepted))
+
+        stats = {
+            'p_curr' : p_curr, 'U_curr' : U_curr, 'K_curr' : K_curr, 'H_curr' : H_curr,
+            'q_prop' : q_prop, 'p_prop' : p_prop, 'U_prop' : U_prop, 'K_prop' : K_prop,
+            'alpha' : alpha,
+        }
+        return q_next, U_next, G_next, stats
+
+    def _adapt(self, i, q_curr, stats):
+        """
+        Update the step size and the mass after the i-th iteration of burn-in
+        (see `adapt_step_size` and `adapt_mass`).
+        """
+        if self.adapt_mass:
+            window_start = int(0.15*self.burn_num)
+            window_end = self.burn_num - int(0.1*self.burn_num)
+            if (window_start < i <= window_end):
+                self._welford.update(q_curr)  # One row per chain.
+            if (i == window_end) and (self._welford.n > 1):
+                self.mass = 1.0/self._welford.regularized_variance()
+                self._dual_averaging.restart(self.step_size)
+        if self.adapt_step_size:
+            self.step_size = self._dual_averaging.update(np.mean(stats['alpha']))
+            if i == self.burn_num:
+                self.step_size = self._dual_averaging.final_step_size
 
     def sample(self, new_samples=None, progress=None):
 
@@ -236,11 +663,13 @@ class HMC:
             if len(self.raw_samples)==0:
                 raise RuntimeError("The `new_samples` parameter should only be used for additional runs.")
             # Prepare for warm start:
-            self._reset(warm_start=True)  # Convert arrays back to lists, for appending.
+            self._reset(warm_start=True)
             # Assume brun-in was performed on initial run:
             iters = HMC.calc_iters(total_samples=new_samples, burn_in=0.0, thinning_factor=self.thinning_factor)
-            # Start from last (raw) sample:
-            position_init = np.vstack(self.raw_samples[-1:])
+            # Grow the sample buffer once for the additional iterations:
+            self.raw_samples.reserve(iters)
+            # Start from last (raw) sample of each chain:
+            position_init = np.array(self.raw_samples[-1]).reshape(self.n_chains,self.dims)
         else:
             if len(self.raw_samples)>0:
                 raise RuntimeError("Initial run has already been performed; To get extra samples from a warm state, try `hmc.sample(new_samples=n)` .")
@@ -254,69 +683,28 @@ class HMC:
         time_start = time.time()
         
         # Iterate for specified number of samples:
+        adapting = (self.adapt_step_size or self.adapt_mass) and (len(self.raw_samples)==0)
         q_curr = position_init
-        U_curr = None  # Reuse previous result (or set to None to recalculate).
+        # Potential and its gradient at the current position
+        # (reused across iterations until a proposal is accepted):
+        U_curr, G_curr = self.potential_value_and_grad(q_curr)
         for i in range(1,1+iters):
-            
-            # Sample a random momentum:
-            #q_curr = self.raw_samples[-1]
-            p_curr = self.momentum_sample()
-            
-            # Take specified number of steps:
-            q_prop = q_curr
-            p_prop = p_curr
-            #hist_q_prop = []
-            #hist_p_prop = []
-            for j in range(1,1+self.leapfrog_steps):
-                # # Keep history for debugging:
-                # hist_q_prop.append(q_prop)
-                # hist_p_prop.append(p_prop)
-                # Leapfrog intergrator:
-                p_prop = p_prop - self.step_size/2 * self.potential_grad(q_prop)
-                q_prop = q_prop + self.step_size * self.kinetic_grad(p_prop)
-                p_prop = p_prop - self.step_size/2 * self.potential_grad(q_prop)
-            
-            # Reverse momentum:
-            p_prop = - p_prop
-            
-            # Calculate total energy (current):
-            if U_curr is None:
-                U_curr = self.potential_func(q_curr)
-            K_curr = self.kinetic_func(p_curr)
-            H_curr = U_curr + K_curr
-            
-            # Calculate total energy (proposed):
-            U_prop = self.potential_func(q_prop)
-            K_prop = self.kinetic_func(p_prop)
-            H_prop = U_prop + K_prop
 
-            # Calculate acceptance threshold:
-            alpha = min(1, np.exp( H_curr - H_prop ))
-            
-            # Accept or reject:
-            u = self.np_random.uniform(0,1)
-            if u <= alpha:
-                q_curr = q_prop
-                U_curr = None  # Trigger recalculation.
-                self.n_accepted += 1
-            else:
-                self.n_rejected += 1
-            self.raw_samples.append(q_curr.copy())
+            # Advance all chains by one iteration:
+            q_curr, U_curr, G_curr, stats = self._transition(q_curr, U_curr, G_curr)
+            self.raw_samples.append(q_curr)  # Copied into the preallocated buffer.
+
+            # Tune the step size and mass during burn-in (initial run only):
+            if adapting and (i <= self.burn_num):
+                self._adapt(i, q_curr, stats)
 
             # For debugging:
-            if not ( np.all(np.isfinite(p_prop)) and np.all(np.isfinite(q_prop)) ):
+            if not ( np.all(np.isfinite(stats['p_prop'])) and np.all(np.isfinite(stats['q_prop'])) ):
                 error_msg = f"ERROR: Encountered nan or inf values (iteration {i:,})."
                 error_msg += f"\n    q_curr : {q_curr}"
-                error_msg += f"\n    p_curr : {p_curr}"
-                error_msg += f"\n    U_curr : {U_curr}"
-                error_msg += f"\n    K_curr : {K_curr}"
-                error_msg += f"\n    q_prop : {q_prop}"
-                error_msg += f"\n    p_prop : {p_prop}"
-                error_msg += f"\n    U_prop : {U_prop}"
-                error_msg += f"\n    K_prop : {K_prop}"
+                for key, value in stats.items():
+                    error_msg += f"\n    {key} : {value}"
                 print(error_msg)
-                # print("    hist_q_prop :",np.array(hist_q_prop))
-                # print("    hist_p_prop :",np.array(hist_p_prop))
                 if self.wb_settings:
                     wandb.alert(
                         title = "HMC failure",
@@ -342,21 +730,22 @@ class HMC:
             if self.wb_progress and (i % self.wb_progress == 0):
                 # Upload performance metrics:
                 wandb.log({
-                    'n_samples' : len(self.samples),
+                    'n_samples' : self.n_samples,
                     'n_accepted' : self.n_accepted,
                     'n_rejected' : self.n_rejected,
                     'acceptance_rate' : self.n_accepted/(self.n_accepted+self.n_rejected),
-                    'log_target_func' : self.log_target_func(q_curr),
-                    'kinetic_grad_mag' : np.linalg.norm(self.kinetic_grad(p_curr)),
-                    'potential_grad_mag' : np.linalg.norm(self.potential_grad(q_curr)),
-                    'H_curr' : H_curr,
-                    'U_curr' : U_curr,
-                    'K_curr' : K_curr,
+                    'log_target_func' : np.mean(-U_curr),
+                    'kinetic_grad_mag' : np.linalg.norm(self.kinetic_grad(stats['p_curr'])),
+                    'potential_grad_mag' : np.linalg.norm(G_curr),
+                    'H_curr' : np.mean(stats['H_curr']),
+                    'U_curr' : np.mean(U_curr),
+                    'K_curr' : np.mean(stats['K_curr']),
+                    'step_size' : self.step_size,
                 }, step=i)
                 # Save samples/state and upload them:
                 try:
-                    self.save_state(self.wb_filepath, replace=True)  # Saves a json file locally.
-                    wandb.save(self.wb_filepath, base_path=self.wb_base_path)  # Uploads the file to W&B.
+                    for filepath in self.save_state(self.wb_filepath, replace=True):  # Saves (new) samples locally.
+                        wandb.save(filepath, base_path=self.wb_base_path)  # Uploads the files to W&B.
                 except Exception as e:
                     print(f"Failed to save {self.wb_filepath} at step {i}.\n\t{e}")
                 # Callback function (for producing diagnostic plots):
@@ -375,8 +764,8 @@ class HMC:
         if self.wb_settings:
             # Save final state:
             try:
-                self.save_state(self.wb_filepath, replace=True)  # Saves a json file locally.
-                wandb.save(self.wb_filepath, base_path=self.wb_base_path)  # Uploads the file to W&B.
+                for filepath in self.save_state(self.wb_filepath, replace=True):  # Saves (new) samples locally.
+                    wandb.save(filepath, base_path=self.wb_base_path)  # Uploads the files to W&B.
             except Exception as e:
                 print(f"Failed to save {self.wb_filepath} at step {i}.\n\t{e}")
             # Finish run:
@@ -395,51 +784,110 @@ class HMC:
         # Return new samples:
         return self.samples
 
+    def get_chain_samples(self):
+        """
+        Remove burn-in (by negative indexing) and perform thinning (by slicing).
+        Returns an S-by-C-by-D tensor with the samples of each chain.
+        (This is a read-only view of `.raw_samples`, so no data is copied.)
+        """
+        samples = self.raw_samples.data[self.burn_num::self.thinning_factor]
+        samples.flags.writeable = False
+        return samples
+
     def get_samples(self):
         """
-        Remove burn-in (by negative indexing) and perform thinning (by list slicing).
-        Builds `.samples` from `.raw_samples`.
+        Builds `.samples` from `.raw_samples`,
+        pooling the samples of all chains (one chain after another)
+        in an (S*C)-by-D matrix.
+        (With a single chain, this is a read-only view; otherwise the chains are copied.)
+        """
+        chain_samples = self.get_chain_samples()
+        if self.n_chains==1:
+            return chain_samples.reshape(-1,self.dims)
+        return chain_samples.swapaxes(0,1).reshape(-1,self.dims)
+
+    def effective_sample_size(self):
+        """
+        Effective sample size of each dimension (after burn-in and thinning, over all chains).
         """
-        samples = self.raw_samples[self.burn_num::self.thinning_factor]
-        if len(samples)==0:
-            return np.zeros((0,self.dims))
-        return np.vstack(samples)
+        return effective_sample_size(self.get_chain_samples())
+
+    def effective_samples_per_gradient(self):
+        """
+        Effective sample size of each dimension per evaluation of the gradient of the target
+        (the cost measure that the step size and mass adaptation aim to improve).
+        """
+        return self.effective_sample_size() / self.gradient_provider.n_evals
+
+    @property
+    def n_samples(self):
+        """ Number of samples (after burn-in and thinning, over all chains). """
+        return len(range(self.burn_num, len(self.raw_samples), self.thinning_factor)) * self.n_chains
 
     @property
     def samples(self):
         return self.get_samples()
 
+    @property
+    def chain_samples(self):
+        return self.get_chain_samples()
+
     def save_state(self, filepath, replace=False):
-        # Get raw samples (as list of list of lists):
-        raw_samples = np.array(self.raw_samples).tolist()
-        # Get samples (as list of list of lists):
-        samples = np.array(self.samples).tolist()
-        # Get random state:
-        random_state = list(self.np_random.get_state())
-        random_state[1] = random_state[1].tolist()
+        """
+        Save the sampler state as a binary checkpoint (see `Checkpoint`).
+        Only the raw samples are stored (the burn-in and thinning are reapplied on load),
+        and repeated saves to the same file only append the samples drawn since the last save.
+        Returns the list of files that were written.
+        """
+        if (self._checkpoint is None) or (self._checkpoint.filepath != filepath):
+            self._checkpoint = Checkpoint(filepath)
         # Make dictionary:
         hmc_state = {
-            'raw_samples' : raw_samples,
-            'samples' : samples,
-            'random_state' : random_state,
+            'n_accepted' : self.n_accepted,
+            'n_rejected' : self.n_rejected,
+            'burn_num' : self.burn_num,
+            'thinning_factor' : self.thinning_factor,
+            'seconds' : self.seconds,
+            'step_size' : self.step_size,
+            'mass' : np.asarray(self.mass),
         }
-        # Save dictionary as json:
-        filename = filepath.split('/')[-1]
-        directory = filepath[:-len(filename)]
-        if not os.path.isdir('./'+directory):
-            raise FileNotFoundError(f"Make sure directory exists: {directory}")
-        if not replace and os.path.isfile(filename):
-            raise FileExistsError(f"Operation would overwrite file: {filepath}")
-        with open(filepath, 'w') as f:
-            json.dump(hmc_state, f, indent=4)
+        hmc_state.update(Checkpoint.pack_random_state(self.np_random))
+        # Save samples and state:
+        filepaths = self._checkpoint.save({'raw_samples' : self.raw_samples}, hmc_state, replace=replace)
         print(f"Saved HMC state : {filepath} .")
+        return filepaths
         
     def load_state(self, filepath):
+        """
+        Load a checkpoint written by `save_state` (the samples are memory-mapped).
+        Legacy json files are also supported.
+        """
+        if filepath.endswith('.json'):
+            self._load_state_json(filepath)
+            return
+        self._checkpoint = Checkpoint(filepath)
+        histories, hmc_state = self._checkpoint.load(mmap=True)
+        # Get raw samples (copied to memory only if more samples are drawn):
+        self.raw_samples = GrowableArray.from_array(histories['raw_samples'])
+        # Get counters:
+        self.n_accepted = int(hmc_state['n_accepted'])
+        self.n_rejected = int(hmc_state['n_rejected'])
+        self.seconds = float(hmc_state['seconds'])
+        # Get (tuned) step size and mass:
+        if 'step_size' in hmc_state:
+            self.step_size = float(hmc_state['step_size'])
+            self.mass = hmc_state['mass'] if hmc_state['mass'].shape else float(hmc_state['mass'])
+        # Get random state:
+        self.np_random.set_state(Checkpoint.unpack_random_state(hmc_state))
+        print(f"Loaded HMC state : {filepath} .")
+
+    def _load_state_json(self, filepath):
         # Load dictionary:
         with open(filepath, 'r') as f:
             hmc_state = json.load(f)
         # Get raw samples:
-        self.raw_samples = hmc_state['raw_samples']
+        raw_samples = np.array(hmc_state['raw_samples'], dtype=float).reshape(-1,self.n_chains,self.dims)
+        self.raw_samples = GrowableArray.from_array(raw_samples)
         # Get random state:
         random_state = hmc_state['random_state']
         random_state[1] = np.array(random_state[1])
@@ -448,6 +896,367 @@ class HMC:
         print(f"Loaded HMC state : {filepath} .")
 
 
+class NUTS(HMC):
+    """
+    Implementation of the No-U-Turn Sampler (NUTS), as described in
+    Hoffman and Gelman (2014): https://arxiv.org/abs/1111.4246
+    and Betancourt (2017): https://arxiv.org/abs/1701.02434 .
+    Uses the potential, kinetic energy and leapfrog integrator of `HMC`,
+    but the length of each trajectory is chosen automatically:
+    the trajectory is doubled (forwards or backwards in time, at random) until it makes a U-turn,
+    diverges, or reaches `max_depth` doublings, and the next sample is drawn from the
+    points of the trajectory in proportion to their probability (multinomial sampling).
+    The tree is built iteratively (without recursion) and each chain builds its own tree.
+    """
+
+    def __init__(self,
+        log_target_func, position_init,
+        total_samples=1000, step_size=1e-1,
+        burn_in=0.1, thinning_factor=1,
+        mass=1.0, random_seed=None, progress=False,
+        n_chains=1,
+        adapt_step_size=True, target_accept=0.8, adapt_mass=False,
+        max_depth=10, max_energy_error=1000.0,
+        wb_settings=False,
+    ):
+        """
+        Perform NUTS using a Euclidean-Gaussian kinetic energy.
+        The parameters are the same as for `HMC` (without `leapfrog_steps`), with the following additions:
+
+        max_depth:
+            Maximum number of doublings of the trajectory (i.e. at most 2**max_depth-1 leapfrog steps per sample).
+
+        max_energy_error:
+            Increase in the total energy above which a trajectory is considered divergent (and stopped).
+
+        The step size is adapted during burn-in by default (using the average acceptance statistic of each trajectory).
+        """
+        # Log the extra hyperparameters to W&B (optional):
+        if wb_settings is not False:
+            wb_settings = dict(wb_settings)
+            archive = dict() if 'archive' not in wb_settings else dict(wb_settings['archive'])
+            archive.update({
+                'max_depth' : max_depth,
+                'max_energy_error' : max_energy_error,
+            })
+            wb_settings['archive'] = archive
+        assert max_depth==int(max_depth) and max_depth>0, "max_depth must be a positive integer."
+        self.max_depth = max_depth
+        self.max_energy_error = max_energy_error
+        super().__init__(
+            log_target_func, position_init,
+            total_samples=total_samples, leapfrog_steps=None, step_size=step_size,
+            burn_in=burn_in, thinning_factor=thinning_factor,
+            mass=mass, random_seed=random_seed, progress=progress,
+            n_chains=n_chains,
+            adapt_step_size=adapt_step_size, target_accept=target_accept, adapt_mass=adapt_mass,
+            wb_settings=wb_settings,
+        )
+
+    def _reset(self, warm_start=False):
+        super()._reset(warm_start=warm_start)
+        if not warm_start:
+            self.tree_depths = GrowableArray(row_shape=(self.n_chains,), dtype=int, capacity=self.iters)  # Depth of each tree.
+            self.n_leapfrog = 0  # Total number of leapfrog steps.
+            self.n_divergent = 0  # Number of divergent trajectories.
+
+    def _is_turning(self, p_minus, p_plus, rho):
+        """
+        Generalized U-turn criterion (Betancourt, 2017) for a (sub)trajectory with
+        momenta `p_minus` and `p_plus` at its ends and a sum of momenta `rho`.
+        """
+        return (np.sum(self.kinetic_grad(p_minus)*rho) <= 0) or (np.sum(self.kinetic_grad(p_plus)*rho) <= 0)
+
+    def _leapfrog(self, q, p, G, step_size):
+        """
+        Take a single leapfrog step for one chain (given as a 1-by-D row).
+        """
+        p = p - step_size/2 * G
+        q = q + step_size * self.kinetic_grad(p)
+        U, G = self.potential_value_and_grad(q)
+        p = p - step_size/2 * G
+        return q, p, U[0], G
+
+    def _build_subtree(self, edge, depth, direction, H0):
+        """
+        Extend the trajectory from `edge` (a tuple q, p, U, G) by 2**depth leapfrog steps in the given direction.
+        The leaves are generated one at a time; the U-turn criterion is checked on every
+        balanced sub-subtree by keeping the momentum and running momentum sum at checkpoints
+        (indexed by the binary representation of the leaf index, as in the iterative NUTS of NumPyro).
+        Returns a dictionary with the new edge, the sampled leaf, the log of the sum of the weights,
+        the sum of momenta, the sum of acceptance statistics, the number of leaves and
+        whether the subtree turned or diverged.
+        """
+        q, p, U, G = edge
+        step_size = direction * self.step_size
+        n_leaves = 2**depth
+        p_ckpts = [None]*(depth+1)
+        rho_ckpts = [None]*(depth+1)
+        rho = np.zeros_like(p)
+        log_weight_sum = -np.inf
+        sample = None
+        accept_sum = 0.0
+        turning = False
+        diverged = False
+        n = 0
+        for leaf in range(n_leaves):
+            q, p, U, G = self._leapfrog(q, p, G, step_size)
+            n += 1
+            self.n_leapfrog += 1
+            H = U + self.kinetic_func(p)[0]
+            energy_error = H - H0
+            if (not np.isfinite(energy_error)) or (energy_error > self.max_energy_error):
+                diverged = True
+                break
+            accept_sum += min(1.0, np.exp(-energy_error))
+            rho = rho + p
+            # Multinomial sampling within the subtree (progressive, uniform in the weights):
+            log_weight = -energy_error
+            log_weight_sum = np.logaddexp(log_weight_sum, log_weight)
+            if np.log(self.np_random.uniform()) < log_weight - log_weight_sum:
+                sample = (q, U, G)
+            # Check for U-turns of the balanced subtrees that end at this leaf:
+            idx_max = bin(leaf >> 1).count('1')
+            if leaf % 2 == 0:
+                p_ckpts[idx_max] = p
+                rho_ckpts[idx_max] = rho
+            else:
+                n_subtrees = len(bin(leaf)) - len(bin(leaf).rstrip('1'))  # Number of trailing ones.
+                for idx in range(idx_max, idx_max-n_subtrees, -1):
+                    subtree_rho = rho - rho_ckpts[idx] + p_ckpts[idx]
+                    if self._is_turning(p_ckpts[idx], p, subtree_rho):
+                        turning = True
+                        break
+                if turning:
+                    break
+        return {
+            'edge' : (q, p, U, G),
+            'sample' : sample,
+            'log_weight_sum' : log_weight_sum,
+            'rho' : rho,
+            'accept_sum' : accept_sum,
+            'n' : n,
+            'turning' : turning,
+            'diverged' : diverged,
+        }
+
+    def _build_tree(self, q0, p0, U0, G0):
+        """
+        Draw the next sample of one chain (positions and momenta given as 1-by-D rows)
+        by iteratively doubling the trajectory.
+        Returns the sample (q, U, G), the tree depth, the average acceptance statistic,
+        the last momentum and whether the trajectory diverged.
+        """
+        H0 = U0 + self.kinetic_func(p0)[0]
+        left = right = (q0, p0, U0, G0)
+        sample = (q0, U0, G0)
+        log_weight_sum = 0.0  # The initial point has weight exp(0).
+        rho = p0
+        accept_sum, n_steps = 0.0, 0
+        diverged = False
+        depth = 0
+        while depth < self.max_depth:
+            direction = 1 if self.np_random.uniform() < 0.5 else -1
+            edge = right if direction==1 else left
+            subtree = self._build_subtree(edge, depth, direction, H0)
+            depth += 1
+            accept_sum += subtree['accept_sum']
+            n_steps += subtree['n']
+            if subtree['diverged'] or subtree['turning']:
+                diverged = subtree['diverged']
+                break
+            # Biased progressive sampling (prefers the new subtree):
+            if (subtree['sample'] is not None) and (np.log(self.np_random.uniform()) < subtree['log_weight_sum'] - log_weight_sum):
+                sample = subtree['sample']
+            log_weight_sum = np.logaddexp(log_weight_sum, subtree['log_weight_sum'])
+            rho = rho + subtree['rho']
+            if direction==1:
+                right = subtree['edge']
+            else:
+                left = subtree['edge']
+            # Check for a U-turn of the whole trajectory:
+            if self._is_turning(left[1], right[1], rho):
+                break
+        accept_stat = accept_sum / max(n_steps, 1)
+        p_last = subtree['edge'][1]
+        return sample, depth, accept_stat, p_last, diverged
+
+    def _transition(self, q_curr, U_curr, G_curr):
+        """
+        Perform one NUTS iteration for all chains (one tree per chain).
+        """
+        p_curr = self.momentum_sample()
+        q_next, U_next, G_next = np.array(q_curr, dtype=float), np.array(U_curr, dtype=float), np.array(G_curr, dtype=float)
+        p_prop = np.array(p_curr, dtype=float)
+        alpha = np.zeros(self.n_chains)
+        depths = np.zeros(self.n_chains, dtype=int)
+        for c in range(self.n_chains):
+            (q, U, G), depth, accept_stat, p_last, diverged = self._build_tree(
+                q_curr[c:c+1], p_curr[c:c+1], U_curr[c], G_curr[c:c+1],
+            )
+            q_next[c], U_next[c], G_next[c] = q[0], U, G[0]
+            p_prop[c] = p_last[0]
+            alpha[c] = accept_stat
+            depths[c] = depth
+            self.n_divergent += int(diverged)
+        moved = np.any(q_next != q_curr, axis=-1)
+        self.n_accepted += int(np.sum(moved))
+        self.n_rejected += int(np.sum(~moved))
+        self.tree_depths.append(depths)
+        K_curr = self.kinetic_func(p_curr)
+        stats = {
+            'p_curr' : p_curr, 'U_curr' : U_curr, 'K_curr' : K_curr, 'H_curr' : U_curr + K_curr,
+            'q_prop' : q_next, 'p_prop' : p_prop, 'U_prop' : U_next, 'K_prop' : self.kinetic_func(p_prop),
+            'alpha' : alpha, 'tree_depth' : depths,
+        }
+        return q_next, U_next, G_next, stats
+
+
+class SGHMC(HMC):
+    """
+    Implementation of Stochastic-Gradient Hamiltonian-Montecarlo (SGHMC) sampling
+    as described in Chen et al. (2014): https://arxiv.org/abs/1402.4102 .
+    The gradient of the potential is estimated on a minibatch of the data at every step
+    and the noise of the estimate is compensated by a friction term (instead of a Metropolis-Hastings step),
+    so the cost of each step does not depend on the size of the dataset.
+    Uses the same interface as `HMC` (including multiple chains, `samples` and `save_state`).
+    """
+
+    def __init__(self,
+        log_target_func, position_init,
+        total_samples=1000, leapfrog_steps=20, step_size=1e-2,
+        burn_in=0.1, thinning_factor=1,
+        mass=1.0, random_seed=None, progress=False,
+        n_chains=1,
+        friction=1.0, noise_estimate=0.0,
+        batch_size=None, sampler_model=None,
+        wb_settings=False,
+    ):
+        """
+        Perform SGHMC using a Euclidean-Gaussian kinetic energy.
+        The parameters are the same as for `HMC`, with the following additions:
+
+        friction:
+            Friction coefficient C (per unit of time), which dissipates the energy added by the noisy gradients.
+            The injected noise has variance 2*(C-B)*step_size, so C should be larger than `noise_estimate`.
+
+        noise_estimate:
+            Estimate B of the variance of the gradient noise (per unit of time); 0 by default.
+
+        batch_size:
+            Number of data points in the minibatch drawn at each step (or None to use the full gradient).
+            Requires `sampler_model` (a `SamplerModel`), which draws the batch and locates its latent variables;
+            `log_target_func` is then called as `log_target_func(samples, batch=batch)` with samples that only
+            contain the weights and the latent variables of the batch (e.g. `sampler_model.log_posterior`),
+            and is expected to scale the data terms by N/B (as `BayesianModel` does).
+
+        sampler_model:
+            The `SamplerModel` whose samples are being drawn (only used for minibatches).
+
+        Each iteration resamples the momentum and takes `leapfrog_steps` steps,
+        and the position at the end of the steps is stored (all proposals are kept).
+        """
+        assert friction>=noise_estimate, "The friction must be at least as large as the estimated gradient noise."
+        if batch_size is not None:
+            assert sampler_model is not None, "Minibatches require a `sampler_model` (to locate the latent variables of each batch)."
+        # Log the extra hyperparameters to W&B (optional):
+        if wb_settings is not False:
+            wb_settings = dict(wb_settings)
+            archive = dict() if 'archive' not in wb_settings else dict(wb_settings['archive'])
+            archive.update({
+                'friction' : friction,
+                'noise_estimate' : noise_estimate,
+                'batch_size' : batch_size,
+            })
+            wb_settings['archive'] = archive
+        # Store parameters:
+        self.friction = friction
+        self.noise_estimate = noise_estimate
+        self.batch_size = batch_size
+        self.sampler_model = sampler_model
+        super().__init__(
+            log_target_func, position_init,
+            total_samples=total_samples, leapfrog_steps=leapfrog_steps, step_size=step_size,
+            burn_in=burn_in, thinning_factor=thinning_factor,
+            mass=mass, random_seed=random_seed, progress=progress,
+            n_chains=n_chains,
+            wb_settings=wb_settings,
+        )
+        # The target is evaluated on batches of samples:
+        if batch_size is not None:
+            self.gradient_provider = GradientProvider(lambda samples, batch: log_target_func(samples, batch=batch))
+
+    def potential_value_and_grad(self, q):
+        """
+        Estimate the potential energy (one value per chain) and its gradient on a minibatch.
+        The gradient of the weights and of the latent variables of the batch is
+        scattered into a C-by-D matrix (the other latent variables get a zero gradient).
+        """
+        if self.batch_size is None:
+            return super().potential_value_and_grad(q)
+        batch = self.sampler_model.sample_batch(self.batch_size, self.np_random)
+        columns = self.sampler_model.batch_columns(batch)
+        log_target, log_target_grad = self.gradient_provider.value_and_grad(q[:,columns], batch)
+        G = numpy.zeros(q.shape)
+        numpy.add.at(G, (slice(None), columns), -log_target_grad)  # Accumulates repeated rows of the batch.
+        return -log_target.reshape(q.shape[0]), G
+
+    def _noise(self, variance):
+        return self.np_random.normal(loc=0, scale=np.sqrt(variance), size=(self.n_chains, self.dims))
+
+    def _transition(self, q_curr, U_curr, G_curr):
+        """
+        Perform one SGHMC iteration for all chains:
+            q <- q + eps * M^-1 p
+            p <- p - eps * grad U(q) - eps * C M^-1 p + N(0, 2 (C-B) eps)
+        """
+        eps = self.step_size
+        p_curr = self.momentum_sample()
+        q_prop = q_curr
+        p_prop = p_curr
+        U_prop = U_curr
+        G_prop = G_curr
+        for j in range(1,1+self.leapfrog_steps):
+            q_prop = q_prop + eps * self.kinetic_grad(p_prop)
+            U_prop, G_prop = self.potential_value_and_grad(q_prop)
+            p_prop = p_prop - eps * G_prop - eps * self.friction * self.kinetic_grad(p_prop)
+            p_prop = p_prop + self._noise(2*(self.friction-self.noise_estimate)*eps)
+        # There is no accept/reject step:
+        self.n_accepted += self.n_chains
+        K_curr = self.kinetic_func(p_curr)
+        stats = {
+            'p_curr' : p_curr, 'U_curr' : U_curr, 'K_curr' : K_curr, 'H_curr' : U_curr + K_curr,
+            'q_prop' : q_prop, 'p_prop' : p_prop, 'U_prop' : U_prop, 'K_prop' : self.kinetic_func(p_prop),
+        }
+        return q_prop, U_prop, G_prop, stats
+
+
+class SGLD(SGHMC):
+    """
+    Implementation of Stochastic-Gradient Langevin Dynamics (SGLD) sampling
+    as described in Welling and Teh (2011): https://www.ics.uci.edu/~welling/publications/papers/stoclangevin_v6.pdf .
+    This is the overdamped limit of SGHMC (no momentum is kept between steps):
+        q <- q - eps/2 * M^-1 grad U(q) + N(0, eps M^-1)
+    Uses the same interface as `SGHMC` (the friction parameters are ignored).
+    """
+
+    def _transition(self, q_curr, U_curr, G_curr):
+        eps = self.step_size
+        q_prop = q_curr
+        U_prop = U_curr
+        G_prop = G_curr
+        for j in range(1,1+self.leapfrog_steps):
+            p_prop = self.momentum_sample()  # Noise with covariance M (scaled by M^-1 below).
+            q_prop = q_prop - eps/2 * self.kinetic_grad(G_prop) + np.sqrt(eps) * self.kinetic_grad(p_prop)
+            U_prop, G_prop = self.potential_value_and_grad(q_prop)
+        self.n_accepted += self.n_chains
+        stats = {
+            'U_curr' : U_curr, 'q_prop' : q_prop, 'p_prop' : p_prop, 'U_prop' : U_prop,
+            'p_curr' : p_prop, 'K_curr' : self.kinetic_func(p_prop), 'H_curr' : U_curr,
+        }
+        return q_prop, U_prop, G_prop, stats
+
+
 class BBVI:
 
     """
@@ -463,6 +1272,8 @@ class BBVI:
         log_target_func, Mu_init, Sigma_init,
         num_samples=1_000, step_size=0.1, num_iters=1_000,
         random_seed=None, progress=False,
+        diagnostic_interval=None,
+        batch_size=None, sampler_model=None,
         wb_settings=False,
     ):
         """
@@ -493,6 +1304,23 @@ class BBVI:
         
         progress :
             Number of iterations at which to print progress updates (or False).
+            (The ELBO and gradient magnitude are recorded from the evaluation used for the ADAM step.)
+
+        diagnostic_interval :
+            Number of iterations at which to compute an independent estimate of the ELBO and its gradient (or None).
+            These extra evaluations use their own random state, so they do not change the optimization;
+            results are stored in `diagnostic_hist` (rows of iteration, ELBO, gradient magnitude).
+
+        batch_size :
+            Number of data points in the minibatch drawn at each step (or None to use the full dataset).
+            Requires `sampler_model` (a `SamplerModel`), which draws the batch and locates its latent variables;
+            `log_target_func` is then called as `log_target_func(samples, batch=batch)` with samples that only
+            contain the weights and the latent variables of the batch (e.g. `sampler_model.log_posterior`),
+            and is expected to scale the data terms by N/B (as `BayesianModel` does).
+            The entropy of the latent variables is scaled the same way, so that the ELBO estimate is unbiased.
+
+        sampler_model :
+            The `SamplerModel` whose samples are being approximated (only used for minibatches).
 
         wb_settings:
             (False or dict) Settings for logging to Weights & Biases (optional).
@@ -510,7 +1338,8 @@ class BBVI:
             base_path: Local directory where samples will be saved before W&B upload.
                 (If blank, uses the folder wandb creates for this run;
                 the default is a good choice, but does not seem to work on DeepNote.)
-            filename: Name of the file the BBVI parameters/state are dumped to (default: "bbvi_state.json").
+            filename: Name of the file the BBVI parameters/state are dumped to (default: "bbvi_state.npz").
+                (The histories are appended to binary files next to it; see `Checkpoint`.)
             archive: A static dictionary of params/values to archive (e.g. info about the priors).
                 (These are logged as hyperparameters addition to the BBVI intialization parameters).
             callback: A callback function that is run at every wandb checkpoint (e.g. for drawing plots).
@@ -529,6 +1358,8 @@ class BBVI:
                 'step_size' : step_size,
                 'num_iters' : num_iters,
                 'random_seed' : random_seed,
+                'diagnostic_interval' : diagnostic_interval,
+                'batch_size' : batch_size,
                 'Mu_init' : Mu_init,
                 'Sigma_init' : Sigma_init,
             })
@@ -553,7 +1384,7 @@ class BBVI:
             #       so the use can also specify some other local folder in wb_settings.
             self.wb_base_path = wandb.run.dir if 'base_path' not in self.wb_settings else self.wb_settings['base_path']
             # Save HMC samples/state:
-            self.wb_filename = "bbvi_state.json" if 'filename' not in self.wb_settings else self.wb_settings['filename']
+            self.wb_filename = "bbvi_state.npz" if 'filename' not in self.wb_settings else self.wb_settings['filename']
             self.wb_filepath = os.path.join(self.wb_base_path, self.wb_filename)
             # Bind the W&B module to the instance, for use in callback (e.g. for plotting progress):
             self.wandb = wandb
@@ -584,6 +1415,11 @@ class BBVI:
         # Check that Mu and Sigma match:
         assert Mu_init.shape[1]==Sigma_init.shape[1], "Expect Mu and Sigma to have same dimension."
         dims = Mu_init.shape[1]
+
+        # Check minibatch settings:
+        if batch_size is not None:
+            assert sampler_model is not None, "Minibatches require a `sampler_model` (to locate the latent variables of each batch)."
+            assert dims==sampler_model.D+sampler_model.N*sampler_model.L, f"Expects {sampler_model.D+sampler_model.N*sampler_model.L} variational parameters for the sampler model, not {dims}."
         # Convert covariance to log standard deviation:
         logStDev_init = 0.5*np.log(Sigma_init)
 
@@ -597,19 +1433,27 @@ class BBVI:
         self.num_iters = num_iters
         self.progress = progress
         self.random_seed = random_seed
+        self.diagnostic_interval = diagnostic_interval
+        self.batch_size = batch_size
+        self.sampler_model = sampler_model
         self.dims = dims
         
         # Represent position as a 1-by-2D matrix:
         self.params_init = self._stack(Mu=Mu_init, logStDev=logStDev_init)
 
         # Build placeholder for state variables:
-        self.params_hist = None  # History of parameters at each interation (built as list of arrays and converted to numpy 2D array).
-        self.gradident_hist = None  # History of gradient at each iteration (built as list of arrays and converted to numpy 2D array).
-        self.elbo_hist = None  # History of ELBO value at each iteration (built as list and converted to numpy 1D array).
-        self.magnitude_hist = None  # History of gradient magnitude at each iteration (built as list and converted to numpy 1D array).
+        self.params_hist = None  # History of parameters at each interation (built as a buffer and converted to numpy 2D array).
+        self.gradident_hist = None  # History of gradient at each iteration (built as a buffer and converted to numpy 2D array).
+        self.elbo_hist = None  # History of ELBO value at each iteration (built as a buffer and converted to numpy 2D array).
+        self.magnitude_hist = None  # History of gradient magnitude at each iteration (built as a buffer and converted to numpy 2D array).
+        self.diagnostic_hist = None  # History of (optional) independent ELBO estimates (iteration, ELBO, gradient magnitude).
         self.seconds = None  # Runtime in seconds.
         self.np_random = None  # Numpy random state.
+        self.diagnostic_random = None  # Numpy random state for diagnostics (independent of the optimization).
+        self.gradient_provider = None  # Builds the (fused) objective and gradient once (computed with autograd).
         self.variational_gradient = None  # Gradient function (computed with autograd).
+        self._objective_value = None  # Objective value from the latest gradient evaluation.
+        self._checkpoint = None  # Checkpoint file that histories are appended to (see `save_state`).
         
         # Initialize:
         self._reset(warm_start=False)
@@ -618,28 +1462,36 @@ class BBVI:
 
         if warm_start:
 
-            # Convert state variables from arrays back to lists
+            # Wrap state variables from arrays back into buffers
             #   to continue appending:
-            if not isinstance(self.params_hist, list):
-                self.params_hist = self.params_hist.tolist()
-                self.gradident_hist = self.gradident_hist.tolist()
-                self.elbo_hist = self.elbo_hist.tolist()
-                self.magnitude_hist = self.magnitude_hist.tolist()
+            if not isinstance(self.params_hist, GrowableArray):
+                self.params_hist = GrowableArray.from_array(np.asarray(self.params_hist).reshape(-1,2*self.dims))
+                self.gradident_hist = GrowableArray.from_array(np.asarray(self.gradident_hist).reshape(-1,2*self.dims))
+                self.elbo_hist = GrowableArray.from_array(np.asarray(self.elbo_hist).reshape(-1,1))
+                self.magnitude_hist = GrowableArray.from_array(np.asarray(self.magnitude_hist).reshape(-1,1))
+            if self.diagnostic_hist is None:
+                self.diagnostic_hist = GrowableArray(row_shape=(3,))
+            elif not isinstance(self.diagnostic_hist, GrowableArray):
+                self.diagnostic_hist = GrowableArray.from_array(np.asarray(self.diagnostic_hist).reshape(-1,3))
 
         else:
 
             # Reset state history:
-            self.params_hist = list()
-            self.gradident_hist = list()
-            self.elbo_hist = list()
-            self.magnitude_hist = list()
+            self.params_hist = GrowableArray(row_shape=(2*self.dims,))
+            self.gradident_hist = GrowableArray(row_shape=(2*self.dims,))
+            self.elbo_hist = GrowableArray(row_shape=(1,))
+            self.magnitude_hist = GrowableArray(row_shape=(1,))
+            self.diagnostic_hist = GrowableArray(row_shape=(3,))
             self.seconds = 0
+            self._checkpoint = None
 
-            # Reset random state:
+            # Reset random state (diagnostics draw from a separate stream):
             self.np_random = np.random.RandomState(self.random_seed)
+            self.diagnostic_random = np.random.RandomState(None if self.random_seed is None else [self.random_seed, 1])
 
             # Take gradient of objective:
-            self.variational_gradient = grad(self.variational_objective, argnum=0)
+            self.gradient_provider = GradientProvider(self.variational_objective)
+            self.variational_gradient = self.gradient_provider.grad
 
     def _stack(self, Mu, logStDev):
         """
@@ -661,16 +1513,36 @@ class BBVI:
         return Mu, logStDev
 
     # Define optimizer and callback:
+    def _objective_and_gradient(self, params, iteration):
+        """
+        Gradient function for ADAM that evaluates the objective and its gradient together
+        (from the same Monte Carlo samples) and keeps the objective for the callback.
+        """
+        objective_value, gradient = self.gradient_provider.value_and_grad(params, iteration)
+        self._objective_value = objective_value
+        return gradient
+
+    def _diagnostics(self, params, iteration):
+        """
+        Independent estimate of the ELBO and its gradient magnitude (drawn from `diagnostic_random`).
+        """
+        objective_value, gradient = self.gradient_provider.value_and_grad(params, iteration, self.diagnostic_random)
+        return -objective_value, np.linalg.norm(gradient)
+
     def _callback(self, params, iteration, gradient):
-        # Calculate ELBO:
-        elbo_value = -self.variational_objective(params, iteration)
+        # Get ELBO (from the evaluation used for this step):
+        elbo_value = -self._objective_value
         # Calculate magnitude of gradient:
-        grad_mag = np.linalg.norm(self.variational_gradient(params, iteration))
+        grad_mag = np.linalg.norm(gradient)
         # Update history:
-        self.params_hist.append(params)
-        self.gradident_hist.append(gradient)
+        self.params_hist.append(params.reshape(-1))
+        self.gradident_hist.append(gradient.reshape(-1))
         self.elbo_hist.append(elbo_value)
         self.magnitude_hist.append(grad_mag)
+        # Run diagnostics (optional):
+        if self.diagnostic_interval and ((iteration+1) % self.diagnostic_interval == 0):
+            diagnostic_elbo, diagnostic_grad_mag = self._diagnostics(params, iteration)
+            self.diagnostic_hist.append([iteration+1, diagnostic_elbo, diagnostic_grad_mag])
         # Print progress (optional):
         if self.progress and ((iteration+1) % self.progress == 0):
             printout = "Iteration {} : lower bound = {}, gradient magnitude = {}".format(iteration+1, elbo_value, grad_mag)
@@ -680,16 +1552,20 @@ class BBVI:
         # Log progress to W&B (optional):
         if self.wb_progress and ((iteration+1) % self.wb_progress == 0):
             # Upload performance metrics:
-            wandb.log({
+            metrics = {
                 'params' : params,
                 'gradient' : gradient,
                 'elbo_value' : elbo_value,
                 'grad_mag' : grad_mag,
-            }, step=iteration+1)
+            }
+            if len(self.diagnostic_hist)>0:
+                metrics['diagnostic_elbo_value'] = self.diagnostic_hist[-1,1]
+                metrics['diagnostic_grad_mag'] = self.diagnostic_hist[-1,2]
+            wandb.log(metrics, step=iteration+1)
             # Save samples/state and upload them:
             try:
-                self.save_state(self.wb_filepath, replace=True)  # Saves a json file locally.
-                wandb.save(self.wb_filepath, base_path=self.wb_base_path)  # Uploads the file to W&B.
+                for filepath in self.save_state(self.wb_filepath, replace=True):  # Saves (new) samples locally.
+                    wandb.save(filepath, base_path=self.wb_base_path)  # Uploads the files to W&B.
             except Exception as e:
                 print(f"Failed to save {self.wb_filepath} at step {iteration+1}.\n\t{e}")
         if self.wb_progress:
@@ -721,13 +1597,17 @@ class BBVI:
         #return dims/2*np.log(2*np.pi) + 1/2*np.sum(logStDev**2,axis=-1) + 1/2*dims
         return 0.5* dims *( 1.0 + np.log(2*np.pi) ) + np.sum(logStDev,axis=-1)
 
-    def variational_objective(self, params, iteration=None):
+    def variational_objective(self, params, iteration=None, np_random=None):
         """
         Provides a stochastic estimate of the variational lower bound.
         (The `iteration` parameter is required by ADAM but is not used.)
+        The noise is drawn from `np_random` (by default, the sampler's random state).
         """
+        np_random = self.np_random if np_random is None else np_random
         Mu, logStDev = self._unstack(params)
-        eps_sample = self.np_random.randn(self.num_samples,self.dims)  # Each row is a different sample.
+        if self.batch_size is not None:
+            return self._minibatch_objective(Mu, logStDev, np_random)
+        eps_sample = np_random.randn(self.num_samples,self.dims)  # Each row is a different sample.
         StDev = np.exp(logStDev)
         params_sample = eps_sample * StDev + Mu  # Perturb StDev element-wise for each of `num_samples` in eps_S.
         posterior_vector = self.log_target_func(params_sample).flatten()
@@ -738,6 +1618,31 @@ class BBVI:
         elbo_approx = posterior_term + gaussian_entropy_term
         return -elbo_approx
 
+    def _minibatch_objective(self, Mu, logStDev, np_random):
+        """
+        Stochastic estimate of the variational lower bound from a minibatch of B data points:
+        only the weights and the latent variables of the rows in the batch are sampled and evaluated
+        (so the other latent variables get a zero gradient),
+        and the terms of the latent variables are scaled by N/B.
+        """
+        D = self.sampler_model.D
+        batch = self.sampler_model.sample_batch(self.batch_size, np_random)
+        columns = self.sampler_model.batch_columns(batch)
+        Mu = Mu[:,columns]
+        logStDev = logStDev[:,columns]
+        eps_sample = np_random.randn(self.num_samples,len(columns))  # Each row is a different sample.
+        params_sample = eps_sample * np.exp(logStDev) + Mu
+        posterior_vector = self.log_target_func(params_sample, batch=batch).flatten()
+        if len(posterior_vector) != self.num_samples:
+            raise RuntimeError(f"Expected posterior to have to be a vector of length {self.num_samples} not {posterior_vector.shape}.")
+        posterior_term = np.mean(posterior_vector)
+        # Entropy of the weights and (scaled) entropy of the latent variables in the batch:
+        scale = self.sampler_model.N / len(batch)
+        gaussian_entropy_term = self.gaussian_entropy(logStDev[:,:D]) + scale*np.sum(logStDev[:,D:])
+        gaussian_entropy_term = gaussian_entropy_term + 0.5*(self.dims-D)*( 1.0 + np.log(2*np.pi) )
+        elbo_approx = posterior_term + gaussian_entropy_term
+        return -elbo_approx
+
     def run(self, num_iters=None, progress=None, warm_start=False):
 
         # Optionally override parameters from initialization:
@@ -746,16 +1651,18 @@ class BBVI:
         if progress is not None:
             self.progress = progress
 
-        # Create empty lists of state history (for fresh start)
-        # or convert them from arrays to lists (for appending):
+        # Create empty buffers of state history (for fresh start)
+        # or wrap the arrays in buffers (for appending):
         self._reset(warm_start=warm_start)
+        for history in [self.params_hist, self.gradident_hist, self.elbo_hist, self.magnitude_hist]:
+            history.reserve(self.num_iters)
         
         # Start timer:
         time_start = time.time()
 
         # Perform optimization with ADAM:
         params = adam(
-            grad = self.variational_gradient,
+            grad = self._objective_and_gradient,
             x0 = self.params_init,
             step_size = self.step_size,
             num_iters = self.num_iters,
@@ -773,8 +1680,8 @@ class BBVI:
         if self.wb_settings:
             # Save final state:
             try:
-                self.save_state(self.wb_filepath, replace=True)  # Saves a json file locally.
-                wandb.save(self.wb_filepath, base_path=self.wb_base_path)  # Uploads the file to W&B.
+                for filepath in self.save_state(self.wb_filepath, replace=True):  # Saves (new) samples locally.
+                    wandb.save(filepath, base_path=self.wb_base_path)  # Uploads the files to W&B.
             except Exception as e:
                 print(f"Failed to save {self.wb_filepath} at step {i}.\n\t{e}")
             # Finish run:
@@ -783,11 +1690,12 @@ class BBVI:
             except:
                 print("W & B run already ended. (Should only happen if .sample() is called more than once.)")
         
-        # Convert results to numpy arrays:
-        self.params_hist = np.vstack(self.params_hist)
-        self.gradident_hist = np.vstack(self.gradident_hist)
-        self.elbo_hist = np.vstack(self.elbo_hist)
-        self.magnitude_hist = np.vstack(self.magnitude_hist)
+        # Convert results to numpy arrays (views of the buffers):
+        self.params_hist = self.params_hist.data
+        self.gradident_hist = self.gradident_hist.data
+        self.elbo_hist = self.elbo_hist.data
+        self.magnitude_hist = self.magnitude_hist.data
+        self.diagnostic_hist = self.diagnostic_hist.data
 
         # Unpack paramters (Mu as vector and Sigma as square matrix):
         Mu_final, Sigma_final = BBVI.unstack_params(params, to_square=True)
@@ -800,10 +1708,8 @@ class BBVI:
     def params(self):
         if len(self.params_hist) == 0:
             return None
-        elif isinstance(self.params_hist, list):
-            return self.params_hist[-1]
         else:
-            return self.params_hist[-1,:].reshape(1,-1)
+            return np.asarray(self.params_hist)[-1,:].reshape(1,-1)
 
     def get_samples(self, num=None, seed=None):
         # Determine how many samples to get: 
@@ -819,34 +1725,61 @@ class BBVI:
         return samples
     
     def save_state(self, filepath, replace=False):
-        # Get histories (as lists of lists):
-        params_hist = np.array(self.params_hist).tolist()
-        gradident_hist = np.array(self.gradident_hist).tolist()
-        elbo_hist = np.array(self.elbo_hist).tolist()
-        magnitude_hist = np.array(self.magnitude_hist).tolist()
-        # Get random state:
-        random_state = list(self.np_random.get_state())
-        random_state[1] = random_state[1].tolist()
-        # Make dictionary:
+        """
+        Save the optimizer state as a binary checkpoint (see `Checkpoint`).
+        Repeated saves to the same file only append the iterations since the last save.
+        Returns the list of files that were written.
+        """
+        if (self._checkpoint is None) or (self._checkpoint.filepath != filepath):
+            self._checkpoint = Checkpoint(filepath)
+        # Make dictionaries:
+        histories = {
+            'params_hist' : self.params_hist,
+            'gradident_hist' : self.gradident_hist,
+            'elbo_hist' : self.elbo_hist,
+            'magnitude_hist' : self.magnitude_hist,
+            'diagnostic_hist' : self.diagnostic_hist,
+        }
         bbvi_state = {
-            'params_hist' : params_hist,
-            'gradident_hist' : gradident_hist,
-            'elbo_hist' : elbo_hist,
-            'magnitude_hist' : magnitude_hist,
-            'random_state' : random_state,
+            'seconds' : self.seconds,
         }
-        # Save dictionary as json:
-        filename = filepath.split('/')[-1]
-        directory = filepath[:-len(filename)]
-        if not os.path.isdir('./'+directory):
-            raise FileNotFoundError(f"Make sure directory exists: {directory}")
-        if not replace and os.path.isfile(filename):
-            raise FileExistsError(f"Operation would overwrite file: {filepath}")
-        with open(filepath, 'w') as f:
-            json.dump(bbvi_state, f, indent=4)
+        bbvi_state.update(Checkpoint.pack_random_state(self.np_random))
+        bbvi_state.update({
+            f"diagnostic_{key}" : value
+            for key, value in Checkpoint.pack_random_state(self.diagnostic_random).items()
+        })
+        # Save histories and state:
+        filepaths = self._checkpoint.save(histories, bbvi_state, replace=replace)
         print(f"Saved BBVI state : {filepath} .")
+        return filepaths
         
     def load_state(self, filepath):
+        """
+        Load a checkpoint written by `save_state` (the histories are memory-mapped).
+        Legacy json files are also supported.
+        """
+        if filepath.endswith('.json'):
+            self._load_state_json(filepath)
+            return
+        self._checkpoint = Checkpoint(filepath)
+        histories, bbvi_state = self._checkpoint.load(mmap=True)
+        # Get histories:
+        self.params_hist = histories['params_hist']
+        self.gradident_hist = histories['gradident_hist']
+        self.elbo_hist = histories['elbo_hist']
+        self.magnitude_hist = histories['magnitude_hist']
+        self.diagnostic_hist = histories.get('diagnostic_hist', None)
+        self.seconds = float(bbvi_state['seconds'])
+        # Get random state:
+        self.np_random.set_state(Checkpoint.unpack_random_state(bbvi_state))
+        if 'diagnostic_random_state_key' in bbvi_state:
+            self.diagnostic_random.set_state(Checkpoint.unpack_random_state({
+                key[len('diagnostic_'):] : bbvi_state[key]
+                for key in bbvi_state if key.startswith('diagnostic_')
+            }))
+        print(f"Loaded BBVI state : {filepath} .")
+
+    def _load_state_json(self, filepath):
         # Load dictionary:
         with open(filepath, 'r') as f:
             bbvi_state = json.load(f)